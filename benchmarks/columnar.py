@@ -0,0 +1,204 @@
+"""Compare the row-by-row and the columnar conversion engines (CPU time)
+
+Generates a synthetic archive for the schema, converts it using both engines
+(the columnar one to record batches, without rows) and reports the CPU time
+spent by each, both for the conversion only and for the conversion plus CSV
+writing (`write_csv` for the rows and `columnar.format_csv` for the batches,
+as done by the CSV exporters' `export_batch`). Also checks the output is the
+same: the CSV, the values' types of the rows (also for an archive with NUL
+bytes), the parts written by `transparenciagovbr.convert` and the files
+written by the CSV and Parquet exporters from items and from batches.
+
+Usage: python benchmarks/columnar.py [--rows N] [schema_filename ...]
+"""
+import argparse
+import csv
+import gzip
+import io
+import random
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import pyarrow.parquet
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
+from schema import make_rows
+from transparenciagovbr.convert import write_batches, write_csv
+from transparenciagovbr.exporters import GzipCsvItemExporter, ParquetItemExporter
+from transparenciagovbr.spiders.base import parse_csv_rows
+from transparenciagovbr.utils import columnar
+from transparenciagovbr.utils.fields import get_schema
+
+
+def make_archive(filename, schema_filename, quantity, nul=False):
+    """Create an archive with `quantity` rows
+
+    With `nul`, NUL bytes are added inside some values and at the end of the
+    file (like some of the Portal's files, padded with them).
+    """
+
+    header, data = make_rows(schema_filename, quantity)
+    fobj = io.StringIO()
+    writer = csv.writer(fobj, delimiter=";")
+    writer.writerow(header)
+    writer.writerows(data)
+    content = fobj.getvalue().encode("iso-8859-1")
+    if nul:
+        content = content.replace(b";", b"\x00;", 1000) + b"\x00" * 4096
+    with zipfile.ZipFile(filename, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("20210101_Benchmark.csv", content)
+
+
+def typed_rows(engine, filename, schema):
+    """Return the rows converted by `engine` with the type of each value"""
+
+    return [
+        {key: (type(value), value) for key, value in row.items()}
+        for row in engine(str(filename), schema)
+    ]
+
+
+def rows_engine(filename, schema):
+    return parse_csv_rows(filename, "_Benchmark.csv", "iso-8859-1", schema)
+
+
+def columnar_batches(filename, schema):
+    converter = columnar.ColumnarSchema(schema)
+    batches = columnar.read_zip_batches(
+        filename, "_Benchmark.csv", "iso-8859-1", converter.original_names
+    )
+    for batch in batches:
+        yield converter.record_batch(batch)
+
+
+def columnar_engine(filename, schema):
+    converter = columnar.ColumnarSchema(schema)
+    batches = columnar.read_zip_batches(
+        filename, "_Benchmark.csv", "iso-8859-1", converter.original_names
+    )
+    for batch in batches:
+        yield from converter.rows(batch)
+
+
+def write_csv_batches(fobj, batches):
+    """Columnar version of `write_csv` (with header)"""
+
+    text_fobj = io.TextIOWrapper(fobj, encoding="utf-8", newline="", write_through=True)
+    header = False
+    for batch in batches:
+        if not header and batch.num_rows:
+            csv.writer(text_fobj).writerow(columnar.first_row(batch).keys())
+            header = True
+        text_fobj.write(columnar.format_csv(batch))
+    text_fobj.detach()
+
+
+def export(exporter_class, filename, method, data, **kwargs):
+    """Export `data` (rows or batches) calling the exporter's `method`"""
+
+    exporter = exporter_class(open(filename, mode="wb"), **kwargs)
+    exporter.start_exporting()
+    start = time.process_time()
+    for item_or_batch in data:
+        getattr(exporter, method)(item_or_batch)
+    exporter.finish_exporting()
+    return time.process_time() - start
+
+
+def check_outputs(temp_path, filename, schema_filename, schema):
+    """Check the parts and the exporters' files are the same with both engines"""
+
+    parts = [Path(temp_path) / f"part-{name}.csv.gz" for name in ("rows", "columnar")]
+    with gzip.open(parts[0], mode="wb") as fobj:
+        rows_result = write_csv(fobj, rows_engine(str(filename), schema), header=False)
+    columnar_result = write_batches(parts[1], columnar_batches(str(filename), schema))
+    assert rows_result == columnar_result, "Parts have different field names or counts"
+    assert gzip.open(parts[0]).read() == gzip.open(parts[1]).read(), "Different parts"
+
+    outputs = [Path(temp_path) / f"export-{name}.csv.gz" for name in ("rows", "columnar")]
+    export(GzipCsvItemExporter, outputs[0], "export_item", rows_engine(str(filename), schema))
+    export(
+        GzipCsvItemExporter, outputs[1], "export_batch", columnar_batches(str(filename), schema)
+    )
+    assert gzip.open(outputs[0]).read() == gzip.open(outputs[1]).read(), "Different CSVs"
+
+    outputs = [Path(temp_path) / f"export-{name}.parquet" for name in ("rows", "columnar")]
+    times = [
+        export(
+            ParquetItemExporter,
+            output,
+            method,
+            engine(str(filename), schema),
+            schema_filename=schema_filename,
+            row_group_size=4_096,
+        )
+        for output, method, engine in zip(
+            outputs, ("export_item", "export_batch"), (rows_engine, columnar_batches)
+        )
+    ]
+    first, second = [pyarrow.parquet.ParquetFile(output) for output in outputs]
+    assert first.metadata.num_row_groups == second.metadata.num_row_groups
+    assert first.read().equals(second.read()), "Different Parquet files"
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("schema_filenames", nargs="*", default=["despesa_empenho.csv"])
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as temp_path:
+        for schema_filename in args.schema_filenames:
+            filename = Path(temp_path) / f"{schema_filename}.zip"
+            make_archive(filename, schema_filename, args.rows)
+            schema = get_schema(schema_filename)
+            outputs, results = {}, {}
+            engines = (
+                ("rows", rows_engine, write_csv),
+                ("columnar", columnar_batches, write_csv_batches),
+            )
+            for name, engine, write in engines:
+                start = time.process_time()
+                for _ in engine(str(filename), schema):
+                    pass
+                conversion = time.process_time() - start
+                output = io.BytesIO()
+                start = time.process_time()
+                write(output, engine(str(filename), schema))
+                total = time.process_time() - start
+                outputs[name], results[name] = output.getvalue(), (conversion, total)
+                print(
+                    f"{schema_filename:25} {name:8} conversion: {conversion:6.2f}s CPU "
+                    f"({args.rows / conversion:10,.0f} rows/s), with CSV writing: "
+                    f"{total:6.2f}s CPU ({args.rows / total:10,.0f} rows/s)"
+                )
+            assert outputs["rows"] == outputs["columnar"], "Engines have different outputs"
+            nul_filename = Path(temp_path) / f"{schema_filename}.nul.zip"
+            make_archive(nul_filename, schema_filename, min(args.rows, 10_000), nul=True)
+            for name in (filename, nul_filename):
+                assert typed_rows(rows_engine, name, schema) == typed_rows(
+                    columnar_engine, name, schema
+                ), f"Engines have different values (or types) for {name.name}"
+            rows_parquet, columnar_parquet = check_outputs(
+                temp_path, nul_filename, schema_filename, schema
+            )
+            (rows_conversion, rows_total), (columnar_conversion, columnar_total) = results.values()
+            print(
+                f"{schema_filename:25} speedup: conversion {rows_conversion / columnar_conversion:.2f}x, "
+                f"with CSV writing {rows_total / columnar_total:.2f}x (same output)"
+            )
+            print(
+                f"{schema_filename:25} Parquet export of {min(args.rows, 10_000):,} rows: "
+                f"{rows_parquet:6.2f}s CPU for items, {columnar_parquet:6.2f}s CPU for "
+                "batches (same output)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Benchmark and check `parse_description` (despesa_item_empenho) against the original implementation
+
+The descriptions are read from the `_Despesas_ItemEmpenho.csv` files inside
+the despesas archives passed as arguments (like the ones in
+`data/download/despesa`) or, if none is passed, generated in the Portal's
+layout (including descriptions which don't follow it). The output of both
+implementations must be the same for every description.
+
+Usage: python benchmarks/description.py [--rows N] [archive ...]
+"""
+import argparse
+import random
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
+from transparenciagovbr.spiders.despesa_item_empenho import parse_description
+from transparenciagovbr.utils.io import parse_zip_csvs
+
+
+class Text(str):
+    def until(self, substr):
+        return Text(self[: self.find(substr)])
+
+    def after(self, substr):
+        return Text(self[self.find(substr) + len(substr) :])
+
+
+def legacy_parse_description(text):
+    """`parse_description` as it was before the regular expression"""
+
+    new = {
+        "descricao_restante": "",
+        "item": "",
+        "item_material": "",
+        "item_processo": "",
+        "marca": "",
+        "quantidade": "",
+        "unidade": "",
+    }
+    if len(text) < 78 or "MARCA:" not in text:
+        return new
+    part1, part2 = Text(text[:78].strip()), Text(text[78:])
+    try:
+        new["quantidade"] = Decimal(part1.until(" ").strip().replace(".", "").replace(",", "."))
+    except InvalidOperation:
+        return new
+    new["unidade"] = part1.after(" ").strip()
+    item = part2.until(",")
+    if item and item[0] == item[-1] == "'":
+        item = item[1:-1]
+    new["item"] = item
+    rest = part2.after(",")
+    new["descricao_restante"] = rest.until("MARCA:").strip()
+    rest = rest.after("MARCA:")
+    new["marca"] = rest.until("ITEM DO PROCESSO:").strip()
+    rest = rest.after("ITEM DO PROCESSO:")
+    new["item_processo"] = rest.until("ITEM DE MATERIAL:").strip()
+    rest = rest.after("ITEM DE MATERIAL:")
+    new["item_material"] = rest.strip()
+    return new
+
+
+ITEMS = ("'CANETA ESFEROGRAFICA'", "PAPEL A4", "'ALCOOL ETILICO, 70%'", "'LUVA'")
+UNITS = ("UNIDADE", "CAIXA", "RESMA", "LITRO", "PACOTE 100.00 UN")
+MARKERS = ("MARCA:", "ITEM DO PROCESSO:", "ITEM DE MATERIAL:")
+
+
+def make_description():
+    quantity = f"{random.randint(1, 99999):,},{random.randint(0, 99):02d}".replace(",", "X", 1)
+    quantity = quantity.replace("X", ".") if random.random() < 0.3 else quantity.split("X")[-1]
+    part1 = f"{quantity} {random.choice(UNITS)}".ljust(78)
+    parts = [
+        random.choice(ITEMS),
+        ",",
+        "DESCRICAO DO MATERIAL CONFORME EDITAL ",
+        "MARCA: ",
+        random.choice(("BIC", "CHAMEX", "")),
+        " ITEM DO PROCESSO: ",
+        f"{random.randint(1, 999):05d}",
+        " ITEM DE MATERIAL: ",
+        str(random.randint(1000, 999999)),
+    ]
+    choice = random.random()
+    if choice < 0.05:  # Marker missing
+        marker = random.choice(MARKERS[1:])
+        parts = [part.replace(marker, "") for part in parts]
+    elif choice < 0.08:  # Markers out of order
+        parts[3], parts[5] = parts[5], parts[3]
+    elif choice < 0.10:  # No comma after the item
+        parts[1] = " "
+    elif choice < 0.12:  # Invalid quantity
+        part1 = "SERVICO".ljust(78)
+    elif choice < 0.14:  # Short description
+        return "MARCA: X"
+    return part1 + "".join(parts)
+
+
+def read_descriptions(filenames, quantity):
+    descriptions = []
+    for filename in filenames:
+        csvs = parse_zip_csvs(
+            filename,
+            inner_filename_suffix="_Despesas_ItemEmpenho.csv",
+            encoding="iso-8859-1",
+        )
+        for header, reader in csvs:
+            index = header.index("Descrição")
+            for values in reader:
+                if not values:
+                    continue
+                descriptions.append(values[index])
+                if len(descriptions) == quantity:
+                    return descriptions
+    return descriptions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("archives", nargs="*")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.archives:
+        descriptions = read_descriptions(args.archives, args.rows)
+    else:
+        descriptions = [make_description() for _ in range(args.rows)]
+
+    for description in descriptions:
+        expected, result = legacy_parse_description(description), parse_description(description)
+        if expected != result:
+            raise AssertionError(f"Different results for {repr(description)}: {expected} != {result}")
+    print(f"{len(descriptions):,} descriptions checked")
+
+    results = {}
+    for name, function in (("before", legacy_parse_description), ("after", parse_description)):
+        start = time.perf_counter()
+        for description in descriptions:
+            function(description)
+        results[name] = len(descriptions) / (time.perf_counter() - start)
+        print(f"{name:6} {results[name]:12,.0f} descriptions/s")
+    print(f"speedup {results['after'] / results['before']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
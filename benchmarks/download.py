@@ -0,0 +1,142 @@
+"""Benchmark and check `download_file` against a local HTTP server supporting ranges
+
+A random file is served by a local server (with `Range`, `If-Range` and
+`ETag` support, like the Portal's) and downloaded in one connection and in
+segments; the downloaded file must be the same (also when the connections
+to the host are limited to less than the segments). Then the server drops the
+connections in the middle of the body until the download fails and the
+download is started again: the segments must be resumed (without
+downloading the whole file again) and the result must still be the same.
+
+Usage: python benchmarks/download.py [--size MB] [--segments N]
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
+from transparenciagovbr.utils.download import HostLimiter, download_file
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files supporting `Range` (one range per request) and `If-Range`"""
+
+    fail_after = None  # Drop the connection after sending this number of bytes
+    sent = 0  # Body bytes sent by all requests
+    connections = max_connections = 0  # Sending a body (now and at most)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            return self.send_error(404)
+        size = path.stat().st_size
+        etag = f'"{size}-{int(path.stat().st_mtime)}"'
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if match and (if_range is None or if_range == etag):
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else end, size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        cls = type(self)
+        with cls.lock:
+            cls.connections += 1
+            cls.max_connections = max(cls.max_connections, cls.connections)
+        try:
+            with open(path, mode="rb") as fobj:
+                fobj.seek(start)
+                remaining = end - start + 1
+                if self.fail_after is not None:
+                    remaining = min(remaining, self.fail_after)
+                while remaining:
+                    chunk = fobj.read(min(remaining, 256 * 1024))
+                    self.wfile.write(chunk)
+                    cls.sent += len(chunk)
+                    remaining -= len(chunk)
+        finally:
+            with cls.lock:
+                cls.connections -= 1
+        if self.fail_after is not None:
+            self.close_connection = True
+
+
+def checksum(filename):
+    with open(filename, mode="rb") as fobj:
+        return hashlib.sha256(fobj.read()).hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256, help="File size (MB)")
+    parser.add_argument("--segments", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        path = Path(path)
+        source = path / "archive.zip"
+        with open(source, mode="wb") as fobj:
+            for _ in range(args.size):
+                fobj.write(os.urandom(1024 * 1024))
+        expected = checksum(source)
+        handler = lambda *a, **kw: RangeRequestHandler(*a, directory=str(path), **kw)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/archive.zip"
+
+        for segments in (1, args.segments):
+            filename = path / f"download-{segments}.zip"
+            start = time.perf_counter()
+            status, _ = download_file(url, filename, segments=segments, min_segment_size=1)
+            elapsed = time.perf_counter() - start
+            assert status == 200 and checksum(filename) == expected
+            print(f"{segments} segment(s): {args.size / elapsed:8.1f} MB/s")
+
+        # The segments count against the host's limit (like the concurrency
+        # of its downloader slot, see `StreamingDownloadHandler`)
+        limiter = HostLimiter(max_per_host=args.segments)
+        limiter.set_limit("127.0.0.1", 2)
+        RangeRequestHandler.max_connections = 0
+        filename = path / "download-limited.zip"
+        download_file(
+            url, filename, segments=args.segments, min_segment_size=1, limiter=limiter
+        )
+        assert checksum(filename) == expected
+        assert RangeRequestHandler.max_connections <= 2, "Host limit not respected"
+        print(f"limited to 2 connections: {RangeRequestHandler.max_connections} at most")
+
+        # Connections dropped in the middle of each segment (more times than
+        # the retries) and then the download is started again
+        RangeRequestHandler.sent = 0
+        RangeRequestHandler.fail_after = source.stat().st_size // (10 * args.segments)
+        filename = path / "download-resumed.zip"
+        try:
+            download_file(url, filename, segments=args.segments, min_segment_size=1)
+        except Exception as exception:
+            print(f"interrupted: {type(exception).__name__}")
+        assert not filename.exists()
+        RangeRequestHandler.fail_after = None
+        download_file(url, filename, segments=args.segments, min_segment_size=1)
+        assert checksum(filename) == expected
+        print(f"resumed: {RangeRequestHandler.sent / source.stat().st_size:.2f}x the file size sent")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Check and benchmark `PostgreSQLPipeline` (rows per second loaded)
+
+Loads synthetic rows of 3 periods (like a complete run), then the rows of
+one of them again (like an incremental run in which its archive changed) and
+then a run which didn't finish, checking the rows in the table after each one.
+By default, a `COPY`-compatible stand-in (a DuckDB database, with the
+psycopg2 methods used by the pipeline) is used; use `--uri` to load into a
+PostgreSQL database (the table `benchmark_pagamento` is replaced).
+
+Usage: python benchmarks/postgresql.py [--rows N] [--batch-size N] [--uri URI]
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from twisted.internet import defer, task
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
+from schema import make_rows
+from transparenciagovbr.items import Row
+from transparenciagovbr.pipelines import PostgreSQLPipeline
+from transparenciagovbr.utils.fields import get_schema
+
+
+PERIODS = ("2021-01-01", "2021-01-02", "2021-01-03")
+
+
+class StandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement):
+        self.connection.execute(statement)
+
+    def fetchall(self):
+        return self.connection.fetchall()
+
+    def copy_expert(self, statement, fobj):
+        # DuckDB can't read `COPY` data from the client: it's read from a file
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".csv") as temp:
+            temp.write(fobj.read())
+            temp.flush()
+            self.connection.execute(
+                statement.replace("FROM STDIN WITH", f"FROM '{temp.name}'")
+            )
+
+
+class StandInConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.begin()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+
+    def cursor(self):
+        return StandInCursor(self.connection)
+
+
+class StandInPool:
+    """`psycopg2.pool.ThreadedConnectionPool`-like pool of DuckDB connections"""
+
+    def __init__(self, database_filename):
+        import duckdb
+
+        self.database = duckdb.connect(database_filename)
+
+    def getconn(self):
+        return StandInConnection(self.database.cursor())
+
+    def putconn(self, connection):
+        connection.connection.close()
+
+    def closeall(self):
+        pass
+
+
+class StandInPipeline(PostgreSQLPipeline):
+    def connect(self):
+        return StandInPool(self.uri)
+
+
+class BenchmarkSpider:
+    name = "benchmark_pagamento"
+
+    def __init__(self, incremental=False):
+        self.incremental = incremental
+
+
+def make_items(quantity, periods):
+    schema = get_schema("pagamento.csv")
+    header, data = make_rows("pagamento.csv", quantity)
+    return [
+        Row(schema.deserialize(dict(zip(header, values))), period=periods[index % len(periods)])
+        for index, values in enumerate(data)
+    ]
+
+
+@defer.inlineCallbacks
+def run(pipeline, spider, items, reason="finished"):
+    pipeline.open_spider(spider)
+    start = time.time()
+    for item in items:
+        result = pipeline.process_item(item, spider)
+        if isinstance(result, defer.Deferred):  # Waiting for the connections
+            yield result
+    yield pipeline.close_spider(spider)
+    yield pipeline.spider_closed(spider, reason)
+    return time.time() - start
+
+
+def query(pipeline, sql):
+    pool = pipeline.connect()
+    connection = pool.getconn()
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+                return cursor.fetchall()
+    finally:
+        pool.putconn(connection)
+        pool.closeall()
+
+
+def period_counts(pipeline):
+    return {
+        str(period): count
+        for period, count in query(
+            pipeline,
+            f'SELECT periodo_arquivo, COUNT(*) FROM "{BenchmarkSpider.name}" GROUP BY 1',
+        )
+    }
+
+
+@defer.inlineCallbacks
+def check(reactor, args, database_filename):
+    def make_pipeline():
+        if args.uri:
+            return PostgreSQLPipeline(args.uri, batch_size=args.batch_size)
+        return StandInPipeline(database_filename, batch_size=args.batch_size)
+
+    pipeline = make_pipeline()
+    query(pipeline, f'DROP TABLE IF EXISTS "{BenchmarkSpider.name}"')
+    items = make_items(args.rows, PERIODS)
+    elapsed = yield run(pipeline, BenchmarkSpider(), items)
+    print(f"complete     {len(items):10,} rows {len(items) / elapsed:10,.0f} rows/s")
+    expected = {period: len(items[index :: len(PERIODS)]) for index, period in enumerate(PERIODS)}
+    assert period_counts(pipeline) == expected, "Rows not loaded"
+
+    # The period's rows must be replaced (not duplicated)
+    items = make_items(args.rows // 10, PERIODS[1:2])
+    elapsed = yield run(make_pipeline(), BenchmarkSpider(incremental=True), items)
+    print(f"incremental  {len(items):10,} rows {len(items) / elapsed:10,.0f} rows/s")
+    expected[PERIODS[1]] = len(items)
+    assert period_counts(pipeline) == expected, "Rows of the period not replaced"
+
+    # The table must not change if the spider doesn't finish
+    yield run(make_pipeline(), BenchmarkSpider(), items, reason="shutdown")
+    assert period_counts(pipeline) == expected, "Table changed by a failed run"
+    print("Table has the expected rows after each run")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--uri")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as temp_path:
+        database_filename = str(Path(temp_path) / "benchmark.duckdb")
+        task.react(check, (args, database_filename))
+
+
+if __name__ == "__main__":
+    main()
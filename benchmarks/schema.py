@@ -0,0 +1,151 @@
+"""Benchmark `Schema` deserialization (rows per second) before and after caching/compiling
+
+Usage: python benchmarks/schema.py [--rows N] [--rows-per-archive N] [schema_filename ...]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
+from transparenciagovbr.utils.fields import (
+    EM_SIGILO_STRINGS,
+    Schema,
+    get_schema,
+    import_schema_table,
+)
+
+
+SAMPLE_VALUES = {
+    "bool": lambda: "",
+    "brazilian_date": lambda: f"{random.randint(1, 28):02d}/{random.randint(1, 12):02d}/{random.randint(2013, 2021)}",
+    "cpf": lambda: "{:03d}.{:03d}.{:03d}-{:02d}".format(*[random.randint(0, 999) for _ in range(3)], random.randint(0, 99)),
+    "custom_integer": lambda: f"{random.randint(0, 999999):06d}",
+    "custom_text": lambda: random.choice(("Não se aplica", "Não há", "Observação qualquer")),
+    "date": lambda: f"{random.randint(2013, 2021)}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+    "integer": lambda: str(random.randint(0, 999999)),
+    "money_real": lambda: f"{random.randint(0, 9999999)},{random.randint(0, 99):02d}",
+    "text": lambda: random.choice(("MINISTERIO DA SAUDE", "Fundo Nacional de Saude", "", "-")),
+}
+
+
+class LegacySchema(Schema):
+    """`Schema.deserialize` as it was before the single-pass implementation"""
+
+    def deserialize(self, row):
+        new = {
+            field_name: deserialize(row.pop(original_field_name, None))
+            for field_name, original_field_name, deserialize in self.fields
+        }
+        if row:
+            raise ValueError(f"Missing fields during deserialization: {', '.join(row.keys())}")
+        for key, value in new.items():
+            if value in EM_SIGILO_STRINGS:
+                new[key] = None
+                new["em_sigilo"] = "t"
+        return new
+
+
+def make_rows(schema_filename, quantity, sigilo_ratio=0.01, overrides=None):
+    """Return `(header, rows)` with random values for each field type
+
+    `overrides` has generators for specific fields (by `field_name`), like
+    fields which must have valid values for the spider's `convert_row`.
+    """
+
+    overrides = overrides or {}
+    header, generators, text_indexes = [], [], []
+    for row in import_schema_table(schema_filename):
+        if not row.original_name or row.field_name == "em_sigilo":
+            continue
+        if row.internal_field_type == "text" and row.field_name not in overrides:
+            text_indexes.append(len(header))
+        header.append(row.original_name)
+        generators.append(
+            overrides.get(row.field_name, SAMPLE_VALUES[row.internal_field_type])
+        )
+    data = []
+    for _ in range(quantity):
+        values = [generator() for generator in generators]
+        if text_indexes and random.random() < sigilo_ratio:
+            values[random.choice(text_indexes)] = EM_SIGILO_STRINGS[1]
+        data.append(values)
+    return header, data
+
+
+def run_legacy(schema_filename, header, data, rows_per_archive):
+    # Before: a new schema for each response and one dict per row
+    schema = None
+    for counter, values in enumerate(data):
+        if counter % rows_per_archive == 0:
+            import_schema_table.cache_clear()
+            schema = LegacySchema(schema_filename)
+        schema.deserialize(dict(zip(header, values)))
+
+
+def run_compiled(schema_filename, header, data, rows_per_archive):
+    # After: cached schema, compiled once per CSV (header) and positional rows
+    deserialize = None
+    for counter, values in enumerate(data):
+        if counter % rows_per_archive == 0:
+            deserialize = get_schema(schema_filename).compile(header)
+        deserialize(values)
+
+
+def outcome(deserialize, row):
+    """Return the deserialized row (or the exception's class, if it fails)"""
+
+    try:
+        return deserialize(row)
+    except Exception as exception:
+        return type(exception)
+
+
+def check(schema_filename, header, data):
+    legacy = LegacySchema(schema_filename)
+    schema = get_schema(schema_filename)
+    deserialize = schema.compile(header)
+    for values in data:
+        expected = legacy.deserialize(dict(zip(header, values)))
+        result = deserialize(values)
+        assert result == expected, f"{result} != {expected}"
+        assert list(result.keys()) == list(expected.keys())
+        assert schema.deserialize(dict(zip(header, values))) == expected
+
+    # Sigilo strings are detected after the conversion: in fields which are
+    # not text, they fail it (as before)
+    types = {row.original_name: row.internal_field_type for row in import_schema_table(schema_filename)}
+    for index, original_name in enumerate(header):
+        if types[original_name] in ("text", "custom_text"):
+            continue
+        values = list(data[0])
+        values[index] = EM_SIGILO_STRINGS[0]
+        expected = outcome(legacy.deserialize, dict(zip(header, values)))
+        assert outcome(deserialize, values) == expected, f"{original_name}: not {expected}"
+        assert outcome(schema.deserialize, dict(zip(header, values))) == expected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--rows-per-archive", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("schema_filenames", nargs="*", default=["pagamento.csv", "despesa_item_empenho.csv"])
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for schema_filename in args.schema_filenames:
+        header, data = make_rows(schema_filename, args.rows)
+        check(schema_filename, header, data[:1000])
+        results = {}
+        for name, function in (("before", run_legacy), ("after", run_compiled)):
+            start = time.perf_counter()
+            function(schema_filename, header, data, args.rows_per_archive)
+            results[name] = args.rows / (time.perf_counter() - start)
+            print(f"{schema_filename:30} {name:6} {results[name]:12,.0f} rows/s")
+        print(f"{schema_filename:30} speedup {results['after'] / results['before']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""Benchmark the whole conversion (parsing, deserialization and export) of each spider
+
+Synthetic archives are generated in each spider's format (inner CSVs named
+like the Portal's, ISO-8859-1, `;`-delimited - tab-delimited for
+`pagamento_historico` - with the columns from `schema/*.csv`, Brazilian money
+and dates, sigilo strings and NUL bytes) and converted by the spider's
+`parse_zip_file` and exported by the exporter of `--format`, each spider in
+a new process (so the peak RSS is the spider's). Reports rows/s, MB/s (of
+uncompressed CSV) and peak RSS and, from a second (instrumented) run, the
+share of time in each stage (see `transparenciagovbr.utils.metrics`). NUL
+bytes are added to text values of `--nul-ratio` of the rows (before Python
+3.11, `csv` doesn't accept them, so spiders which don't remove them fail).
+
+With `--save BASELINE.json` the results are saved; with `--compare
+BASELINE.json` they're compared to a saved baseline and the exit status is 1
+if the rows/s of any spider dropped (or its peak RSS grew) more than
+`--tolerance` (so it can be used to gate regressions). Archives are kept in
+`--fixtures-path` (if given) and reused while their parameters don't change.
+
+Usage: python benchmarks/spiders.py [--rows N] [--archives N] [--format FORMAT] [--nul-ratio R] [--save FILENAME | --compare FILENAME] [spider ...]
+"""
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
+from description import make_description
+from schema import make_rows
+from scrapy import spiderloader
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import get_project_settings
+from transparenciagovbr.utils.fields import import_schema_table
+from transparenciagovbr.utils.metrics import STAGES, Metrics
+
+
+def load_spider(spider_name):
+    settings = get_project_settings()
+    spider_loader = spiderloader.SpiderLoader.from_settings(settings)
+    return spider_loader.load(spider_name)()
+
+
+def table_spiders(spider):
+    """Return `{table: spider}` for the CSVs inside the spider's archives"""
+
+    return getattr(spider, "table_spiders", None) or {None: spider}
+
+
+def field_overrides(spider):
+    # Codes read as text but exported as integers
+    overrides = {
+        row.field_name: lambda: str(random.randint(0, 999999))
+        for row in import_schema_table(spider.schema_filename)
+        if row.internal_field_type == "text" and row.field_type == "integer"
+    }
+    # Values `convert_row` depends on
+    if spider.name == "auxilio_emergencial":
+        from transparenciagovbr.utils.cities import city_name_by_id
+
+        codes = list(city_name_by_id.keys())
+        overrides["codigo_ibge_municipio"] = lambda: str(random.choice(codes))
+    elif spider.name == "despesa_item_empenho":
+        overrides["descricao"] = make_description
+        overrides["elemento_despesa"] = lambda: random.choice(
+            ("MATERIAL DE CONSUMO", "MATERIAL DE CONSUMO", "OUTROS SERVICOS")
+        )
+    return overrides
+
+
+def make_archive(spider, filename, quantity, sigilo_ratio, nul_ratio):
+    """Write a ZIP in the spider's format (one CSV per table)"""
+
+    with zipfile.ZipFile(filename, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for table_spider in table_spiders(spider).values():
+            header, data = make_rows(
+                table_spider.schema_filename,
+                quantity,
+                sigilo_ratio=sigilo_ratio,
+                overrides=field_overrides(table_spider),
+            )
+            text_fields = {
+                row.original_name
+                for row in import_schema_table(table_spider.schema_filename)
+                if row.internal_field_type == "text"
+            }
+            text_indexes = [
+                index for index, field_name in enumerate(header) if field_name in text_fields
+            ]
+            for values in data:
+                if random.random() < nul_ratio:  # Padding, like in some Portal's files
+                    index = random.choice(text_indexes)
+                    values[index] = values[index] + "\x00" * random.randint(1, 4)
+            fobj = io.StringIO()
+            if table_spider.name == "pagamento_historico":
+                inner_filename = "201101_GastosDiretos.txt"
+                writer = csv.writer(fobj, delimiter="\t", quoting=csv.QUOTE_NONE)
+            else:
+                inner_filename = f"20210101{table_spider.filename_suffix}"
+                writer = csv.writer(fobj, delimiter=";", quoting=csv.QUOTE_ALL)
+            writer.writerow(header)
+            writer.writerows(data)
+            zf.writestr(inner_filename, fobj.getvalue().encode(table_spider.encoding))
+
+
+def make_fixtures(spider_name, path, archives, quantity, sigilo_ratio, nul_ratio, seed):
+    """Return the filenames of the spider's archives (generating them if needed)"""
+
+    spider = load_spider(spider_name)
+    path = Path(path) / spider_name
+    parameters = {
+        "rows": quantity,
+        "sigilo_ratio": sigilo_ratio,
+        "nul_ratio": nul_ratio,
+        "seed": seed,
+    }
+    parameters_filename = path / "parameters.json"
+    filenames = [path / f"{number:04d}.zip" for number in range(archives)]
+    if (
+        parameters_filename.exists()
+        and json.loads(parameters_filename.read_text()) == parameters
+        and all(filename.exists() for filename in filenames)
+    ):
+        return filenames
+    path.mkdir(parents=True, exist_ok=True)
+    random.seed(seed)
+    for filename in filenames:
+        make_archive(spider, filename, quantity, sigilo_ratio, nul_ratio)
+    parameters_filename.write_text(json.dumps(parameters))
+    return filenames
+
+
+def convert(spider, filenames, output_path, feed_format, metrics=None):
+    """Convert and export the archives, returning the number of rows"""
+
+    exporters_classes = get_project_settings().getwithbase("FEED_EXPORTERS")
+    exporter_class = load_object(exporters_classes[feed_format])
+    exporters, rows = {}, 0
+    for filename in filenames:
+        for row in spider.parse_zip_file(str(filename), metrics=metrics):
+            table = getattr(row, "table", None)
+            exporter = exporters.get(table)
+            if exporter is None:
+                kwargs = {"metrics": metrics}
+                if feed_format == "parquet":
+                    kwargs["schema_filename"] = table_spiders(spider)[table].schema_filename
+                output_filename = Path(output_path) / f"{table or spider.name}.{feed_format}"
+                exporter = exporter_class(open(output_filename, mode="wb"), **kwargs)
+                exporter.start_exporting()
+                exporters[table] = exporter
+            exporter.export_item(row)
+            rows += 1
+    for exporter in exporters.values():
+        exporter.finish_exporting()
+    return rows
+
+
+def run(spider_name, filenames, feed_format, repeat, stages):
+    """Benchmark one spider (called in a new process)"""
+
+    spider = load_spider(spider_name)
+    with tempfile.TemporaryDirectory() as output_path:
+        elapsed = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = convert(spider, filenames, output_path, feed_format)
+            elapsed = min(elapsed or float("inf"), time.perf_counter() - start)
+        result = {"rows": rows, "seconds": elapsed}
+        if stages:
+            metrics = Metrics()
+            convert(spider, filenames, output_path, feed_format, metrics=metrics)
+            result["stages"] = metrics.seconds
+    # `ru_maxrss` is in KiB on Linux (bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print the differences to the baseline and return the regressions"""
+
+    regressions = []
+    for spider_name, result in results.items():
+        expected = baseline["results"].get(spider_name)
+        if expected is None:
+            print(f"{spider_name:25} not in the baseline")
+            continue
+        speed = result["rows_per_second"] / expected["rows_per_second"] - 1
+        memory = result["peak_rss_mb"] / expected["peak_rss_mb"] - 1
+        failed = []
+        if speed < -tolerance:
+            failed.append("rows/s")
+        if memory > tolerance:
+            failed.append("peak RSS")
+        print(
+            f"{spider_name:25} rows/s {speed:+7.1%}  peak RSS {memory:+7.1%}"
+            + (f"  REGRESSION ({', '.join(failed)})" if failed else "")
+        )
+        if failed:
+            regressions.append(spider_name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20_000, help="Rows per CSV")
+    parser.add_argument("--archives", type=int, default=2, help="Archives per spider")
+    parser.add_argument("--format", default="csv.gz", help="Feed format (FEED_EXPORTERS)")
+    parser.add_argument("--sigilo-ratio", type=float, default=0.01)
+    parser.add_argument("--nul-ratio", type=float, default=0.001)
+    parser.add_argument("--repeat", type=int, default=1, help="Use the fastest of N runs")
+    parser.add_argument("--no-stages", action="store_true", help="Skip the instrumented run")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fixtures-path", help="Keep the archives in this path")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--save", metavar="FILENAME", help="Save the results as a baseline")
+    group.add_argument("--compare", metavar="FILENAME", help="Compare to a saved baseline")
+    parser.add_argument("spider_names", nargs="*")
+    args = parser.parse_args()
+
+    settings = get_project_settings()
+    spider_names = args.spider_names or spiderloader.SpiderLoader.from_settings(settings).list()
+    parameters = {
+        "rows": args.rows,
+        "archives": args.archives,
+        "format": args.format,
+        "sigilo_ratio": args.sigilo_ratio,
+        "nul_ratio": args.nul_ratio,
+    }
+    baseline = None
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if baseline["parameters"] != parameters:
+            print(f"WARNING: baseline parameters are different: {baseline['parameters']}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_path:
+        fixtures_path = args.fixtures_path or temp_path
+        # A new process for each spider (`spawn`, so the peak RSS doesn't
+        # include the parent's memory)
+        context = multiprocessing.get_context("spawn")
+        for spider_name in spider_names:
+            filenames = make_fixtures(
+                spider_name,
+                fixtures_path,
+                args.archives,
+                args.rows,
+                args.sigilo_ratio,
+                args.nul_ratio,
+                args.seed,
+            )
+            size = 0
+            for filename in filenames:
+                with zipfile.ZipFile(filename) as zf:
+                    size += sum(info.file_size for info in zf.infolist())
+            with context.Pool(processes=1) as pool:
+                try:
+                    result = pool.apply(
+                        run,
+                        (spider_name, filenames, args.format, args.repeat, not args.no_stages),
+                    )
+                except Exception as exception:
+                    print(f"{spider_name:25} ERROR: {type(exception).__name__}: {exception}")
+                    results[spider_name] = None
+                    continue
+            result = {
+                "rows": result["rows"],
+                "rows_per_second": result["rows"] / result["seconds"],
+                "mb_per_second": size / result["seconds"] / 1024 / 1024,
+                "peak_rss_mb": result["peak_rss_mb"],
+                "stages": result.get("stages"),
+            }
+            results[spider_name] = result
+            line = (
+                f"{spider_name:25} {result['rows']:9,} rows {result['rows_per_second']:10,.0f} rows/s "
+                f"{result['mb_per_second']:7.2f} MB/s {result['peak_rss_mb']:8.1f} MB peak RSS"
+            )
+            if result["stages"]:
+                total = sum(result["stages"][stage] for stage in STAGES if stage != "compress")
+                line += "  " + " ".join(
+                    f"{stage} {seconds / total:.0%}"
+                    for stage, seconds in result["stages"].items()
+                    if stage != "download"
+                )
+            print(line)
+
+    failed = [spider_name for spider_name, result in results.items() if result is None]
+    results = {spider_name: result for spider_name, result in results.items() if result}
+    if args.save:
+        data = {"parameters": parameters, "python": platform.python_version(), "results": results}
+        Path(args.save).write_text(json.dumps(data, indent=2, sort_keys=True))
+    if baseline is not None:
+        failed.extend(compare(results, baseline, args.tolerance))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,19 +5,37 @@ set -e
 SCHEMA_PATH="schema"
 OUTPUT_PATH="data/output"
 
-function import_table() {
+function import_file() {
 	tablename="$1"
+	filename="$2"
 
-	echo "DROP TABLE IF EXISTS ${tablename};" | psql "$POSTGRESQL_URI"
 	time rows pgimport \
 		--schema="$SCHEMA_PATH/${tablename}.csv" \
 		--input-encoding="utf-8" \
 		--dialect="excel" \
-		"$OUTPUT_PATH/${tablename}.csv.gz" \
+		"$filename" \
 		"$POSTGRESQL_URI" \
 		"$tablename"
 }
 
+function import_table() {
+	tablename="$1"
+
+	echo "DROP TABLE IF EXISTS ${tablename};" | psql "$POSTGRESQL_URI"
+	if [ -e "$OUTPUT_PATH/${tablename}/_index.json" ]; then
+		# Partitioned output (`./run.sh --partitioned`): only the partitions
+		# from START to END (`YYYY-MM`, optional) are imported
+		partition_opts=""
+		if [ ! -z "$START" ]; then partition_opts="$partition_opts --start=$START"; fi
+		if [ ! -z "$END" ]; then partition_opts="$partition_opts --end=$END"; fi
+		for filename in $(python -m transparenciagovbr.utils.partition $partition_opts "$OUTPUT_PATH/${tablename}"); do
+			import_file "$tablename" "$filename"
+		done
+	else
+		import_file "$tablename" "$OUTPUT_PATH/${tablename}.csv.gz"
+	fi
+}
+
 if [ -z "$POSTGRESQL_URI" ]; then
 	echo "ERROR: you must set POSTGRESQL_URI environment variable."
 	exit 1
@@ -0,0 +1,133 @@
+"""Memoization with a limit of memory (in bytes) and statistics
+
+`cached(name, max_bytes)` replaces `functools.lru_cache` for the conversion
+functions: the least recently used entries are evicted when the (estimated)
+size of the keys and values passes `max_bytes` and the hits, misses and
+evictions are counted, so the sizes can be tuned from the report printed at
+the end of the run.
+"""
+import sys
+from collections import OrderedDict
+
+
+STATS = ("hits", "misses", "evictions")
+MISSING = object()
+caches = {}
+
+
+def sizeof(obj, getsizeof=sys.getsizeof):
+    """Estimated size of `obj` (a tuple's items included) in a `Cache`
+
+    Each one adds 50 bytes, about half of the overhead of an entry (the
+    `OrderedDict` node and hash table slot).
+    """
+
+    if type(obj) is tuple:
+        return getsizeof(obj) + sum(getsizeof(item) for item in obj) + 50
+    return getsizeof(obj) + 50
+
+
+class Cache:
+    """Memoize `function` (with hashable positional arguments) using up to `max_bytes`"""
+
+    def __init__(self, function, name, max_bytes):
+        self.function = function
+        self.name = name
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.__doc__ = function.__doc__
+        self.__wrapped__ = function
+
+    def __call__(self, *args):
+        data = self.data
+        value = data.get(args, MISSING)
+        if value is not MISSING:
+            data.move_to_end(args)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = data[args] = self.function(*args)
+        self.bytes += sizeof(args) + sizeof(value)
+        if self.bytes > self.max_bytes:
+            while self.bytes > self.max_bytes and data:
+                old_args, old_value = data.popitem(last=False)
+                self.bytes -= sizeof(old_args) + sizeof(old_value)
+                self.evictions += 1
+        return value
+
+    @property
+    def stats(self):
+        return {stat: getattr(self, stat) for stat in STATS}
+
+    def clear(self):
+        self.data.clear()
+        self.bytes = 0
+
+
+def cached(name, max_bytes):
+    """Decorator creating a `Cache` (registered in `caches` as `name`)"""
+
+    def decorator(function):
+        cache = Cache(function, name, max_bytes)
+        caches[name] = cache
+        return cache
+
+    return decorator
+
+
+def configure(max_bytes):
+    """Set the limits of the caches (`{name: bytes}`)"""
+
+    for name, value in max_bytes.items():
+        caches[name].max_bytes = value
+
+
+def snapshot():
+    """Return `{name: {stat: value}}`, including the current size in bytes"""
+
+    return {
+        name: {**cache.stats, "entries": len(cache.data), "bytes": cache.bytes}
+        for name, cache in caches.items()
+    }
+
+
+def difference(before, after):
+    """Return the stats between two `snapshot`s (with the size of `after`)"""
+
+    return {
+        name: {
+            **values,
+            **{stat: values[stat] - before.get(name, {}).get(stat, 0) for stat in STATS},
+        }
+        for name, values in after.items()
+    }
+
+
+def merge(total, stats):
+    """Add `stats` (from a worker) to `total`, keeping the largest size"""
+
+    for name, values in stats.items():
+        current = total.setdefault(name, {key: 0 for key in values})
+        for key, value in values.items():
+            if key in STATS:
+                current[key] += value
+            else:
+                current[key] = max(current[key], value)
+    return total
+
+
+def report(stats):
+    """Return the statistics (like `snapshot`'s) as text, one line per cache"""
+
+    lines = []
+    for name, values in stats.items():
+        calls = values["hits"] + values["misses"]
+        hit_rate = values["hits"] / calls if calls else 0.0
+        lines.append(
+            f"{name}: {calls} calls, {hit_rate:.1%} hits, {values['evictions']} evictions, "
+            f"{values['entries']} entries ({values['bytes'] / 1024 / 1024:.1f} MiB)"
+        )
+    return "\n".join(lines)
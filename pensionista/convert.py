@@ -1,24 +1,53 @@
+"""Convert the pensionista archives to one compressed CSV per table and month
+
+Each archive (one per month, with one inner ZIP per origin system, each one
+with the `cadastro`, `remuneracao` and `observacao` CSVs) is read only once,
+converting all the tables, and the archives are converted in parallel (one
+worker process per archive). The parts are written to
+`data/output/pensionista_<table>/<year>-<month>.csv.gz`.
+
+The functions called for each value are memoized (see `cache.py`) with a
+limit of memory per worker for each cache (`--cache-size NAME=MiB`); their
+statistics are printed at the end. With `--person-index FILENAME` the
+persons' UUIDs are looked up (for each chunk of rows at once) in a SQLite
+index shared between runs and converters (see
+`transparenciagovbr.utils.person`) instead of being created for each person.
+
+Usage: python convert.py [--workers N] [--cache-size NAME=MiB ...] [--person-index FILENAME] [cadastro|observacao|remuneracao ...]
+"""
+import argparse
 import csv
 import datetime
 import io
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import lru_cache
 from pathlib import Path
-from uuid import NAMESPACE_URL, uuid5
 from zipfile import ZipFile
 
 from rows.fields import slug
 from rows.utils import CsvLazyDictWriter, open_compressed
 from tqdm import tqdm
 
+import cache
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
+from transparenciagovbr.utils import person
+
 
 strptime = datetime.datetime.strptime
+MiB = 1024 * 1024
+
 
-@lru_cache(maxsize=1024 ** 2)
 def convert_number(value):
     return value.replace(".", "").replace(",", ".")
 
 
-@lru_cache(maxsize=32 * 1024)
+@cache.cached("convert_date", max_bytes=4 * MiB)
 def convert_date(value):
     value = value.strip()
     if not value:
@@ -26,15 +55,15 @@ def convert_date(value):
     return str(strptime(value, "%d/%m/%Y").date())
 
 
-@lru_cache(maxsize=1024 * 1024)
+@cache.cached("person_uuid", max_bytes=256 * MiB)
 def person_uuid(cpf, name):
-    """Create UUID based on URLid methodology"""
+    return person.person_uuid(cpf, name)
+
 
-    if cpf is None:
-        cpf = "***********"
-    assert len(cpf) == 11, f"Invalid CPF: {repr(cpf)}"
-    internal_id = cpf[3:9] + "-" + slug(name).upper().replace("_", "-")
-    return str(uuid5(NAMESPACE_URL, f"https://id.brasil.io/person/v1/{internal_id}/"))
+def person_uuids(pairs):
+    """Return `{(cpf, name): uuid}` (like `PersonIndex.uuids`, but memoized)"""
+
+    return {pair: person_uuid(*pair) for pair in set(pairs)}
 
 
 @lru_cache(maxsize=128)
@@ -68,8 +97,25 @@ def convert_row(row):
     return new
 
 
-def read_csv(fobj, table_name, year, month, input_encoding="iso-8859-1", delimiter=";"):
-    """Read binary `fobj` as CSV, convert each row, adding `table_name` as a column"""
+# `(cpf, name, uuid)` fields of the persons in each table
+PERSON_FIELDS = {
+    "cadastro": [
+        ("cpf", "nome", "pessoa_uuid"),
+        ("cpf_representante_legal", "nome_representante_legal", "representante_legal_uuid"),
+        ("cpf_instituidor", "nome_instituidor", "instituidor_uuid"),
+    ],
+    "remuneracao": [("cpf", "nome", "pessoa_uuid")],
+    "observacao": [("cpf", "nome", "pessoa_uuid")],
+}
+
+
+def read_csv(
+    fobj, origin_system, year, month, table_name, input_encoding="iso-8859-1", delimiter=";"
+):
+    """Read binary `fobj` as CSV, convert each row, adding `origin_system` as a column
+
+    The persons' UUID fields are created empty (see `person.add_uuids`).
+    """
 
     fobj = io.TextIOWrapper(fobj, encoding=input_encoding)
     reader = csv.DictReader(fobj, delimiter=delimiter)
@@ -87,12 +133,11 @@ def read_csv(fobj, table_name, year, month, input_encoding="iso-8859-1", delimit
         else:
             new["menor_16"] = False
             new["cpf"] = new["cpf"].replace(".", "").replace("-", "")
-        new["sistema_origem"] = table_name
-        new["pessoa_uuid"] = person_uuid(new["cpf"], new["nome"])
-        if table_name == "cadastro":
-            for key in ("representante_legal", "instituidor"):
-                new[f"cpf_{key}"] = new[f"cpf_{key}"].replace(".", "").replace("-", "")
-                new[f"{key}_uuid"] = person_uuid(new[f"cpf_{key}"], new[f"nome_{key}"])
+        new["sistema_origem"] = origin_system
+        for cpf_field, _, uuid_field in PERSON_FIELDS[table_name]:
+            if cpf_field != "cpf" and new[cpf_field] is not None:
+                new[cpf_field] = new[cpf_field].replace(".", "").replace("-", "")
+            new[uuid_field] = None
         yield new
 
 
@@ -107,47 +152,134 @@ def extract_origin_system(filename):
     return filename.split(".zip")[0].split("_")[-1]
 
 
-if __name__ == "__main__":
-    import argparse
+def extract_table_name(filename):
+    return filename.split(".")[0].split("_")[-1].lower().replace("observacoes", "observacao")
+
+
+def convert_archive(filename, output_path, table_names, person_index=None):
+    """Convert the tables of one archive, writing one part per table (in a worker)
 
+    The persons' UUIDs are looked up in `person_index` (if given). Return the
+    number of rows written for each table and the caches' stats.
+    """
+
+    year, month = extract_year_month(filename)
+    writers, counter = {}, Counter()
+    cache_stats = cache.snapshot()
+    try:
+        with ZipFile(filename) as zf:
+            for fileinfo in zf.filelist:
+                origin_system = extract_origin_system(fileinfo.filename)
+                # The inner ZIP is copied to a temporary file, since `ZipFile`
+                # seeks around the file (and seeking backwards on `zf.open`
+                # decompresses it again from the start)
+                with tempfile.TemporaryFile() as temp:
+                    with zf.open(fileinfo.filename) as fobj:
+                        shutil.copyfileobj(fobj, temp, length=8 * 1024 * 1024)
+                    inner_zf = ZipFile(temp)
+                    for inner_fileinfo in inner_zf.filelist:
+                        table_name = extract_table_name(inner_fileinfo.filename)
+                        if table_name not in table_names:
+                            continue
+                        if table_name not in writers:
+                            # Written with a temporary name, renamed when finished
+                            path = output_path / f"pensionista_{table_name}"
+                            temp_filename = path / f".{year}-{month:02d}.csv.gz"
+                            output = open_compressed(
+                                temp_filename, mode="w", buffering=8 * 1024 * 1024
+                            )
+                            writer = CsvLazyDictWriter(output)
+                            writers[table_name] = (temp_filename, output, writer)
+                        writer = writers[table_name][2]
+                        with inner_zf.open(inner_fileinfo.filename) as fobj:
+                            rows = person.add_uuids(
+                                read_csv(fobj, origin_system, year, month, table_name),
+                                PERSON_FIELDS[table_name],
+                                person_index.uuids if person_index else person_uuids,
+                            )
+                            for row in rows:
+                                writer.writerow(row)
+                                counter[table_name] += 1
+    except BaseException:
+        for temp_filename, output, _ in writers.values():
+            output.close()
+            temp_filename.unlink()
+        raise
+    for temp_filename, output, _ in writers.values():
+        output.close()
+        temp_filename.rename(temp_filename.parent / temp_filename.name[1:])
+    return counter, cache.difference(cache_stats, cache.snapshot())
+
+
+person_index = None
+
+
+def init_worker(cache_sizes, person_index_filename):
+    global person_index
+
+    cache.configure(cache_sizes)
+    if person_index_filename:
+        person_index = person.PersonIndex(person_index_filename)
+
+
+def convert_archive_in_worker(filename, output_path, table_names):
+    return convert_archive(filename, output_path, table_names, person_index=person_index)
+
+
+def parse_cache_size(value):
+    name, size = value.split("=")
+    if name not in cache.caches:
+        raise argparse.ArgumentTypeError(f"unknown cache: {name}")
+    return name, int(float(size) * MiB)
+
+
+if __name__ == "__main__":
+    table_names = ("cadastro", "remuneracao", "observacao")
     parser = argparse.ArgumentParser()
-    parser.add_argument("table_name", choices=("cadastro", "remuneracao", "observacao"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--cache-size",
+        type=parse_cache_size,
+        action="append",
+        default=[],
+        help=f"Memory limit of a cache, per worker ({', '.join(cache.caches)})",
+    )
+    parser.add_argument("--person-index", help="SQLite database with the persons' UUIDs")
+    parser.add_argument("table_names", nargs="*", help=f"Default: {' '.join(table_names)}")
     args = parser.parse_args()
+    args.table_names = args.table_names or table_names
+    for table_name in args.table_names:
+        if table_name not in table_names:
+            parser.error(f"invalid table name: {table_name}")
 
     # Make sure all working paths exist before anything
     DATA_PATH = Path(__file__).parent / "data"
     DOWNLOAD_PATH = DATA_PATH / "download"
     OUTPUT_PATH = DATA_PATH / "output"
-    for path in (DATA_PATH, DOWNLOAD_PATH, OUTPUT_PATH):
+    for path in [DATA_PATH, DOWNLOAD_PATH, OUTPUT_PATH] + [
+        OUTPUT_PATH / f"pensionista_{table_name}" for table_name in args.table_names
+    ]:
         if not path.exists():
             path.mkdir(parents=True)
 
-    # Create one compressed-CSV writer
-    filename = OUTPUT_PATH / f"pensionista_{args.table_name}.csv.gz"
-    fobj = open_compressed(filename, mode="w", buffering=8 * 1024 * 1024)
-    writer = CsvLazyDictWriter(fobj)
-
-    # Read each ZIP file, then each inner ZIP file, then filter desired
-    # inner-inner CSV file, convert it and write to the output CSV.
-    progress_bar = tqdm()
-    filenames = DOWNLOAD_PATH.glob("*.zip")
-    for filename in sorted(filenames, key=extract_year_month):
-        year, month = extract_year_month(filename)
-        progress_bar.desc = f"{year}-{month:02d}"
-        progress_bar.refresh()
-        zf = ZipFile(filename)
-        for fileinfo in zf.filelist:
-            origin_system = extract_origin_system(fileinfo.filename)
-            progress_bar.desc = f"{year}-{month:02d}/{origin_system}"
-            inner_zf = ZipFile(zf.open(fileinfo.filename))
-            for inner_fileinfo in inner_zf.filelist:
-                table_name = inner_fileinfo.filename.split(".")[0].split("_")[-1].lower().replace("observacoes", "observacao")
-                if table_name != args.table_name:  # We don't want this file
-                    continue
-                progress_bar.desc = f"{year}-{month:02d}/{origin_system}.{table_name}"
-                fobj = inner_zf.open(inner_fileinfo.filename)
-                reader = read_csv(fobj, origin_system, year, month)
-                for row in reader:
-                    writer.writerow(row)
-                    progress_bar.update()
-    progress_bar.close()
+    # Each archive is converted by a worker (all the desired tables at once)
+    filenames = sorted(DOWNLOAD_PATH.glob("*.zip"), key=extract_year_month)
+    total, cache_stats = Counter(), {}
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=init_worker,
+        initargs=(dict(args.cache_size), args.person_index),
+    ) as executor:
+        futures = [
+            executor.submit(
+                convert_archive_in_worker, filename, OUTPUT_PATH, set(args.table_names)
+            )
+            for filename in filenames
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            counter, stats = future.result()
+            total.update(counter)
+            cache.merge(cache_stats, stats)
+    for table_name in args.table_names:
+        print(f"pensionista_{table_name}: {total[table_name]} rows")
+    print(cache.report(cache_stats))
@@ -6,11 +6,13 @@ if [ -z "$DATABASE_URL" ]; then
 fi
 
 for table in cadastro observacao remuneracao; do
-	rows pgimport \
-		--dialect=excel \
-		--input-encoding=utf-8 \
-		--schema=schema/pensionista_${table}.csv \
-		data/output/pensionista_${table}.csv.gz \
-		$DATABASE_URL \
-		pensionista_${table}
+	for filename in data/output/pensionista_${table}/*.csv.gz; do
+		rows pgimport \
+			--dialect=excel \
+			--input-encoding=utf-8 \
+			--schema=schema/pensionista_${table}.csv \
+			$filename \
+			$DATABASE_URL \
+			pensionista_${table}
+	done
 done
@@ -4,28 +4,84 @@ set -e
 OUTPUT_PATH=data/output
 LOG_PATH=data/log
 LOG_LEVEL=INFO
-if [ "$1" = "--use-mirror" ]; then
-	OPTS="-a use_mirror=true"
+FORMAT="csv.gz"
+INCREMENTAL=false
+PARTITIONED=false
+QUEUE=""
+WORKERS=$(nproc)
+OPTS=""
+QUEUE_OPTS=""
+while [[ "$1" == --* ]]; do
+	case "$1" in
+		--format=*) FORMAT="${1#--format=}" ;;
+		--use-mirror) OPTS="$OPTS -a use_mirror=true"; QUEUE_OPTS="$QUEUE_OPTS --use-mirror" ;;
+		--stream-download) OPTS="$OPTS -a stream_download=true" ;;
+		--revalidate) OPTS="$OPTS -a revalidate=true" ;;
+		--partitioned) PARTITIONED=true ;;
+		--index-fields=*) OPTS="$OPTS -a index_fields=${1#--index-fields=}" ;;
+		--metrics) OPTS="$OPTS -s METRICS_ENABLED=true" ;;
+		--postgresql) OPTS="$OPTS -s POSTGRESQL_PIPELINE_ENABLED=true" ;;
+		--metrics-port=*) OPTS="$OPTS -s METRICS_ENABLED=true -s METRICS_PROMETHEUS_PORT=${1#--metrics-port=}" ;;
+		--queue=*) QUEUE="${1#--queue=}" ;;
+		--workers=*) WORKERS="${1#--workers=}" ;;
+		--incremental) INCREMENTAL=true; OPTS="$OPTS -a incremental=true -s FEED_STORE_EMPTY=False" ;;
+		*) echo "ERROR: unknown option $1"; exit 1 ;;
+	esac
 	shift
-else
-	OPTS=""
-fi
+done
+
+remove_outputs() {
+	# The complete output (and its block index), the incremental partitions and
+	# the partitioned output of a table
+	rm -rf "$OUTPUT_PATH/$1" "$OUTPUT_PATH/$1".*
+}
 
 run_spider() {
 	spider="$1"
 
 	mkdir -p $LOG_PATH $OUTPUT_PATH
 	log_filename="$LOG_PATH/${spider}.log"
-	output_filename="$OUTPUT_PATH/${spider}.csv.gz"
-	rm -rf $log_filename $output_filename
+	rm -rf $log_filename
+	if ! $INCREMENTAL; then
+		# The whole output is regenerated (and the manifest is cleared)
+		if [ "$spider" = "despesas" ]; then
+			for table in $(python transparenciagovbr/utils/print_spider_names.py despesas); do
+				remove_outputs $table
+			done
+		else
+			remove_outputs $spider
+		fi
+	fi
+	if [ "$spider" = "despesas" ]; then
+		# One output per table, defined by the spider (`OUTPUT_PATH/<table>...`)
+		output_opts="-s FEED_FORMAT=$FORMAT"
+		if $PARTITIONED; then
+			output_opts="-s FEED_FORMAT=partitioned -s PARTITION_FORMAT=$FORMAT"
+		elif $INCREMENTAL; then
+			output_opts="$output_opts -s OUTPUT_PARTITION=$(date +%Y%m%d%H%M%S)"
+		fi
+		output_filename="$OUTPUT_PATH (one output per table)"
+	elif $PARTITIONED; then
+		# Partitions by year/month (`ano=YYYY/mes=MM/part-*`), listed in the index
+		mkdir -p "$OUTPUT_PATH/${spider}"
+		output_filename="$OUTPUT_PATH/${spider}/_index.json"
+		output_opts="-s PARTITION_FORMAT=$FORMAT -t partitioned -o $output_filename"
+	elif $INCREMENTAL; then
+		# New/changed periods are written to a new partition
+		mkdir -p "$OUTPUT_PATH/${spider}"
+		output_filename="$OUTPUT_PATH/${spider}/$(date +%Y%m%d%H%M%S).${FORMAT}"
+		output_opts="-t $FORMAT -o $output_filename"
+	else
+		output_filename="$OUTPUT_PATH/${spider}.${FORMAT}"
+		output_opts="-t $FORMAT -o $output_filename"
+	fi
 	echo "Running ${spider} - check $log_filename for logs and $output_filename for output"
 	time scrapy crawl \
 		--loglevel=$LOG_LEVEL \
 		--logfile=$log_filename \
 		$OPTS \
 		$spider \
-		-t "csv.gz" \
-		-o $output_filename
+		$output_opts
 }
 
 if [ ! -z "$1" ]; then
@@ -33,6 +89,22 @@ if [ ! -z "$1" ]; then
 else
 	spiders="$(python transparenciagovbr/utils/print_spider_names.py)"
 fi
+if [ ! -z "$QUEUE" ]; then
+	# Distributed mode: the units (spider and period) are put in the queue and
+	# converted by the workers (these and the ones started on other nodes with
+	# `python -m transparenciagovbr.workqueue --queue=$QUEUE work`)
+	if [ "$FORMAT" != "csv.gz" ]; then
+		echo "ERROR: the queue workers only write csv.gz"
+		exit 1
+	fi
+	enqueue_opts=""
+	if $INCREMENTAL; then
+		enqueue_opts="--incremental"
+	fi
+	python -m transparenciagovbr.workqueue --queue=$QUEUE enqueue $enqueue_opts $spiders
+	time python -m transparenciagovbr.workqueue --queue=$QUEUE work --processes=$WORKERS $QUEUE_OPTS
+	exit
+fi
 for spider in $spiders; do
 	run_spider $spider
 done
@@ -9,18 +9,27 @@ from tqdm import tqdm
 sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))  # noqa
 from transparenciagovbr.utils.cities import city_name_by_id
 from transparenciagovbr.utils.fields import Schema
-from transparenciagovbr.utils.io import parse_zip
+from transparenciagovbr.utils.io import parse_zip_csvs
+from transparenciagovbr.utils.person import PersonIndex, add_uuids
+
+PERSON_FIELDS = [
+    ("cpf_beneficiario", "beneficiario", "beneficiario_uuid"),
+    ("cpf_responsavel", "responsavel", "responsavel_uuid"),
+]
 
 
 def extract_rows(schema, filename):
-    data = parse_zip(
+    csvs = parse_zip_csvs(
         filename_or_fobj=filename,
         inner_filename_suffix="_AuxilioEmergencial.csv",
         encoding="iso-8859-1",
     )
-    for row in data:
-        new = schema.deserialize(row)
-        if new is not None:
+    for header, reader in csvs:
+        deserialize = schema.compile(header)
+        for values in reader:
+            if not values:
+                continue
+            new = deserialize(values)
             if new["codigo_ibge_municipio"] is not None:
                 # Força nome de município a ser mais bonito (com acentos,
                 # maiúsculas e minúsculas). :)
@@ -42,6 +51,9 @@ def main():
     parser.add_argument("output_filename")
     parser.add_argument("--buffering", default=4 * 1024 * 1024)
     parser.add_argument("--schema-filename", default="auxilio_emergencial.csv")
+    parser.add_argument(
+        "--person-index", help="SQLite database with the persons' UUIDs (adds them to the output)"
+    )
     args = parser.parse_args()
 
     schema = Schema(args.schema_filename)
@@ -50,6 +62,8 @@ def main():
     writer = rows.utils.CsvLazyDictWriter(fobj)
 
     data = extract_rows(schema, filename)
+    if args.person_index:
+        data = add_uuids(data, PERSON_FIELDS, PersonIndex(args.person_index).uuids)
     for row in tqdm(data, desc=f"Extracting {filename.name}"):
         writer.writerow(row)
     fobj.close()
@@ -0,0 +1,185 @@
+"""Convert the archives already downloaded by a spider using several processes
+
+The conversion of each archive (reading the inner CSV, deserializing and
+converting each row) runs in a pool of worker processes, outside the Scrapy
+reactor, and writes one compressed part file. The parts are then concatenated
+(in date order) to the output, which has the same format generated by
+`scrapy crawl <spider> -o <output>.csv.gz`. Only archives found in
+`DOWNLOAD_PATH` are converted (run the spider to download them).
+
+With `--engine=columnar` the inner CSVs are converted in batches of columns
+(see `transparenciagovbr.utils.columnar`, which requires pyarrow), written by
+the CSV exporter without creating one dict per row (except for the spiders
+which change each row, with `convert_row`).
+
+Usage: python -m transparenciagovbr.convert [--workers N] [--engine rows|columnar] <spider> <output.csv.gz>
+"""
+import argparse
+import csv
+import gzip
+import io
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from scrapy import spiderloader
+from scrapy.utils import project
+from tqdm import tqdm
+
+from transparenciagovbr.exporters import GzipCsvItemExporter
+from transparenciagovbr.plan import spider_plan
+from transparenciagovbr.spiders.base import TransparenciaBaseSpider
+
+
+@lru_cache(maxsize=None)
+def get_spider(spider_name):
+    settings = project.get_project_settings()
+    spider_loader = spiderloader.SpiderLoader.from_settings(settings)
+    return spider_loader.load(spider_name)()
+
+
+def downloaded_archives(spider):
+    """Return `(period, filename)` for archives on disk for `spider`, in date order"""
+
+    return [
+        (entry.period, entry.filename)
+        for entry in spider_plan(spider)
+        if entry.filename.exists()
+    ]
+
+
+def write_csv(fobj, rows, header=True):
+    """Write rows to binary `fobj` like Scrapy's `CsvItemExporter` does
+
+    Return the field names (from the first row) and the number of rows.
+    """
+
+    text_fobj = io.TextIOWrapper(fobj, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text_fobj)
+    field_names, counter = None, 0
+    for row in rows:
+        if field_names is None:
+            field_names = list(row.keys())
+            if header:
+                writer.writerow(field_names)
+        writer.writerow(row.values())
+        counter += 1
+    text_fobj.flush()
+    text_fobj.detach()
+    return field_names, counter
+
+
+def write_batches(filename, batches):
+    """Write `RecordBatch`es to a gzipped CSV, without header, like `write_csv`"""
+
+    from transparenciagovbr.utils import columnar
+
+    exporter = GzipCsvItemExporter(open(filename, mode="wb"), include_headers_line=False)
+    exporter.start_exporting()
+    field_names, counter = None, 0
+    for batch in batches:
+        if field_names is None and batch.num_rows:
+            field_names = list(columnar.first_row(batch).keys())
+        exporter.export_batch(batch)
+        counter += batch.num_rows
+    exporter.finish_exporting()
+    return field_names, counter
+
+
+def convert_archive(spider_name, filename, part_filename, engine="rows"):
+    """Convert one archive to a gzipped CSV part, without header (in a worker)"""
+
+    spider = get_spider(spider_name)
+    if engine == "columnar":
+        from transparenciagovbr.utils import columnar
+
+        if type(spider).convert_row is TransparenciaBaseSpider.convert_row:
+            batches = columnar.parse_zip_batches(spider, str(filename))
+            return write_batches(part_filename, batches)
+        rows = columnar.parse_zip_file(spider, str(filename))
+    else:
+        rows = spider.parse_zip_file(str(filename))
+    with gzip.open(part_filename, mode="wb") as fobj:
+        return write_csv(fobj, rows, header=False)
+
+
+def csv_line(values):
+    fobj = io.StringIO(newline="")
+    csv.writer(fobj).writerow(values)
+    return fobj.getvalue()
+
+
+def concatenate_parts(output_filename, field_names, part_filenames):
+    """Write the header and then each part (as gzip members) to the output"""
+
+    with open(output_filename, mode="wb") as output:
+        with gzip.GzipFile(fileobj=output, mode="wb") as fobj:
+            if field_names:
+                fobj.write(csv_line(field_names).encode("utf-8"))
+        for part_filename in part_filenames:
+            with open(part_filename, mode="rb") as part:
+                shutil.copyfileobj(part, output, length=8 * 1024 * 1024)
+
+
+def convert(spider_name, output_filename, workers=None, engine="rows"):
+    spider = get_spider(spider_name)
+    if hasattr(spider, "tables"):
+        raise ValueError(
+            f"Spider {spider_name} has more than one table (convert each one instead)"
+        )
+    custom_parser = type(spider).parse_zip_file is not TransparenciaBaseSpider.parse_zip_file
+    if engine == "columnar" and custom_parser:
+        raise ValueError(f"Spider {spider_name} can't use the columnar engine")
+    archives = downloaded_archives(spider)
+    output_filename = Path(output_filename)
+    parts_path = output_filename.parent / f".{output_filename.name}.parts"
+    if not parts_path.exists():
+        parts_path.mkdir(parents=True)
+    part_filenames = [
+        parts_path / f"{index:06d}-{filename.stem}.csv.gz"
+        for index, (_, filename) in enumerate(archives)
+    ]
+
+    # The parts are finished in any order, but are read in the archives' order
+    header, total = None, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            convert_archive,
+            [spider_name] * len(archives),
+            [filename for _, filename in archives],
+            part_filenames,
+            [engine] * len(archives),
+        )
+        progress = tqdm(results, total=len(archives), desc=f"Converting {spider_name}")
+        for field_names, counter in progress:
+            if field_names is None:  # Empty archive
+                continue
+            elif header is None:
+                header = field_names
+            elif field_names != header:
+                raise ValueError(f"Different field names in parts: {header} != {field_names}")
+            total += counter
+
+    concatenate_parts(output_filename, header, part_filenames)
+    shutil.rmtree(parts_path)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--engine", choices=("rows", "columnar"), default="rows")
+    parser.add_argument("spider_name")
+    parser.add_argument("output_filename")
+    args = parser.parse_args()
+
+    total = convert(
+        args.spider_name, args.output_filename, workers=args.workers, engine=args.engine
+    )
+    print(f"{total} rows written to {args.output_filename}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,166 @@
-import gzip
+import datetime
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from decimal import Decimal
+from pathlib import Path
 
-from scrapy.exporters import CsvItemExporter
+from itemadapter import ItemAdapter
+from scrapy.exporters import BaseItemExporter, CsvItemExporter
+from scrapy.utils.misc import create_instance, load_object
+
+from transparenciagovbr.utils.blockindex import BlockIndexWriter
+from transparenciagovbr.utils.compression import open_compressed
+from transparenciagovbr.utils.fields import load_field_types
+from transparenciagovbr.utils.metrics import TimedFile
+from transparenciagovbr.utils.partition import (
+    PartitionIndex,
+    partition_keys,
+    partition_path,
+)
+
+
+# Convert values (from the spiders or strings, like "t" for em_sigilo) to the
+# types expected by pyarrow for each schema field type
+PARQUET_CONVERTERS = {
+    "bool": lambda value: {"t": True, "f": False}.get(value, value),
+    "date": lambda value: (
+        datetime.date.fromisoformat(value) if isinstance(value, str) else value
+    ),
+    "decimal": lambda value: Decimal(value) if isinstance(value, str) else value,
+    "integer": lambda value: int(value) if isinstance(value, str) else value,
+}
+
+
+class CompressedCsvItemExporter(CsvItemExporter):
+    """Compressed CSV exporter (the codec is defined by the subclasses)
+
+    The compression level and the number of compression threads come from
+    the spider arguments `compression_level` and `compression_threads` or
+    from the settings `FEED_COMPRESSION_LEVEL` and `FEED_COMPRESSION_THREADS`.
+    With threads, blocks of `FEED_COMPRESSION_BLOCK_SIZE` bytes are
+    compressed in parallel (see `transparenciagovbr.utils.compression`).
+
+    If fields to index are defined (spider argument `index_fields` or setting
+    `FEED_INDEX_FIELDS`), the file is always written in blocks (with at least
+    one thread) and the index of the blocks having each value of these fields
+    is saved to `<filename>.idx` (see `transparenciagovbr.utils.blockindex`).
+
+    If the spider has `metrics` (see `MetricsExtension`), the time spent
+    exporting and compressing is added to it.
+
+    Besides items, `pyarrow.RecordBatch`es from the columnar engine can be
+    exported (`export_batch`), with the same result as exporting their rows.
+    """
+
+    codec = None
+
+    def __init__(
+        self,
+        fobj,
+        compression_level=None,
+        compression_threads=0,
+        compression_block_size=None,
+        index_fields=None,
+        metrics=None,
+        **kwargs,
+    ):
+        filename = fobj.name
+        fobj.close()
+        self.fobj = open(filename, mode="wb", buffering=8 * 1024 * 1024)
+        self.index = None
+        if index_fields:
+            self.index = BlockIndexWriter(filename, self.codec, index_fields)
+            compression_threads = max(compression_threads, 1)
+        self.compressed_file = open_compressed(
+            self.fobj,
+            codec=self.codec,
+            level=compression_level,
+            threads=compression_threads,
+            block_size=compression_block_size,
+        )
+        self.metrics = metrics
+        if metrics is None:
+            super().__init__(self.compressed_file, **kwargs)
+        else:
+            super().__init__(TimedFile(self.compressed_file, metrics, "compress"), **kwargs)
+
+    @classmethod
+    def from_crawler(cls, crawler, fobj, **kwargs):
+        settings, spider = crawler.settings, crawler.spider
+        level = getattr(
+            spider, "compression_level", settings.get("FEED_COMPRESSION_LEVEL")
+        )
+        threads = getattr(
+            spider, "compression_threads", settings.get("FEED_COMPRESSION_THREADS")
+        )
+        block_size = settings.getint("FEED_COMPRESSION_BLOCK_SIZE")
+        index_fields = getattr(
+            spider, "index_fields", settings.getlist("FEED_INDEX_FIELDS")
+        )
+        if isinstance(index_fields, str):
+            index_fields = [field for field in index_fields.split(",") if field]
+        kwargs.setdefault("compression_level", None if level is None else int(level))
+        kwargs.setdefault("compression_threads", int(threads or 0))
+        kwargs.setdefault("compression_block_size", block_size or None)
+        kwargs.setdefault("index_fields", index_fields)
+        kwargs.setdefault("metrics", getattr(spider, "metrics", None))
+        return cls(fobj, **kwargs)
+
+    def export_item(self, item):
+        if self.metrics is None:
+            return self._export_item(item)
+        start = time.perf_counter()
+        self._export_item(item)
+        self.metrics.add("export", time.perf_counter() - start)
+
+    def _export_item(self, item):
+        if self.index is None:
+            return super().export_item(item)
+        # The row goes to the block being filled (`write` is called once per row)
+        block = self.compressed_file.submitted
+        super().export_item(item)
+        self.index.add(block, ItemAdapter(item))
+
+    def export_batch(self, batch):
+        if self.metrics is None:
+            return self._export_batch(batch)
+        start = time.perf_counter()
+        self._export_batch(batch)
+        self.metrics.add("export", time.perf_counter() - start)
+
+    def _export_batch(self, batch):
+        from transparenciagovbr.utils import columnar
+
+        if self.index is not None or self._kwargs:
+            # The index needs each row's block and `csv.writer` the options
+            for row in columnar.batch_rows(batch):
+                self._export_item(row)
+            return
+        elif not batch.num_rows:
+            return
+        elif self._headers_not_written:
+            self._headers_not_written = False
+            self._write_headers_and_set_fields_to_export(columnar.first_row(batch))
+        field_names = self.fields_to_export
+        if isinstance(field_names, Mapping):
+            field_names = list(field_names.keys())
+        self.stream.write(columnar.format_csv(batch, field_names))
+
+    def finish_exporting(self):
+        self.stream.flush()
+        self.compressed_file.close()
+        self.fobj.close()
+        if self.index is not None:
+            fields = self.fields_to_export or []
+            header = fields.values() if isinstance(fields, dict) else fields
+            self.index.save(
+                self.compressed_file.blocks, self.compressed_file.compressed_offset, header
+            )
 
 
 # Code from <https://github.com/scrapy/scrapy/issues/2174>
-class GzipCsvItemExporter(CsvItemExporter):
+class GzipCsvItemExporter(CompressedCsvItemExporter):
     """Gzip-compressed CSV exporter
 
     To use it, add
@@ -23,12 +179,331 @@ class GzipCsvItemExporter(CsvItemExporter):
     `-t csv.gz` to the command above)
     """
 
-    def __init__(self, fobj, **kwargs):
+    codec = "gzip"
+
+
+class ZstdCsvItemExporter(CompressedCsvItemExporter):
+    """Zstandard-compressed CSV exporter (requires `pip install zstandard`)"""
+
+    codec = "zstd"
+
+
+class Lz4CsvItemExporter(CompressedCsvItemExporter):
+    """LZ4-compressed CSV exporter (requires `pip install lz4`)"""
+
+    codec = "lz4"
+
+
+class XzCsvItemExporter(CompressedCsvItemExporter):
+    """xz-compressed CSV exporter"""
+
+    codec = "xz"
+
+
+class ParquetItemExporter(BaseItemExporter):
+    """Parquet exporter, with column types from the spider's schema
+
+    The types come from the `field_type` column of the spider's schema file
+    (fields not in the schema are exported as strings) and items are written
+    in row groups of `PARQUET_ROW_GROUP_SIZE` rows, compressed with
+    `PARQUET_COMPRESSION`. Requires pyarrow (`pip install pyarrow`).
+    `pyarrow.RecordBatch`es from the columnar engine are converted to these
+    types and written as they are (`export_batch`).
+
+    To use it, add
+    ::
+
+        FEED_EXPORTERS = {
+            'parquet': 'myproject.exporters.ParquetItemExporter',
+        }
+
+    to settings.py and then run scrapy crawl like this::
+
+        scrapy crawl foo -t parquet -o item.parquet
+    """
+
+    def __init__(
+        self,
+        fobj,
+        schema_filename=None,
+        row_group_size=100_000,
+        compression="zstd",
+        decimal_precision=38,
+        decimal_scale=10,
+        metrics=None,
+        **kwargs,
+    ):
+        import pyarrow
+
+        super().__init__(dont_fail=True, **kwargs)
         filename = fobj.name
         fobj.close()
-        fobj = open(filename, mode="wb", buffering=8 * 1024 * 1024)
-        self.gzfile = gzip.GzipFile(fileobj=fobj)
-        super().__init__(self.gzfile, **kwargs)
+        self.fobj = open(filename, mode="wb", buffering=8 * 1024 * 1024)
+        self.field_types = load_field_types(schema_filename) if schema_filename else {}
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.types = {
+            "bool": pyarrow.bool_(),
+            "date": pyarrow.date32(),
+            "decimal": pyarrow.decimal128(decimal_precision, decimal_scale),
+            "integer": pyarrow.int64(),
+            "text": pyarrow.string(),
+        }
+        self.schema = None
+        self.writer = None
+        self.columns = None
+        self.tables = []  # Converted batches (and rows before them)
+        self.buffered = 0
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler, fobj, **kwargs):
+        settings = crawler.settings
+        kwargs.setdefault("schema_filename", getattr(crawler.spider, "schema_filename", None))
+        kwargs.setdefault("row_group_size", settings.getint("PARQUET_ROW_GROUP_SIZE"))
+        kwargs.setdefault("compression", settings.get("PARQUET_COMPRESSION"))
+        kwargs.setdefault("metrics", getattr(crawler.spider, "metrics", None))
+        return cls(fobj, **kwargs)
+
+    def _create_schema(self, item):
+        import pyarrow
+
+        field_names = self.fields_to_export or list(ItemAdapter(item).field_names())
+        return pyarrow.schema(
+            [
+                (
+                    field_name,
+                    self.types.get(self.field_types.get(field_name), self.types["text"]),
+                )
+                for field_name in field_names
+            ]
+        )
+
+    def export_item(self, item):
+        if self.metrics is None:
+            return self._export_item(item)
+        start = time.perf_counter()
+        self._export_item(item)
+        self.metrics.add("export", time.perf_counter() - start)
+
+    def _export_item(self, item):
+        adapter = ItemAdapter(item)
+        if self.schema is None:
+            self._set_schema(item)
+        for field_name, values in self.columns.items():
+            values.append(adapter.get(field_name))
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self._write_row_group()
+
+    def export_batch(self, batch):
+        if self.metrics is None:
+            return self._export_batch(batch)
+        start = time.perf_counter()
+        self._export_batch(batch)
+        self.metrics.add("export", time.perf_counter() - start)
+
+    def _export_batch(self, batch):
+        import pyarrow
+
+        from transparenciagovbr.utils import columnar
+
+        if not batch.num_rows:
+            return
+        elif self.schema is None:
+            self._set_schema(columnar.first_row(batch))
+        self._convert_rows()  # So the rows exported before are written first
+        names = batch.schema.names
+        arrays = [
+            columnar.cast_column(
+                batch.column(field_name) if field_name in names else None,
+                self.schema.field(field_name).type,
+                batch.num_rows,
+            )
+            for field_name in self.schema.names
+        ]
+        self.tables.append(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.buffered += batch.num_rows
+        if self.buffered >= self.row_group_size:
+            self._write_row_group()
+
+    def _set_schema(self, item):
+        self.schema = self._create_schema(item)
+        self.columns = {field_name: [] for field_name in self.schema.names}
+
+    def _convert_column(self, field_type, values):
+        convert = PARQUET_CONVERTERS.get(field_type)
+        if convert is None:  # Text or not in the schema
+            return [
+                value if value is None or isinstance(value, str) else str(value)
+                for value in values
+            ]
+        return [
+            None if value is None or value == "" else convert(value) for value in values
+        ]
+
+    def _convert_rows(self):
+        """Move the buffered rows to `tables`, converted to Arrow"""
+
+        import pyarrow
+
+        if self.columns is None or not next(iter(self.columns.values()), None):
+            return
+        arrays = [
+            pyarrow.array(
+                self._convert_column(self.field_types.get(field_name), values),
+                type=self.schema.field(field_name).type,
+            )
+            for field_name, values in self.columns.items()
+        ]
+        self.tables.append(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        for values in self.columns.values():
+            values.clear()
+
+    def _write_row_group(self, finish=False):
+        """Write the buffered rows, in row groups of `row_group_size` rows
+
+        The rows which don't fill a row group are kept (until `finish`).
+        """
+
+        import pyarrow
+        import pyarrow.parquet
+
+        start = time.perf_counter()
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.fobj, self.schema, compression=self.compression
+            )
+        self._convert_rows()
+        table = pyarrow.concat_tables(self.tables)
+        size = self.buffered
+        if not finish:
+            size -= size % self.row_group_size
+        self.writer.write_table(table.slice(0, size), row_group_size=self.row_group_size)
+        self.tables = [table.slice(size)] if size < self.buffered else []
+        self.buffered -= size
+        if self.metrics is not None:  # Conversion to Arrow, compression and writing
+            self.metrics.add("compress", time.perf_counter() - start)
+
+    def finish_exporting(self):
+        if self.buffered:
+            start = time.perf_counter()
+            self._write_row_group(finish=True)
+            if self.metrics is not None:  # So `compress` is always part of `export`
+                self.metrics.add("export", time.perf_counter() - start)
+        if self.writer is not None:
+            self.writer.close()
+        self.fobj.close()
+
+
+class PartitionedItemExporter(BaseItemExporter):
+    """Write items to Hive-style partitions, by the period they were downloaded for
+
+    The feed file is the partitions index (`<directory>/_index.json`, see
+    `transparenciagovbr.utils.partition`) and the items are written to
+    `<directory>/ano=YYYY/mes=MM/part-<run>-<N>.<format>` by the exporter of
+    `PARTITION_FORMAT` (by default, `FEED_FORMAT`). The period comes from the
+    item's `period` attribute (see `transparenciagovbr.items.Row`), set by
+    the spiders when the feed format is `partitioned`. At most
+    `PARTITION_MAX_OPEN_FILES` part files are open at the same time: the
+    least recently used one is finished and, if more items of its partition
+    arrive, a new part file is started. Partitions of previous runs (like
+    in the incremental mode) are kept in the index. `<run>` is the spider's
+    `run_id` (if it has one), so the spider can tell its parts apart from
+    the ones of previous runs it replaces.
+
+    To use it, add
+    ::
+
+        FEED_EXPORTERS = {
+            'partitioned': 'myproject.exporters.PartitionedItemExporter',
+        }
+
+    to settings.py and then run scrapy crawl like this::
+
+        scrapy crawl foo -s PARTITION_FORMAT=csv.gz -t partitioned -o foo/_index.json
+    """
+
+    def __init__(
+        self,
+        fobj,
+        create_exporter,
+        extension,
+        frequency="daily",
+        max_open_files=4,
+        run_id=None,
+        **kwargs,
+    ):
+        super().__init__(dont_fail=True, **kwargs)
+        filename = fobj.name
+        fobj.close()
+        self.index = PartitionIndex(Path(filename).parent)
+        self.create_exporter = create_exporter
+        self.extension = extension
+        self.frequency = frequency
+        self.max_open_files = max_open_files
+        self.run_id = run_id or datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        self.partitions = {}  # Partition name and keys by period
+        self.parts = OrderedDict()  # Open parts (least recently used first)
+        self.part_counter = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, fobj, **kwargs):
+        settings = crawler.settings
+        feed_format = settings.get("PARTITION_FORMAT") or settings.get("FEED_FORMAT")
+        if feed_format == "partitioned":
+            raise ValueError("PARTITION_FORMAT must be the format of the part files")
+        exporter_class = load_object(settings.getwithbase("FEED_EXPORTERS")[feed_format])
+
+        def create_exporter(part_fobj):
+            return create_instance(exporter_class, settings, crawler, part_fobj, **kwargs)
+
+        return cls(
+            fobj,
+            create_exporter=create_exporter,
+            extension=feed_format,
+            frequency=getattr(crawler.spider, "publish_frequency", "daily"),
+            max_open_files=settings.getint("PARTITION_MAX_OPEN_FILES"),
+            run_id=kwargs.pop("run_id", None) or getattr(crawler.spider, "run_id", None),
+            **kwargs,
+        )
+
+    def _partition(self, period):
+        if period not in self.partitions:
+            keys = partition_keys(period, self.frequency)
+            self.partitions[period] = (partition_path(keys), keys)
+        return self.partitions[period]
+
+    def _open_part(self, name, keys):
+        number = self.part_counter.get(name, 0) + 1
+        self.part_counter[name] = number
+        filename = f"{name}/part-{self.run_id}-{number:04d}.{self.extension}"
+        (self.index.path / name).mkdir(parents=True, exist_ok=True)
+        fobj = open(self.index.path / filename, mode="wb")
+        exporter = self.create_exporter(fobj)
+        exporter.start_exporting()
+        return {"keys": keys, "filename": filename, "fobj": fobj, "exporter": exporter, "rows": 0}
+
+    def _finish_part(self, part):
+        part["exporter"].finish_exporting()
+        part["fobj"].close()
+        self.index.add(part["keys"], part["filename"], part["rows"])
+
+    def export_item(self, item):
+        period = getattr(item, "period", None)
+        if period is None:
+            raise ValueError(f"Item has no period to be partitioned by: {item!r}")
+        name, keys = self._partition(period)
+        part = self.parts.pop(name, None)
+        if part is None:
+            if len(self.parts) >= self.max_open_files:
+                self._finish_part(self.parts.popitem(last=False)[1])
+            part = self._open_part(name, keys)
+        self.parts[name] = part
+        part["exporter"].export_item(item)
+        part["rows"] += 1
 
     def finish_exporting(self):
-        self.gzfile.close()
+        while self.parts:
+            self._finish_part(self.parts.popitem(last=False)[1])
+        self.index.save()
@@ -0,0 +1,166 @@
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from transparenciagovbr.utils.metrics import Metrics
+
+
+class MetricsExtension:
+    """Record the time spent in each stage for each archive and for the crawl
+
+    Each archive converted adds a line (`"type": "archive"`, with its URL,
+    period, bytes, rows and seconds by stage - see
+    `transparenciagovbr.utils.metrics`) to `METRICS_PATH/<spider>.jsonl` and
+    the totals for the crawl (`"type": "spider"`) are added every
+    `METRICS_INTERVAL` seconds and when the spider closes. If
+    `METRICS_PROMETHEUS_PORT` is set, the totals are also served in the
+    Prometheus text format at `http://METRICS_PROMETHEUS_HOST:<port>/metrics`.
+
+    To use it, add
+    ::
+
+        EXTENSIONS = {
+            "transparenciagovbr.extensions.MetricsExtension": 500,
+        }
+        METRICS_ENABLED = True
+
+    to settings.py.
+    """
+
+    def __init__(
+        self, crawler, path, interval=60, prometheus_host=None, prometheus_port=None
+    ):
+        self.crawler = crawler
+        self.path = Path(path)
+        self.interval = interval
+        self.prometheus_host = prometheus_host
+        self.prometheus_port = prometheus_port
+        self.totals = Metrics()
+        self.fobj = None
+        self.loop = None
+        self.server = None
+        self.started_at = None
+        self.start_time = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured("METRICS_ENABLED is not set")
+        extension = cls(
+            crawler,
+            path=settings.get("METRICS_PATH"),
+            interval=settings.getfloat("METRICS_INTERVAL", 60),
+            prometheus_host=settings.get("METRICS_PROMETHEUS_HOST", "127.0.0.1"),
+            prometheus_port=settings.getint("METRICS_PROMETHEUS_PORT") or None,
+        )
+        # Spiders and exporters record the metrics through `spider.metrics`
+        crawler.spider.metrics = extension
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(
+            extension.response_downloaded, signal=signals.response_downloaded
+        )
+        return extension
+
+    def spider_opened(self, spider):
+        self.started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        self.start_time = time.monotonic()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.fobj = open(self.path / f"{spider.name}.jsonl", mode="a", buffering=1)
+        if self.interval:
+            self.loop = task.LoopingCall(self.write_totals, spider)
+            self.loop.start(self.interval, now=False)
+        if self.prometheus_port:
+            self.server = ThreadingHTTPServer(
+                (self.prometheus_host, self.prometheus_port), self.request_handler(spider)
+            )
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def spider_closed(self, spider, reason):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.write_totals(spider, reason=reason)
+        self.fobj.close()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def response_downloaded(self, response, request, spider):
+        start = request.meta.get("download_start")  # Set by the download handler
+        if start is None:  # Not downloaded (like `file://` URLs)
+            return
+        if "streamed" in response.flags:
+            size = int(response.headers.get("Content-Length", 0))
+        else:
+            size = len(response.body)
+        request.meta["download_size"] = size
+        request.meta["download_time"] = time.monotonic() - start
+
+    def add(self, stage, seconds):
+        self.totals.add(stage, seconds)
+
+    def archive_metrics(self, response):
+        """Return the `Metrics` for the archive in `response` (with the download)"""
+
+        metrics = Metrics()
+        metrics.archives = 1
+        metrics.bytes = response.meta.get("download_size", 0)
+        metrics.add("download", response.meta.get("download_time", 0.0))
+        return metrics
+
+    def archive_parsed(self, response, metrics):
+        self.totals.merge(metrics)
+        self.write(
+            {
+                "type": "archive",
+                "url": response.url,
+                "period": response.meta.get("period"),
+                **metrics.as_dict(),
+            }
+        )
+
+    def write_totals(self, spider, reason=None):
+        record = {"type": "spider", **self.totals.as_dict(self.elapsed)}
+        if reason is not None:
+            record["reason"] = reason
+        self.write(record)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def write(self, record):
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "spider": self.crawler.spider.name,
+            "run": self.started_at,
+            **record,
+        }
+        self.fobj.write(json.dumps(record) + "\n")
+
+    def request_handler(self, spider):
+        totals = self.totals
+
+        class PrometheusRequestHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    return self.send_error(404)
+                body = totals.prometheus({"spider": spider.name}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return PrometheusRequestHandler
@@ -0,0 +1,117 @@
+import time
+from pathlib import Path
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.http import Response
+from twisted.internet import defer, threads
+
+from transparenciagovbr.utils.download import HostLimiter, download_file, load_validators
+
+
+def stored_headers(filename):
+    """Return the stored validators of a file already on the disk as headers"""
+
+    validators = load_validators(filename)
+    if validators is None:
+        return {}
+    headers = {"Content-Length": str(Path(filename).stat().st_size)}
+    if validators.get("etag"):
+        headers["ETag"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["Last-Modified"] = validators["last_modified"]
+    return headers
+
+
+class StreamingDownloadHandler:
+    """HTTP(S) download handler which streams response bodies to the disk
+
+    Requests having `download_to` in their `meta` have the body written in
+    chunks directly to that path and the response is returned with an empty
+    body, so memory usage does not depend on the archive size (the spider must
+    read the file from the disk). If the file already exists, nothing is
+    downloaded (unless `download_overwrite` is also in `meta`; the file is
+    only replaced after the download finishes) and the response has the
+    file's stored validators as headers. If the server supports HTTP
+    Range requests, the file is downloaded in up to `DOWNLOAD_SEGMENTS`
+    concurrent segments and interrupted downloads are resumed (see
+    `transparenciagovbr.utils.download.download_file`), with at most
+    `DOWNLOAD_MAX_CONNECTIONS_PER_HOST` connections to each host (and no more
+    than the concurrency of the host's downloader slot, adjusted by
+    `AdaptiveConcurrencyMiddleware`, counting each segment). Other
+    requests (and the ones not using `GET`, like the `HEAD` requests sent to
+    revalidate an archive) are handled by Scrapy's default HTTP handler.
+
+    To use it, add
+    ::
+
+        DOWNLOAD_HANDLERS = {
+            "http": "transparenciagovbr.handlers.StreamingDownloadHandler",
+            "https": "transparenciagovbr.handlers.StreamingDownloadHandler",
+        }
+
+    to settings.py.
+    """
+
+    lazy = False
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        self.chunk_size = settings.getint("STREAM_CHUNK_SIZE")
+        self.default_timeout = settings.getfloat("DOWNLOAD_TIMEOUT")
+        self.segments = settings.getint("DOWNLOAD_SEGMENTS")
+        self.min_segment_size = settings.getint("DOWNLOAD_SEGMENT_MIN_SIZE")
+        self.limiter = HostLimiter(settings.getint("DOWNLOAD_MAX_CONNECTIONS_PER_HOST"))
+        self.default_handler = HTTP11DownloadHandler.from_crawler(crawler)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def download_request(self, request, spider):
+        request.meta["download_start"] = time.monotonic()
+        filename = request.meta.get("download_to")
+        if filename is None or request.method != "GET":
+            # Like the `HEAD` requests of `RevalidationMiddleware`
+            return self.default_handler.download_request(request, spider)
+
+        if Path(filename).exists() and not request.meta.get("download_overwrite"):
+            return defer.succeed(self._make_response(request, 200, stored_headers(filename)))
+
+        self.limit_connections(request)
+        # The body is saved as is, so it can't be content-encoded
+        headers = request.headers.to_unicode_dict()
+        headers.pop("Accept-Encoding", None)
+        result = threads.deferToThread(
+            download_file,
+            url=request.url,
+            filename=filename,
+            headers=dict(headers),
+            timeout=request.meta.get("download_timeout", self.default_timeout),
+            chunk_size=self.chunk_size,
+            segments=self.segments,
+            min_segment_size=self.min_segment_size,
+            limiter=self.limiter,
+        )
+        result.addCallback(lambda status_headers: self._make_response(request, *status_headers))
+        return result
+
+    def limit_connections(self, request):
+        # Each segment is a connection, so they count against the slot's
+        # concurrency (which only limits the number of requests)
+        key = request.meta.get("download_slot")
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            self.limiter.set_limit(key, slot.concurrency)
+
+    def _make_response(self, request, status, headers):
+        return Response(
+            url=request.url,
+            status=status,
+            headers=headers,
+            request=request,
+            flags=["streamed"],
+        )
+
+    def close(self):
+        return self.default_handler.close()
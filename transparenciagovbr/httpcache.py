@@ -0,0 +1,83 @@
+import os
+import shutil
+from pathlib import Path
+
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+
+from transparenciagovbr.utils.download import write_file
+
+
+def link_or_copy(source, destination):
+    """Hard link `source` to `destination` (or copy it, if it's not possible)
+
+    `destination` is replaced atomically.
+    """
+
+    source, destination = Path(source), Path(destination)
+    temp_filename = destination.parent / (destination.name + ".part")
+    if temp_filename.exists():
+        temp_filename.unlink()
+    try:
+        os.link(source, temp_filename)
+    except OSError:  # Different file systems or no support for hard links
+        with open(source, mode="rb") as input_fobj:
+            with open(temp_filename, mode="wb") as fobj:
+                shutil.copyfileobj(input_fobj, fobj, length=8 * 1024 * 1024)
+    os.replace(temp_filename, destination)
+
+
+class LinkedFilesystemCacheStorage(FilesystemCacheStorage):
+    """Filesystem cache storage which shares the archives' bodies with `DOWNLOAD_PATH`
+
+    For successful responses of requests having `archive_filename` in `meta`
+    (the path where the spider saves the archive), the body is written only
+    once, to `archive_filename`, and the cache's `response_body` is a hard
+    link to it (so the archive is not stored twice). `archive_saved` is set
+    in `meta`, so the spider doesn't write it again. If the archive was
+    removed from `DOWNLOAD_PATH`, it's linked back from the cache when the
+    cached response is used. If hard links are not possible (like when the
+    cache is in another file system), the body is copied. Doesn't apply if
+    `HTTPCACHE_GZIP` is enabled.
+
+    To use it, add
+    ::
+
+        HTTPCACHE_STORAGE = "transparenciagovbr.httpcache.LinkedFilesystemCacheStorage"
+
+    to settings.py.
+    """
+
+    def _archive_filename(self, request, response=None):
+        filename = request.meta.get("archive_filename")
+        if (
+            self.use_gzip
+            or filename is None
+            or (response is not None and response.status != 200)
+        ):
+            return None
+        return filename
+
+    def _body_filename(self, spider, request):
+        return Path(self._get_request_path(spider, request)) / "response_body"
+
+    def retrieve_response(self, spider, request):
+        response = super().retrieve_response(spider, request)
+        if response is None:
+            return None
+        filename = self._archive_filename(request, response)
+        if filename is not None:
+            if not Path(filename).exists():
+                Path(filename).parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(self._body_filename(spider, request), filename)
+            request.meta["archive_saved"] = True
+        return response
+
+    def store_response(self, spider, request, response):
+        filename = self._archive_filename(request, response)
+        if filename is None:
+            return super().store_response(spider, request, response)
+
+        write_file(filename, response.body)
+        super().store_response(spider, request, response.replace(body=b""))
+        link_or_copy(filename, self._body_filename(spider, request))
+        request.meta["archive_saved"] = True
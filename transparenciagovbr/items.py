@@ -6,9 +6,37 @@
 # https://doc.scrapy.org/en/latest/topics/items.html
 
 import scrapy
+from scrapy.extensions.feedexport import ItemFilter
 
 
 class TransparenciagovbrItem(scrapy.Item):
     # define the fields for your item here like:
     # name = scrapy.Field()
     pass
+
+
+class Row(dict):
+    """Row (dict) which also has the name of the table and the period it belongs to
+
+    `table` is used by spiders which read more than one table from the same
+    archive and `period` by the partitioned output and `PostgreSQLPipeline`
+    (none of them is exported as a field).
+    """
+
+    __slots__ = ("table", "period")
+
+    def __init__(self, data, table=None, period=None):
+        super().__init__(data)
+        self.table = table
+        self.period = period
+
+
+class TableFilter(ItemFilter):
+    """Feed item filter accepting only the rows of the feed option `table`"""
+
+    def __init__(self, feed_options):
+        super().__init__(feed_options)
+        self.table = (feed_options or {}).get("table")
+
+    def accepts(self, item):
+        return getattr(item, "table", None) == self.table
@@ -0,0 +1,379 @@
+"""Load the spiders' outputs into an embedded database (DuckDB or SQLite)
+
+Each table is created with typed columns (from the `field_type` column of
+`schema/<table>.csv`; fields not in the schema are text) and the outputs are
+bulk-loaded: `OUTPUT_PATH/<table>.<format>` and then the partitions in
+`OUTPUT_PATH/<table>/` (created by the incremental mode, in name order, and
+the ones listed in the index of the partitioned output), or the files passed
+as arguments. The files already loaded are recorded in the
+database, so only new partitions are loaded in the next runs (if a file
+loaded before changed or was removed, the table is loaded again from
+scratch). After loading, the indexes for the table found in the SQL files
+passed with `--indexes` (by default `pensionista/indexes.sql`) are created.
+
+DuckDB (`pip install duckdb`) is used if it's installed; otherwise, SQLite.
+
+Usage: python -m transparenciagovbr.load [--engine duckdb|sqlite] [--indexes SQL_FILENAME] <database> <table> [filename ...]
+"""
+import argparse
+import csv
+import datetime
+import io
+import re
+import shutil
+import sqlite3
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from tqdm import tqdm
+
+from transparenciagovbr import settings
+from transparenciagovbr.utils.blockindex import INDEX_SUFFIX
+from transparenciagovbr.utils.compression import open_compressed_reader
+from transparenciagovbr.utils.fields import load_field_types
+from transparenciagovbr.utils.partition import PartitionIndex
+
+
+SQL_TYPES = {
+    "duckdb": {
+        "bool": "BOOLEAN",
+        "date": "DATE",
+        "decimal": "DECIMAL(38, 10)",
+        "integer": "BIGINT",
+        "text": "VARCHAR",
+    },
+    "sqlite": {
+        "bool": "BOOLEAN",
+        "date": "DATE",
+        "decimal": "NUMERIC",
+        "integer": "INTEGER",
+        "text": "TEXT",
+    },
+}
+DEFAULT_INDEX_FILENAMES = (settings.REPOSITORY_PATH / "pensionista" / "indexes.sql",)
+REGEXP_INDEX_TABLE = re.compile(
+    r"^\s*(?:CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?P<index>\w+)\s+ON|ALTER\s+TABLE)\s+(?P<table>\w+)",
+    flags=re.IGNORECASE,
+)
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def table_field_types(table_name):
+    """Return the field types from the table's schema (if any), by field name"""
+
+    if not (settings.REPOSITORY_PATH / "schema" / f"{table_name}.csv").exists():
+        return {}
+    return load_field_types(f"{table_name}.csv")
+
+
+def input_filenames(table_name, output_path=None):
+    """Return the complete output and then the partitions for `table_name`"""
+
+    output_path = Path(output_path or settings.OUTPUT_PATH)
+    filenames = sorted(
+        filename
+        for filename in output_path.glob(f"{table_name}.*")
+        if filename.is_file() and not filename.name.endswith(INDEX_SUFFIX)
+    )
+    path = output_path / table_name
+    if path.is_dir():
+        filenames.extend(
+            sorted(
+                filename
+                for filename in path.glob("*.*")
+                if filename.is_file()
+                and not filename.name.startswith("_")
+                and not filename.name.endswith(INDEX_SUFFIX)
+            )
+        )
+        filenames.extend(PartitionIndex(path).filenames())
+    return filenames
+
+
+def read_header(filename):
+    if str(filename).endswith(".parquet"):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_schema(filename).names
+    with open_compressed_reader(filename) as fobj:
+        return next(csv.reader(io.TextIOWrapper(fobj, encoding="utf-8")))
+
+
+def index_statements(table_name, index_filenames):
+    """Return `(index_name, sql)` for each statement about `table_name`
+
+    `index_name` is `None` for statements which are not `CREATE INDEX`.
+    """
+
+    result = []
+    for filename in index_filenames:
+        with open(filename) as fobj:
+            statements = fobj.read().split(";")
+        for statement in statements:
+            match = REGEXP_INDEX_TABLE.match(statement)
+            if match and match.group("table") == table_name:
+                result.append((match.group("index"), statement.strip()))
+    return result
+
+
+class Loader(ABC):
+    name = None
+
+    def __init__(self, database_filename):
+        self.connection = self.connect(str(database_filename))
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS _loaded_files (
+                table_name TEXT, filename TEXT, size BIGINT, mtime DOUBLE, loaded_at TEXT
+            )
+            """
+        )
+
+    @abstractmethod
+    def connect(self, database_filename):
+        """Return the connection to the database"""
+
+    def execute(self, sql, parameters=()):
+        return self.connection.execute(sql, parameters)
+
+    def loaded_files(self, table_name):
+        result = self.execute(
+            "SELECT filename, size, mtime FROM _loaded_files WHERE table_name = ?",
+            (table_name,),
+        )
+        return {filename: (size, mtime) for filename, size, mtime in result.fetchall()}
+
+    def drop_table(self, table_name):
+        self.execute(f"DROP TABLE IF EXISTS {quote(table_name)}")
+        self.execute("DELETE FROM _loaded_files WHERE table_name = ?", (table_name,))
+
+    def create_table(self, table_name, columns):
+        types = SQL_TYPES[self.name]
+        definitions = ", ".join(
+            f"{quote(field_name)} {types.get(field_type, types['text'])}"
+            for field_name, field_type in columns
+        )
+        self.execute(f"CREATE TABLE IF NOT EXISTS {quote(table_name)} ({definitions})")
+
+    def count(self, table_name):
+        return self.execute(f"SELECT COUNT(*) FROM {quote(table_name)}").fetchone()[0]
+
+    def load(self, table_name, filename, columns):
+        """Load `filename` and record it as loaded (in one transaction)"""
+
+        stat = Path(filename).stat()
+        self.execute("BEGIN TRANSACTION")
+        self.load_file(table_name, filename, columns)
+        self.execute(
+            "INSERT INTO _loaded_files VALUES (?, ?, ?, ?, ?)",
+            (
+                table_name,
+                str(filename),
+                stat.st_size,
+                stat.st_mtime,
+                datetime.datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+        self.execute("COMMIT")
+
+    @abstractmethod
+    def load_file(self, table_name, filename, columns):
+        """Insert the rows of `filename` into the table (already created)"""
+
+    def close(self):
+        self.connection.close()
+
+
+class DuckDBLoader(Loader):
+    name = "duckdb"
+    error_class = None
+
+    def connect(self, database_filename):
+        import duckdb
+
+        self.error_class = duckdb.Error
+        return duckdb.connect(database_filename)
+
+    def load_file(self, table_name, filename, columns):
+        filename = str(filename)
+        if filename.endswith(".parquet"):
+            # Partition keys (`ano=YYYY/...` paths) are not columns of the table
+            source = "read_parquet(?, hive_partitioning = false)"
+        else:
+            types = SQL_TYPES[self.name]
+            column_types = ", ".join(
+                f"{quote(field_name)}: '{types.get(field_type, types['text'])}'"
+                for field_name, field_type in columns
+            )
+            source = (
+                "read_csv(?, header = true, delim = ',', quote = '\"', escape = '\"', "
+                f"nullstr = '', hive_partitioning = false, columns = {{{column_types}}})"
+            )
+        if filename.endswith((".lz4", ".xz")):  # Not supported by DuckDB
+            with tempfile.NamedTemporaryFile(suffix=".csv") as temp:
+                with open_compressed_reader(filename) as fobj:
+                    shutil.copyfileobj(fobj, temp, length=8 * 1024 * 1024)
+                temp.flush()
+                self._insert(table_name, source, temp.name)
+        else:
+            self._insert(table_name, source, filename)
+
+    def _insert(self, table_name, source, filename):
+        self.execute(
+            f"INSERT INTO {quote(table_name)} BY NAME SELECT * FROM {source}",
+            (filename,),
+        )
+
+
+class SQLiteLoader(Loader):
+    name = "sqlite"
+    error_class = sqlite3.Error
+    batch_size = 10_000
+
+    def connect(self, database_filename):
+        # Transactions are controlled by `Loader.load`
+        connection = sqlite3.connect(database_filename, isolation_level=None)
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("PRAGMA journal_mode = WAL")
+        return connection
+
+    def _read_rows(self, filename):
+        if str(filename).endswith(".parquet"):
+            import pyarrow.parquet
+
+            parquet_file = pyarrow.parquet.ParquetFile(filename)
+            header = parquet_file.schema_arrow.names
+            yield header
+            for batch in parquet_file.iter_batches(batch_size=self.batch_size):
+                yield from zip(*(column.to_pylist() for column in batch.columns))
+        else:
+            with open_compressed_reader(filename) as fobj:
+                yield from csv.reader(io.TextIOWrapper(fobj, encoding="utf-8"))
+
+    def load_file(self, table_name, filename, columns):
+        field_types = dict(columns)
+        data = self._read_rows(filename)
+        header = next(data)
+        converters = []
+        for field_name in header:
+            if field_types.get(field_name) == "bool":
+                converters.append({"t": 1, "f": 0, True: 1, False: 0}.get)
+            else:
+                converters.append(None)
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            quote(table_name),
+            ", ".join(quote(field_name) for field_name in header),
+            ", ".join("?" for _ in header),
+        )
+        batch = []
+        for row in data:
+            values = []
+            for value, convert in zip(row, converters):
+                if value == "" or value is None:
+                    value = None
+                elif convert is not None:
+                    value = convert(value)
+                values.append(value)
+            batch.append(values)
+            if len(batch) == self.batch_size:
+                self.connection.executemany(sql, batch)
+                batch = []
+        if batch:
+            self.connection.executemany(sql, batch)
+
+
+LOADERS = {"duckdb": DuckDBLoader, "sqlite": SQLiteLoader}
+
+
+def default_engine():
+    try:
+        import duckdb  # noqa
+    except ImportError:
+        return "sqlite"
+    return "duckdb"
+
+
+def create_indexes(loader, statements):
+    for index_name, sql in statements:
+        try:
+            loader.execute(sql)
+        except loader.error_class as exception:
+            if "already exists" not in str(exception).lower():
+                print(f"WARNING: could not execute {repr(sql)}: {exception}")
+
+
+def load(
+    database_filename,
+    table_name,
+    filenames=None,
+    engine=None,
+    index_filenames=DEFAULT_INDEX_FILENAMES,
+):
+    """Load the new files for `table_name` and return the number of rows loaded"""
+
+    filenames = [Path(filename) for filename in (filenames or input_filenames(table_name))]
+    loader = LOADERS[engine or default_engine()](database_filename)
+    try:
+        loaded = loader.loaded_files(table_name)
+        current = {}
+        for filename in filenames:
+            stat = filename.stat()
+            current[str(filename)] = (stat.st_size, stat.st_mtime)
+        if any(current.get(filename) != info for filename, info in loaded.items()):
+            # Some file changed (like a complete output generated again)
+            loader.drop_table(table_name)
+            loaded = {}
+        new_filenames = [filename for filename in filenames if str(filename) not in loaded]
+        if not new_filenames:
+            return 0
+
+        field_types = table_field_types(table_name)
+        columns = [
+            (field_name, field_types.get(field_name, "text"))
+            for field_name in read_header(new_filenames[0])
+        ]
+        loader.create_table(table_name, columns)
+        rows_before = loader.count(table_name)
+
+        # Indexes are dropped during the load and created again after it
+        statements = index_statements(table_name, index_filenames)
+        for index_name, _ in statements:
+            if index_name is not None:
+                loader.execute(f"DROP INDEX IF EXISTS {quote(index_name)}")
+        for filename in tqdm(new_filenames, desc=f"Loading {table_name}"):
+            loader.load(table_name, filename, columns)
+        create_indexes(loader, statements)
+        return loader.count(table_name) - rows_before
+    finally:
+        loader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=tuple(LOADERS.keys()), default=default_engine())
+    parser.add_argument(
+        "--indexes",
+        action="append",
+        help="SQL file with indexes to create (default: pensionista/indexes.sql)",
+    )
+    parser.add_argument("database_filename")
+    parser.add_argument("table_name")
+    parser.add_argument("filenames", nargs="*")
+    args = parser.parse_args()
+
+    total = load(
+        args.database_filename,
+        args.table_name,
+        filenames=args.filenames,
+        engine=args.engine,
+        index_filenames=args.indexes or DEFAULT_INDEX_FILENAMES,
+    )
+    print(f"{total} rows loaded into {args.table_name}")
+
+
+if __name__ == "__main__":
+    main()
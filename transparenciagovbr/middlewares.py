@@ -5,7 +5,18 @@
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+from pathlib import Path
+
 from scrapy import signals
+from scrapy.http import Response
+from scrapy.utils.httpobj import urlparse_cached
+
+from transparenciagovbr.utils.download import (
+    load_validators,
+    save_validators,
+    validators_match,
+)
 
 
 class TransparenciagovbrSpiderMiddleware(object):
@@ -101,3 +112,283 @@ class TransparenciagovbrDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class RevalidationMiddleware:
+    """Check if archives already in `DOWNLOAD_PATH` changed before downloading
+
+    Applies to requests having `archive_filename` (where the archive is saved)
+    in `meta`. The `ETag`, `Last-Modified` and `Content-Length` of each
+    downloaded archive are stored next to it (see
+    `transparenciagovbr.utils.download.save_validators`) and, for requests
+    also having `revalidate` in `meta`, they are used to send a conditional
+    GET (`REVALIDATION_METHOD = "conditional"`) or a HEAD request first
+    (`"head"`). If the archive didn't change, the body is not transferred and
+    the response points to the file on disk (`download_to` in `meta`, like
+    the streamed responses) with the flag `revalidated`.
+    """
+
+    def __init__(self, method="conditional"):
+        if method not in ("conditional", "head"):
+            raise ValueError(f"Invalid REVALIDATION_METHOD: {method}")
+        self.method = method
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(method=crawler.settings.get("REVALIDATION_METHOD", "conditional"))
+
+    def process_request(self, request, spider):
+        filename = request.meta.get("archive_filename")
+        if (
+            filename is None
+            or not request.meta.get("revalidate")
+            or "revalidation" in request.meta
+            or not request.url.startswith(("http://", "https://"))
+        ):
+            return None
+
+        validators = load_validators(filename)
+        if validators is None:  # Never downloaded (or incomplete): download it
+            request.meta["revalidation"] = "download"
+            request.meta["download_overwrite"] = True
+            return None
+        elif self.method == "head":
+            meta = dict(request.meta, revalidation="head", validators=validators)
+            return request.replace(method="HEAD", meta=meta, dont_filter=True)
+
+        request.meta["revalidation"] = "conditional"
+        request.meta["download_overwrite"] = True
+        if validators["etag"]:
+            request.headers["If-None-Match"] = validators["etag"]
+        if validators["last_modified"]:
+            request.headers["If-Modified-Since"] = validators["last_modified"]
+        return None
+
+    def process_response(self, request, response, spider):
+        filename = request.meta.get("archive_filename")
+        if filename is None or not request.url.startswith(("http://", "https://")):
+            return response
+
+        revalidation = request.meta.get("revalidation")
+        headers = response.headers.to_unicode_dict()
+        if revalidation == "head":
+            if response.status == 200 and validators_match(
+                request.meta["validators"], headers
+            ):
+                return self._local_response(request, filename)
+            meta = dict(request.meta, revalidation="download", download_overwrite=True)
+            del meta["validators"]
+            return request.replace(method="GET", meta=meta, dont_filter=True)
+        elif revalidation == "conditional" and response.status == 304:
+            return self._local_response(request, filename)
+        elif response.status == 200 and headers:
+            if "streamed" in response.flags:
+                size = Path(filename).stat().st_size
+            else:
+                size = len(response.body)
+            save_validators(filename, headers, size=size)
+        return response
+
+    def _local_response(self, request, filename):
+        request.meta["download_to"] = filename
+        return Response(
+            url=request.url,
+            status=200,
+            request=request,
+            flags=["revalidated"],
+        )
+
+
+class HostState:
+    """Concurrency, delay and what was observed in the current window for a host"""
+
+    def __init__(self, domain, start=1, min=1, max=4, mirror_fallback=False):
+        self.domain = domain
+        self.concurrency = start
+        self.min_concurrency = min
+        self.max_concurrency = max
+        self.ceiling = max  # Lowered when the host throttles us
+        self.clean_windows = 0
+        self.mirror_fallback = mirror_fallback
+        self.delay = 0.0
+        self.use_mirror = False
+        self.slow_windows = 0
+        self.throttled_at = 0.0
+        self.last_throughput = None
+        self.best_latency = None
+        self.reset(time.monotonic())
+
+    def reset(self, now):
+        self.window_start = now
+        self.bytes = self.responses = self.errors = self.throttled = 0
+        self.latency = 0.0
+        self.retry_after = 0
+
+
+class AdaptiveConcurrencyMiddleware:
+    """Adjust the concurrency and delay of each host from what is observed
+
+    Requests to the hosts in `ADAPTIVE_CONCURRENCY_HOSTS` (`{domain: {"start":
+    N, "min": N, "max": N, "mirror_fallback": bool}}`, also matching their
+    subdomains) use one downloader slot per domain. Every
+    `ADAPTIVE_CONCURRENCY_WINDOW` seconds the throughput (bytes received per
+    second), mean latency, errors and 429/503 responses of the window are
+    checked: if the host is throttling us (or more than 10% of the requests
+    failed), the concurrency is halved and the delay is doubled (at least the
+    `Retry-After`, at most `ADAPTIVE_CONCURRENCY_MAX_DELAY`); otherwise the
+    delay decays and the concurrency is increased by one while the throughput
+    increases and decreased by one if it dropped and the latency is more than
+    twice the best one (the link or the server is saturated). The
+    concurrency which was throttled is not used again until ten windows
+    without errors have passed. If a host with
+    `mirror_fallback` transfers less than `MIRROR_FALLBACK_MIN_SPEED` bytes
+    per second per request for two windows, the next requests are made to the
+    mirror (`spider.make_mirror_url`).
+    """
+
+    throttle_codes = (429, 503)
+
+    def __init__(self, crawler, hosts, window=30, max_delay=60, min_speed=0):
+        self.crawler = crawler
+        self.hosts = {
+            domain: HostState(domain, **config) for domain, config in hosts.items()
+        }
+        self.window = window
+        self.max_delay = max_delay
+        self.min_speed = min_speed
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            crawler,
+            hosts=settings.getdict("ADAPTIVE_CONCURRENCY_HOSTS"),
+            window=settings.getfloat("ADAPTIVE_CONCURRENCY_WINDOW", 30),
+            max_delay=settings.getfloat("ADAPTIVE_CONCURRENCY_MAX_DELAY", 60),
+            min_speed=settings.getint("MIRROR_FALLBACK_MIN_SPEED", 0),
+        )
+
+    def host_state(self, request):
+        hostname = urlparse_cached(request).hostname or ""
+        for domain, state in self.hosts.items():
+            if hostname == domain or hostname.endswith("." + domain):
+                return state
+        return None
+
+    def process_request(self, request, spider):
+        state = self.host_state(request)
+        if state is None:
+            return None
+        if state.use_mirror and hasattr(spider, "make_mirror_url"):
+            meta = dict(request.meta)
+            meta.pop("download_slot", None)
+            return request.replace(
+                url=spider.make_mirror_url(request.url), meta=meta, dont_filter=True
+            )
+        request.meta["download_slot"] = state.domain
+        request.meta["adaptive_start"] = time.monotonic()
+        self.apply(state)
+        return None
+
+    def process_response(self, request, response, spider):
+        state = self.host_state(request)
+        if state is None or "cached" in response.flags:
+            return response
+        if response.status in self.throttle_codes:
+            # Requests sent before the concurrency was decreased don't count
+            if request.meta.get("adaptive_start", 0) >= state.throttled_at:
+                state.throttled += 1
+                retry_after = response.headers.get("Retry-After", b"")
+                retry_after = retry_after.decode("ascii", "ignore")
+                if retry_after.isdigit():
+                    state.retry_after = max(state.retry_after, int(retry_after))
+        elif response.status >= 500:
+            state.errors += 1
+        elif "revalidated" not in response.flags:
+            if "streamed" in response.flags:
+                size = int(response.headers.get("Content-Length", 0))
+            else:
+                size = len(response.body)
+            if size:  # Not skipped (like streamed files already downloaded)
+                state.responses += 1
+                state.bytes += size
+                state.latency += self.latency(request)
+        self.update(state)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        state = self.host_state(request)
+        if state is not None:
+            state.errors += 1
+            self.update(state)
+
+    def latency(self, request):
+        # `download_start` is set by `StreamingDownloadHandler` when the
+        # transfer starts (requests may wait in the slot's queue before it)
+        start = request.meta.get("download_start", request.meta.get("adaptive_start"))
+        return time.monotonic() - start if start is not None else 0.0
+
+    def update(self, state):
+        now = time.monotonic()
+        elapsed = now - state.window_start
+        if elapsed < self.window:
+            return
+
+        requests = state.responses + state.errors + state.throttled
+        if state.throttled or (requests and state.errors / requests > 0.1):
+            state.ceiling = max(state.min_concurrency, state.concurrency - 1)
+            state.clean_windows = 0
+            state.throttled_at = now
+            state.concurrency = max(state.min_concurrency, state.concurrency // 2)
+            state.delay = min(
+                self.max_delay, max(state.delay * 2, state.retry_after, 1.0)
+            )
+            state.last_throughput = None
+        elif state.responses:
+            throughput = state.bytes / elapsed
+            latency = state.latency / state.responses
+            state.delay = state.delay / 2 if state.delay >= 0.1 else 0.0
+            state.clean_windows += 1
+            if state.clean_windows % 10 == 0:  # Probe again if the limit changed
+                state.ceiling = min(state.max_concurrency, state.ceiling + 1)
+            if state.best_latency is None or latency < state.best_latency:
+                state.best_latency = latency
+            last_throughput = state.last_throughput
+            if last_throughput is None or throughput > last_throughput * 1.1:
+                state.concurrency = min(state.ceiling, state.concurrency + 1)
+            elif throughput < last_throughput * 0.9 and latency > 2 * state.best_latency:
+                state.concurrency = max(state.min_concurrency, state.concurrency - 1)
+            state.last_throughput = throughput
+
+            speed = state.bytes / state.latency if state.latency else throughput
+            if state.mirror_fallback and speed < self.min_speed:
+                state.slow_windows += 1
+                if state.slow_windows >= 2 and not state.use_mirror:
+                    state.use_mirror = True
+                    self.crawler.spider.logger.warning(
+                        f"{state.domain} is slow ({speed / 1024:.0f} KiB/s per "
+                        "request), using the mirror"
+                    )
+            else:
+                state.slow_windows = 0
+        else:  # Nothing finished in this window: keep measuring
+            return
+
+        prefix = f"adaptive_concurrency/{state.domain}"
+        self.crawler.stats.set_value(f"{prefix}/concurrency", state.concurrency)
+        self.crawler.stats.set_value(f"{prefix}/delay", state.delay)
+        self.apply(state)
+        state.reset(now)
+
+    def apply(self, state):
+        downloader = self.crawler.engine.downloader
+        # Slots not used for some time are removed by the downloader and
+        # created again from `per_slot_settings`
+        downloader.per_slot_settings[state.domain] = {
+            "concurrency": state.concurrency,
+            "delay": state.delay,
+        }
+        slot = downloader.slots.get(state.domain)
+        if slot is not None:
+            slot.concurrency = state.concurrency
+            slot.delay = state.delay
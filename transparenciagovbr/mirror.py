@@ -0,0 +1,135 @@
+"""Mirror the spiders' archives: download them and upload each one with s3cmd
+
+The archives are downloaded concurrently (by `download_file`: in segments,
+resumable and with a limit of connections per host) and each one is
+uploaded (`s3cmd put`) as soon as its download finishes, while the next ones
+are still being downloaded. Archives downloaded by the mirror are removed
+after the upload (unless `--keep` is used); the ones which were already in
+`DOWNLOAD_PATH` are only uploaded.
+
+Usage: python -m transparenciagovbr.mirror [--downloads N] [--uploads N] [--connections-per-host N] [--keep] [--mirror-uri URI] [--plan FILENAME] [--shard I/N] [spider ...]
+"""
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from tqdm import tqdm
+
+from transparenciagovbr.plan import load_plan, parse_shard, plan, select_shard
+from transparenciagovbr.utils.download import HostLimiter, download_file
+
+
+MIRROR_URI = "s3://mirror/transparenciagovbr"
+
+
+def spider_archives(spider_names=None, mirror_uri=MIRROR_URI, entries=None):
+    """Return `{url: (filename, [mirror URI, ...])}` for the spiders' archives
+
+    The archives are the ones in the plan of the spiders (or in `entries`,
+    like a plan loaded from a file - see `transparenciagovbr.plan`). Archives
+    used by more than one spider (like the despesas ones) are downloaded once
+    and uploaded to the mirror path of each spider.
+    """
+
+    result = {}
+    for entry in entries if entries is not None else plan(spider_names):
+        name = urlparse(entry.url).path.rsplit("/", maxsplit=1)[-1]
+        _, uris = result.setdefault(entry.url, (entry.filename, []))
+        uris.append(f"{mirror_uri}/{entry.spider}/{name}")
+    return result
+
+
+def s3cmd_put(filename, uri):
+    subprocess.run(["s3cmd", "put", str(filename), uri], check=True)
+
+
+def mirror(
+    archives,
+    downloads=4,
+    uploads=2,
+    max_per_host=4,
+    keep=False,
+    upload=s3cmd_put,
+    **download_kwargs,
+):
+    """Download `archives` (see `spider_archives`) and upload them, returning the failed URLs"""
+
+    limiter = HostLimiter(max_per_host)
+    failed = []
+
+    def upload_archive(filename, uris, remove):
+        for uri in uris:
+            upload(filename, uri)
+        if remove:
+            filename.unlink()
+
+    with ThreadPoolExecutor(max_workers=uploads) as upload_executor:
+        upload_futures, download_futures = {}, {}
+        with ThreadPoolExecutor(max_workers=downloads) as download_executor:
+            for url, (filename, uris) in archives.items():
+                if filename.exists():  # Downloaded before (by the spiders)
+                    future = upload_executor.submit(upload_archive, filename, uris, False)
+                    upload_futures[future] = url
+                else:
+                    future = download_executor.submit(
+                        download_file, url, filename, limiter=limiter, **download_kwargs
+                    )
+                    download_futures[future] = url
+
+            progress = tqdm(as_completed(download_futures), total=len(download_futures))
+            for future in progress:
+                url = download_futures[future]
+                filename, uris = archives[url]
+                try:
+                    status, _ = future.result()
+                except Exception as exception:
+                    status = exception
+                if status != 200:
+                    print(f"ERROR: could not download {url}: {status}")
+                    failed.append(url)
+                    continue
+                future = upload_executor.submit(upload_archive, filename, uris, not keep)
+                upload_futures[future] = url
+
+        for future in as_completed(upload_futures):
+            try:
+                future.result()
+            except Exception as exception:
+                print(f"ERROR: could not upload {upload_futures[future]}: {exception}")
+                failed.append(upload_futures[future])
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--downloads", type=int, default=4, help="Concurrent downloads")
+    parser.add_argument("--uploads", type=int, default=2, help="Concurrent uploads")
+    parser.add_argument("--connections-per-host", type=int, default=8)
+    parser.add_argument("--segments", type=int, default=4, help="Segments per download")
+    parser.add_argument("--keep", action="store_true", help="Keep the downloaded archives")
+    parser.add_argument("--mirror-uri", default=MIRROR_URI)
+    parser.add_argument("--plan", help="Plan file (see transparenciagovbr.plan)")
+    parser.add_argument("--shard", type=parse_shard, help="Only the shard I of N (I/N)")
+    parser.add_argument("spider_names", nargs="*")
+    args = parser.parse_args()
+
+    entries = load_plan(args.plan) if args.plan else plan(args.spider_names)
+    if args.spider_names:
+        entries = [entry for entry in entries if entry.spider in args.spider_names]
+    if args.shard:
+        entries = select_shard(entries, *args.shard)
+    archives = spider_archives(mirror_uri=args.mirror_uri, entries=entries)
+    failed = mirror(
+        archives,
+        downloads=args.downloads,
+        uploads=args.uploads,
+        max_per_host=args.connections_per_host,
+        keep=args.keep,
+        segments=args.segments,
+    )
+    print(f"{len(archives) - len(failed)} archives mirrored, {len(failed)} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,233 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import threads
+
+from transparenciagovbr.load import quote, table_field_types
+
+
+POSTGRESQL_TYPES = {
+    "bool": "BOOLEAN",
+    "date": "DATE",
+    "decimal": "NUMERIC",
+    "integer": "BIGINT",
+    "text": "TEXT",
+}
 
 
 class TransparenciagovbrPipeline(object):
     def process_item(self, item, spider):
         return item
+
+
+class PostgreSQLPipeline:
+    """Load the items into PostgreSQL using `COPY`, while the spider runs
+
+    Items are written (as CSV) to a buffer per table (the spider's name or
+    the item's `table` attribute, for spiders with more than one table) and
+    each `POSTGRESQL_BATCH_SIZE` items are sent with `COPY` to a staging
+    table (`<table>_staging`), using a pool of `POSTGRESQL_POOL_SIZE`
+    connections (one thread per connection; all the statements run in
+    threads, so the Scrapy reactor is not blocked). The period of each row is
+    written to the column `periodo_arquivo`. When the spider finishes, the
+    staging table replaces the table atomically (in incremental mode, the
+    table's rows of the periods loaded are replaced by the staging table's).
+    If the spider doesn't finish, the table is not changed.
+
+    Requires psycopg2 (`pip install psycopg2-binary`) and is enabled only if
+    `POSTGRESQL_PIPELINE_ENABLED` is set (`./run.sh --postgresql`), loading
+    into the database at `POSTGRESQL_URI` (by default, the environment
+    variable with the same name).
+    """
+
+    period_column = "periodo_arquivo"
+
+    def __init__(self, uri, batch_size=50_000, pool_size=4):
+        self.uri = uri
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.pool = None
+        self.executor = None
+        self.buffers = {}
+        self.counters = {}
+        self.columns = {}
+        self.created = {}
+        self.pending = []
+        self.failed = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("POSTGRESQL_PIPELINE_ENABLED"):
+            raise NotConfigured("POSTGRESQL_PIPELINE_ENABLED is not set")
+        uri = crawler.settings.get("POSTGRESQL_URI")
+        if not uri:
+            raise ValueError("POSTGRESQL_URI must be set to load into PostgreSQL")
+        pipeline = cls(
+            uri,
+            batch_size=crawler.settings.getint("POSTGRESQL_BATCH_SIZE"),
+            pool_size=crawler.settings.getint("POSTGRESQL_POOL_SIZE"),
+        )
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def connect(self):
+        from psycopg2.pool import ThreadedConnectionPool
+
+        return ThreadedConnectionPool(1, self.pool_size, self.uri)
+
+    def open_spider(self, spider):
+        self.pool = self.connect()
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        spider.rows_with_period = True  # Rows have the period of their archive
+
+    def execute(self, *statements):
+        """Execute SQL statements in one transaction"""
+
+        connection = self.pool.getconn()
+        try:
+            with connection:  # Commits (or rolls back) the transaction
+                with connection.cursor() as cursor:
+                    for statement in statements:
+                        cursor.execute(statement)
+        finally:
+            self.pool.putconn(connection)
+
+    def copy(self, table_name, columns, data):
+        self.created[table_name].result()  # The staging table must exist
+        connection = self.pool.getconn()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(
+                        "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+                            quote(f"{table_name}_staging"),
+                            ", ".join(quote(column) for column in columns),
+                        ),
+                        io.StringIO(data),
+                    )
+        finally:
+            self.pool.putconn(connection)
+
+    def create_staging_table(self, table_name, columns):
+        field_types = table_field_types(table_name)
+        field_types[self.period_column] = "date"
+        definitions = ", ".join(
+            "{} {}".format(
+                quote(column),
+                POSTGRESQL_TYPES.get(field_types.get(column), POSTGRESQL_TYPES["text"]),
+            )
+            for column in columns
+        )
+        staging = quote(f"{table_name}_staging")
+        self.execute(
+            f"DROP TABLE IF EXISTS {staging}",
+            f"CREATE TABLE {staging} ({definitions})",
+        )
+
+    def process_item(self, item, spider):
+        table_name = getattr(item, "table", None) or spider.name
+        adapter = ItemAdapter(item)
+        if table_name not in self.buffers:
+            columns = list(adapter.field_names()) + [self.period_column]
+            self.columns[table_name] = columns
+            # Created by a connection thread before the batches are sent
+            self.created[table_name] = self.executor.submit(
+                self.create_staging_table, table_name, self.columns[table_name]
+            )
+            self.buffers[table_name] = io.StringIO()
+            self.counters[table_name] = 0
+        values = [adapter.get(column) for column in self.columns[table_name][:-1]]
+        values.append(getattr(item, "period", None))
+        csv.writer(self.buffers[table_name]).writerow(values)
+        self.counters[table_name] += 1
+        if self.counters[table_name] >= self.batch_size:
+            self.flush(table_name)
+            # Don't keep more batches in memory than the connections can send
+            # (waiting in a thread, so the reactor is not blocked)
+            if len(self.pending) > 2 * self.pool_size:
+                result = threads.deferToThread(
+                    wait, self.pending[: len(self.pending) - self.pool_size]
+                )
+                result.addCallback(lambda _: self.check_done())
+                result.addCallback(lambda _: item)
+                return result
+            self.check_done()
+        return item
+
+    def flush(self, table_name):
+        if not self.counters[table_name]:
+            return
+        data = self.buffers[table_name].getvalue()
+        self.buffers[table_name] = io.StringIO()
+        self.counters[table_name] = 0
+        columns = self.columns[table_name]
+        self.pending.append(self.executor.submit(self.copy, table_name, columns, data))
+
+    def check(self, future):
+        """Raise the exception of a `COPY` (if any), so the table is not replaced"""
+
+        try:
+            future.result()
+        except Exception:
+            self.failed = True
+            raise
+
+    def check_done(self):
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.remove(future)
+            self.check(future)
+
+    def finish_copies(self):
+        self.executor.shutdown(wait=True)
+        for future in self.pending:
+            self.check(future)
+
+    def close_spider(self, spider):
+        for table_name in self.buffers:
+            self.flush(table_name)
+        return threads.deferToThread(self.finish_copies)
+
+    def swap_tables(self, table_name, append=False):
+        table, staging = quote(table_name), quote(f"{table_name}_staging")
+        old = quote(f"{table_name}_old")
+        if append:
+            columns = ", ".join(quote(column) for column in self.columns[table_name])
+            period = quote(self.period_column)
+            statements = [
+                f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM {staging} LIMIT 0",
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {period} DATE",
+                # Periods converted again (their archive changed) are replaced
+                f"DELETE FROM {table} WHERE {period} IN (SELECT {period} FROM {staging})",
+                f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}",
+                f"DROP TABLE {staging}",
+            ]
+        else:
+            statements = [
+                f"DROP TABLE IF EXISTS {old}",
+                f"ALTER TABLE IF EXISTS {table} RENAME TO {old}",
+                f"ALTER TABLE {staging} RENAME TO {table}",
+                f"DROP TABLE IF EXISTS {old}",
+            ]
+        self.execute(*statements)
+
+    def finish_tables(self, spider, reason):
+        try:
+            for table_name in self.buffers:
+                if reason == "finished" and not self.failed:
+                    incremental = getattr(spider, "incremental", False)
+                    self.swap_tables(table_name, append=incremental)
+                else:
+                    staging = quote(f"{table_name}_staging")
+                    self.execute(f"DROP TABLE IF EXISTS {staging}")
+        finally:
+            self.pool.closeall()
+
+    def spider_closed(self, spider, reason):
+        return threads.deferToThread(self.finish_tables, spider, reason)
@@ -0,0 +1,122 @@
+"""Plan of the archives of each spider: period, URL, local filename and mirror URL
+
+The plan is built once for each spider (and cached): one entry per period,
+from the spider's `start_date` (inclusive) to its `end_date` (exclusive) each
+`publish_frequency`. It's used by the spiders (`start_requests`), the mirror
+and the converter instead of each one building the URLs, and it can be saved
+to a CSV file (`--output`), so all the nodes of a crawl use the same plan,
+and split in shards (`--shard I/N`, also a spider argument: `-a shard=I/N`)
+by hashing the period, so the archives of a period used by more than one
+spider (like the despesas ones) are in the same shard.
+
+Usage: python -m transparenciagovbr.plan [--shard I/N] [--output FILENAME] [spider ...]
+"""
+import argparse
+import csv
+import hashlib
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+from scrapy import spiderloader
+from scrapy.utils import project
+
+from transparenciagovbr.utils.date import date_range
+
+
+FIELDS = ("spider", "period", "url", "filename", "mirror_url")
+PlanEntry = namedtuple("PlanEntry", FIELDS)
+_plans = {}
+
+
+def spider_plan(spider):
+    """Return the plan (a tuple of `PlanEntry`) of a spider, in date order"""
+
+    key = (spider.name, spider.start_date, spider.end_date, spider.publish_frequency)
+    if key not in _plans:
+        entries = []
+        for date in date_range(spider.start_date, spider.end_date, spider.publish_frequency):
+            url = spider.make_url(date)
+            entries.append(
+                PlanEntry(
+                    spider=spider.name,
+                    period=date.isoformat(),
+                    url=url,
+                    filename=spider.make_filename(url),
+                    mirror_url=spider.make_mirror_url(url),
+                )
+            )
+        _plans[key] = tuple(entries)
+    return _plans[key]
+
+
+def plan(spider_names=None):
+    """Return the plan of the spiders (all of them, if `spider_names` is not given)"""
+
+    settings = project.get_project_settings()
+    spider_loader = spiderloader.SpiderLoader.from_settings(settings)
+    entries = []
+    for spider_name in spider_names or spider_loader.list():
+        entries.extend(spider_plan(spider_loader.load(spider_name)()))
+    return entries
+
+
+def parse_shard(value):
+    """Return `(index, shards)` from a string like `"0/4"`"""
+
+    index, shards = (int(part) for part in value.split("/"))
+    if not 0 <= index < shards:
+        raise ValueError(f"Invalid shard: {value}")
+    return index, shards
+
+
+def period_shard(period, shards):
+    digest = hashlib.sha1(period.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def select_shard(entries, index, shards):
+    """Return the entries whose period is in the shard `index` (of `shards`)"""
+
+    return [entry for entry in entries if period_shard(entry.period, shards) == index]
+
+
+def write_plan(entries, fobj):
+    writer = csv.writer(fobj)
+    writer.writerow(FIELDS)
+    writer.writerows(entries)
+
+
+def save_plan(entries, filename):
+    with open(filename, mode="w", newline="") as fobj:
+        write_plan(entries, fobj)
+
+
+def load_plan(filename):
+    with open(filename, newline="") as fobj:
+        reader = csv.reader(fobj)
+        assert tuple(next(reader)) == FIELDS, f"Invalid plan file: {filename}"
+        return [
+            PlanEntry(spider, period, url, Path(archive_filename), mirror_url)
+            for spider, period, url, archive_filename, mirror_url in reader
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard", type=parse_shard, help="Only the shard I of N (I/N)")
+    parser.add_argument("--output", help="CSV file to save the plan (default: stdout)")
+    parser.add_argument("spider_names", nargs="*")
+    args = parser.parse_args()
+
+    entries = plan(args.spider_names)
+    if args.shard:
+        entries = select_shard(entries, *args.shard)
+    if args.output:
+        save_plan(entries, args.output)
+    else:
+        write_plan(entries, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
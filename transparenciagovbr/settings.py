@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 from pathlib import Path
 
 # Scrapy settings for transparenciagovbr project
@@ -54,21 +55,58 @@ ROBOTSTXT_OBEY = False
 
 # Enable or disable downloader middlewares
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'transparenciagovbr.middlewares.TransparenciagovbrDownloaderMiddleware': 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    "transparenciagovbr.middlewares.RevalidationMiddleware": 950,
+    "transparenciagovbr.middlewares.AdaptiveConcurrencyMiddleware": 960,
+}
+# How archives already downloaded are checked for changes (when the spiders
+# run with `-a revalidate=true`): "conditional" (GET with If-None-Match and
+# If-Modified-Since) or "head" (HEAD request and then GET if changed)
+REVALIDATION_METHOD = "conditional"
+# Concurrency per host, adjusted from the throughput, latency and 429/503
+# responses observed (see `AdaptiveConcurrencyMiddleware`, used instead of
+# AutoThrottle). The Portal blocks clients making too many requests, so it
+# starts low; the mirror (data.brasil.io) is served by object storage. The
+# segments of streamed downloads (`DOWNLOAD_SEGMENTS` connections each) count
+# against the concurrency of their host.
+ADAPTIVE_CONCURRENCY_HOSTS = {
+    "transparencia.gov.br": {"start": 2, "min": 1, "max": 4, "mirror_fallback": True},
+    "portaldatransparencia.gov.br": {"start": 2, "min": 1, "max": 4, "mirror_fallback": True},
+    "portaltransparencia.gov.br": {"start": 2, "min": 1, "max": 4, "mirror_fallback": True},
+    "data.brasil.io": {"start": 4, "min": 2, "max": 16},
+}
+ADAPTIVE_CONCURRENCY_WINDOW = 30  # Seconds
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 60  # Seconds
+# Archives from the Portal are downloaded from the mirror if the Portal sends
+# less than this (bytes per second per request) for two windows
+MIRROR_FALLBACK_MIN_SPEED = 256 * 1024
 
 # Enable or disable extensions
 # See https://doc.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-# }
+EXTENSIONS = {
+    "transparenciagovbr.extensions.MetricsExtension": 500,
+}
+# Time spent in each stage (download, unzip, parse, deserialize, export and
+# compression), bytes and rows of each archive and of the whole crawl, written
+# to `METRICS_PATH/<spider>.jsonl` (`./run.sh --metrics`; disabled by default
+# since every row is timed). The totals can also be served in the Prometheus
+# text format (`http://METRICS_PROMETHEUS_HOST:METRICS_PROMETHEUS_PORT/metrics`).
+METRICS_ENABLED = False
+METRICS_INTERVAL = 60  # Seconds between the totals written to the file
+METRICS_PROMETHEUS_HOST = "127.0.0.1"
+METRICS_PROMETHEUS_PORT = None
 
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
-#    'transparenciagovbr.pipelines.TransparenciagovbrPipeline': 300,
-# }
+ITEM_PIPELINES = {
+    "transparenciagovbr.pipelines.PostgreSQLPipeline": 300,
+}
+# Items are loaded into PostgreSQL while crawling only if enabled (like with
+# `./run.sh --postgresql`); the URI is also used by `import-postgresql.sh`
+POSTGRESQL_PIPELINE_ENABLED = False
+POSTGRESQL_URI = os.environ.get("POSTGRESQL_URI")
+POSTGRESQL_BATCH_SIZE = 50_000
+POSTGRESQL_POOL_SIZE = 4
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -89,12 +127,51 @@ HTTPCACHE_ENABLED = True
 HTTPCACHE_EXPIRATION_SECS = 0
 HTTPCACHE_DIR = "httpcache"
 HTTPCACHE_IGNORE_HTTP_CODES = []
-HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
-
-FEED_EXPORTERS = {"csv.gz": "transparenciagovbr.exporters.GzipCsvItemExporter"}
+# Cached archives are hard links to the files in `DOWNLOAD_PATH`
+HTTPCACHE_STORAGE = "transparenciagovbr.httpcache.LinkedFilesystemCacheStorage"
+
+# Streams bodies of requests having `download_to` in meta directly to the disk
+# (used by spiders running with `-a stream_download=true`)
+DOWNLOAD_HANDLERS = {
+    "http": "transparenciagovbr.handlers.StreamingDownloadHandler",
+    "https": "transparenciagovbr.handlers.StreamingDownloadHandler",
+}
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Streamed downloads use concurrent Range requests (when supported by the
+# server) of at least `DOWNLOAD_SEGMENT_MIN_SIZE` bytes and are resumable
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+DOWNLOAD_MAX_CONNECTIONS_PER_HOST = 8
+
+FEED_EXPORTERS = {
+    "csv.gz": "transparenciagovbr.exporters.GzipCsvItemExporter",
+    "csv.lz4": "transparenciagovbr.exporters.Lz4CsvItemExporter",
+    "csv.xz": "transparenciagovbr.exporters.XzCsvItemExporter",
+    "csv.zst": "transparenciagovbr.exporters.ZstdCsvItemExporter",
+    "parquet": "transparenciagovbr.exporters.ParquetItemExporter",
+    "partitioned": "transparenciagovbr.exporters.PartitionedItemExporter",
+}
 FEED_FORMAT = "csv.gz"
+# Compression of the CSV feeds (can also be set with `-a compression_level=N`
+# and `-a compression_threads=N`). Level `None` uses the codec's default (9
+# for gzip) and threads > 0 compresses blocks in parallel.
+FEED_COMPRESSION_LEVEL = None
+FEED_COMPRESSION_THREADS = 0
+FEED_COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+# Fields to index in the compressed CSV feeds (like `codigo_favorecido`; can
+# also be set with `-a index_fields=field1,field2`), see `utils/blockindex.py`
+FEED_INDEX_FIELDS = []
+PARQUET_ROW_GROUP_SIZE = 100_000
+PARQUET_COMPRESSION = "zstd"
+# Partitioned output (`-t partitioned`): format of the part files (`None` uses
+# `FEED_FORMAT`) and how many of them can be open at the same time
+PARTITION_FORMAT = None
+PARTITION_MAX_OPEN_FILES = 4
 
 REPOSITORY_PATH = Path(__file__).parent.parent
 DOWNLOAD_PATH = REPOSITORY_PATH / "data" / "download"
+MANIFEST_PATH = REPOSITORY_PATH / "data" / "manifest"
+OUTPUT_PATH = REPOSITORY_PATH / "data" / "output"
+METRICS_PATH = REPOSITORY_PATH / "data" / "metrics"
 
 DOWNLOAD_WARNSIZE = 2 * 1024 * 1024 * 1024
@@ -2,19 +2,14 @@ import datetime
 
 from transparenciagovbr.spiders.base import TransparenciaBaseSpider
 from transparenciagovbr.utils.cities import city_name_by_id
-from transparenciagovbr.utils.date import today
-
-day = today()
-last_month = day.month - 1 if day.month > 1 else 12
-year = day.year if day.month > 1 else day.year - 1
-end_date = datetime.date(year, last_month, day.day)
+from transparenciagovbr.utils.date import add_months, today
 
 
 class AuxilioEmergencialSpider(TransparenciaBaseSpider):
     name = "auxilio_emergencial"
     base_url = "http://transparencia.gov.br/download-de-dados/auxilio-emergencial/{year}{month:02d}"
     start_date = datetime.date(2020, 4, 1)
-    end_date = end_date
+    end_date = add_months(today(), -1)  # Day 31 becomes the last day of the previous month
     publish_frequency = "monthly"
     filename_suffix = "_AuxilioEmergencial.csv"
     schema_filename = "auxilio_emergencial.csv"
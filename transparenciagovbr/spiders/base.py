@@ -1,27 +1,40 @@
-import csv
+import datetime
 import io
-import zipfile
+from pathlib import Path
 from urllib.parse import urlparse
 
 import scrapy
 from cached_property import cached_property
+from scrapy import signals
 
 from transparenciagovbr import settings
-from transparenciagovbr.utils.date import date_range, date_to_dict
-from transparenciagovbr.utils.fields import Schema
-from transparenciagovbr.utils.io import parse_zip
+from transparenciagovbr.items import Row
+from transparenciagovbr.plan import parse_shard, select_shard, spider_plan
+from transparenciagovbr.utils.blockindex import INDEX_SUFFIX
+from transparenciagovbr.utils.date import date_to_dict
+from transparenciagovbr.utils.download import write_file
+from transparenciagovbr.utils.fields import get_schema
+from transparenciagovbr.utils.io import parse_zip_csvs
+from transparenciagovbr.utils.manifest import Manifest
+from transparenciagovbr.utils.metrics import timed_rows
+from transparenciagovbr.utils.partition import PartitionIndex, partition_keys, partition_path
 
 
-def parse_csv_rows(filename_or_fobj, inner_filename_suffix, encoding, schema):
-    data = parse_zip(
+def parse_csv_rows(filename_or_fobj, inner_filename_suffix, encoding, schema, metrics=None):
+    data = parse_zip_csvs(
         filename_or_fobj=filename_or_fobj,
         inner_filename_suffix=inner_filename_suffix,
         encoding=encoding,
+        metrics=metrics,
     )
-    for row in data:
-        new = schema.deserialize(row)
-        if new is not None:
-            yield new
+    for header, reader in data:
+        deserialize = schema.compile(header)
+        if metrics is not None:
+            yield from timed_rows(reader, deserialize, metrics)
+            continue
+        for values in reader:
+            if values:  # Skip blank lines (as `csv.DictReader` does)
+                yield deserialize(values)
 
 
 class TransparenciaBaseSpider(scrapy.Spider):
@@ -35,49 +48,312 @@ class TransparenciaBaseSpider(scrapy.Spider):
     }
     encoding = "iso-8859-1"
     mirror_url = "https://data.brasil.io/mirror/transparenciagovbr/{dataset}/{filename}"
+    metrics = None  # Set by `MetricsExtension`, if enabled
+    rows_with_period = False  # Set by `PostgreSQLPipeline`, if enabled
 
 
-    def __init__(self, use_mirror="False", save_file="True", *args, **kwargs):
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.feeds_stored, signal=signals.feed_exporter_closed)
+        return spider
+
+    def __init__(
+        self,
+        use_mirror="False",
+        save_file="True",
+        stream_download="False",
+        incremental="False",
+        revalidate="False",
+        shard=None,
+        *args,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
+        self.shard = parse_shard(shard) if shard else None
         self.use_mirror = use_mirror.lower() == "true"
         self.save_file = save_file.lower() == "true"
+        self.stream_download = stream_download.lower() == "true"
+        self.incremental = incremental.lower() == "true"
+        self.revalidate = revalidate.lower() == "true"
+        self.manifest = Manifest.for_spider(self.name)
+        if not self.incremental:  # The whole output will be regenerated
+            self.manifest.clear()
+        # Identifies the parts written by this run (see `PartitionedItemExporter`)
+        self.run_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        self.requested = set()  # Periods requested in this run
+        self.converted = set()  # Periods converted in this run
+        self.replaced = {}  # Previous outputs being replaced (see `replace_output`)
+        self.close_reason = None
+
+    @property
+    def partition(self):
+        """Name of the output file (the first feed) the rows are written to"""
+
+        if not hasattr(self, "settings"):  # Not running inside a crawler
+            return None
+        feeds = list(self.settings.getdict("FEEDS").keys())
+        return feeds[0].rsplit("/", maxsplit=1)[-1] if feeds else None
+
+    @property
+    def feed_paths(self):
+        """Paths of the feeds' files (the partitions' indexes, if partitioned)"""
+
+        if not hasattr(self, "settings"):  # Not running inside a crawler
+            return []
+        return [
+            Path(uri[len("file://") :] if uri.startswith("file://") else uri)
+            for uri in self.settings.getdict("FEEDS").keys()
+        ]
+
+    def output_paths(self, partition):
+        """Paths of the output `partition` (one per feed), to record in the manifest"""
+
+        if self.partitioned:
+            return [str(path.parent / partition) for path in self.feed_paths]
+        return [str(path) for path in self.feed_paths]
+
+    @cached_property
+    def partitioned(self):
+        """`True` if the rows are written to partitions by period (feed format `partitioned`)"""
+
+        if not hasattr(self, "settings"):  # Not running inside a crawler
+            return False
+        feeds = self.settings.getdict("FEEDS").values()
+        return any(feed_options.get("format") == "partitioned" for feed_options in feeds)
 
     @property
     def schema(self):
-        return Schema(self.schema_filename)
+        return get_schema(self.schema_filename)
 
     def make_filename(self, url):
         return settings.DOWNLOAD_PATH / self.name / urlparse(url).path.rsplit("/", maxsplit=1)[-1]
 
+    def make_temp_filename(self, url):
+        return settings.DOWNLOAD_PATH / "tmp" / self.name / urlparse(url).path.rsplit("/", maxsplit=1)[-1]
+
+    def make_url(self, date):
+        return self.base_url.format(**date_to_dict(date))
+
+    def make_mirror_url(self, url):
+        return self.mirror_url.format(
+            dataset=self.name, filename=urlparse(url).path.rsplit("/", maxsplit=1)[-1]
+        )
+
+    def plan(self):
+        """Return the plan entries (see `transparenciagovbr.plan`) to crawl"""
+
+        entries = spider_plan(self)
+        if self.shard is not None:
+            entries = select_shard(entries, *self.shard)
+        return entries
+
     def start_requests(self):
-        for date in date_range(
-            start=self.start_date, stop=self.end_date, interval=self.publish_frequency
-        ):
-            url = self.base_url.format(**date_to_dict(date))
-            if self.use_mirror:
-                url = self.mirror_url.format(
-                    dataset=self.name,
-                    filename=urlparse(url).path.rsplit("/", maxsplit=1)[-1],
-                )
-            elif self.save_file:
+        for entry in self.plan():
+            if entry.period in self.requested:  # To replace a previous output
+                continue
+            # When revalidating, the archive may have changed in the server
+            # (this is checked after the response is received)
+            elif self.incremental and not self.revalidate:
+                if self.manifest.is_current(entry.period, entry.filename):
+                    self.logger.debug(f"Skipping period {entry.period} (already converted)")
+                    continue
+                elif entry.period in self.manifest:  # The archive changed
+                    yield from self.replace_output(entry.period)
+                    if entry.period in self.requested:
+                        continue
+            yield self.make_request(entry)
+
+    def replace_output(self, period):
+        """Convert again all the periods in the previous output of `period`
+
+        The rows of a period converted again can't be removed from its
+        previous output (a file or a partition, shared with other periods),
+        so all the periods in it are converted again (this method yields the
+        requests for the ones not requested yet) and it's removed when the
+        crawl finishes (see `remove_replaced_outputs`).
+        """
+
+        entry = self.manifest.get(period)
+        partition = entry.get("partition")
+        if partition is None or partition in self.replaced:
+            return
+        paths = entry.get("outputs") or [
+            str(path.parent / partition) for path in self.feed_paths
+        ]
+        periods = self.manifest.periods_in(partition)
+        self.replaced[partition] = (periods, paths)
+        self.logger.info(
+            f"Period {period} changed: replacing output {partition} ({len(periods)} periods)"
+        )
+        entries = {entry.period: entry for entry in spider_plan(self)}
+        for other_period in periods:
+            if other_period not in self.requested and other_period in entries:
+                yield self.make_request(entries[other_period], replacing=True)
+
+    def make_request(self, entry, replacing=False):
+        url, period, filename = entry.url, entry.period, entry.filename
+        self.requested.add(period)
+        meta = {"period": period}
+        if replacing:  # Converted even if the archive didn't change
+            meta["replacing"] = True
+        if self.save_file:
+            meta["archive_filename"] = str(filename)
+        if self.revalidate:
+            # The conditional request is made by `RevalidationMiddleware`
+            meta.update({"revalidate": True, "dont_cache": True})
+        if self.use_mirror:
+            url = entry.mirror_url
+        elif self.save_file and not self.stream_download and not self.revalidate:
+            if filename.exists():
+                url = f"file://{filename.absolute()}"
+        if self.stream_download:
+            # The download handler will write the body directly to this
+            # path (or skip the download if it already exists)
+            if self.save_file:
                 filename = self.make_filename(url)
-                if filename.exists():
-                    url = f"file://{filename.absolute()}"
-            yield scrapy.Request(url, callback=self.parse_zip_response)
+            else:
+                filename = self.make_temp_filename(url)
+            meta.update({"download_to": str(filename), "dont_cache": True})
+        return scrapy.Request(url, callback=self.parse_zip_response, meta=meta)
+
+    def open_zip_response(self, response):
+        """Return the filename or file object to read the response's ZIP from"""
+
+        # If the body was streamed by the download handler, it's already on
+        # the disk (and the response body is empty).
+        if "download_to" in response.meta:
+            return response.meta["download_to"]
 
-    def parse_zip_response(self, response):
         # If it's set to save file and the response comes from the Web, then
-        # save it to the disk.
-        if self.save_file and not response.request.url.startswith("file://"):
-            filename = self.make_filename(response.request.url)
-            if not filename.parent.exists():
-                filename.parent.mkdir(parents=True)
-            with open(filename, mode="wb") as fobj:
-                fobj.write(response.body)
-
-        yield from parse_csv_rows(
-            filename_or_fobj=io.BytesIO(response.body),
+        # save it to the disk (unless the HTTP cache storage already did it).
+        # The file is replaced (not overwritten), since it may be a hard link
+        # to the cache.
+        if (
+            self.save_file
+            and not response.request.url.startswith("file://")
+            and not response.meta.get("archive_saved")
+        ):
+            write_file(self.make_filename(response.request.url), response.body)
+
+        return io.BytesIO(response.body)
+
+    def close_zip_response(self, response):
+        # Streamed files which should not be saved are removed after parsing
+        if "download_to" in response.meta and not self.save_file:
+            Path(response.meta["download_to"]).unlink()
+
+    def convert_row(self, row):
+        """Change a deserialized row before it's returned (must return the row)"""
+
+        return row
+
+    def parse_zip_file(self, filename_or_fobj, metrics=None):
+        """Yield converted rows from a ZIP file (used outside Scrapy also)
+
+        If `metrics` (a `transparenciagovbr.utils.metrics.Metrics`) is given,
+        the time spent in each stage is added to it.
+        """
+
+        data = parse_csv_rows(
+            filename_or_fobj=filename_or_fobj,
             inner_filename_suffix=self.filename_suffix,
             encoding=self.encoding,
             schema=self.schema,
+            metrics=metrics,
         )
+        for row in data:
+            yield self.convert_row(row)
+
+    def parse_zip_response(self, response):
+        zip_file = self.open_zip_response(response)
+        period = response.meta.get("period")
+        if (
+            self.incremental
+            and period is not None
+            and "archive_filename" in response.meta
+            and not response.meta.get("replacing")
+        ):
+            if self.manifest.is_current(period, response.meta["archive_filename"]):
+                self.logger.debug(f"Skipping period {period} (not changed)")
+                self.close_zip_response(response)
+                return
+            elif period in self.manifest:  # Changed in the server (revalidated)
+                yield from self.replace_output(period)
+        with_period = (self.partitioned or self.rows_with_period) and period is not None
+        archive_metrics = None
+        if self.metrics is not None:
+            archive_metrics = self.metrics.archive_metrics(response)
+        rows = 0
+        for row in self.parse_zip_file(zip_file, metrics=archive_metrics):
+            if with_period:
+                if not isinstance(row, Row):
+                    row = Row(row)
+                row.period = period
+            yield row
+            rows += 1
+        if period is not None:
+            # Use the saved archive (if any), so its mtime is recorded also
+            filename = response.meta.get("archive_filename")
+            source = filename if filename and Path(filename).exists() else zip_file
+            if self.partitioned:
+                frequency = getattr(self, "publish_frequency", "daily")
+                partition = partition_path(partition_keys(period, frequency))
+            else:
+                partition = self.partition
+            self.manifest.add(
+                period, source, rows, partition, outputs=self.output_paths(partition)
+            )
+            self.converted.add(period)
+        if archive_metrics is not None:
+            archive_metrics.rows = rows
+            self.metrics.archive_parsed(response, archive_metrics)
+        self.close_zip_response(response)
+
+    def remove_replaced_outputs(self):
+        """Remove the previous outputs whose periods were all converted again"""
+
+        current = {str(path) for path in self.feed_paths}
+        for partition, (periods, paths) in self.replaced.items():
+            missing = [period for period in periods if period not in self.converted]
+            if missing:
+                self.logger.error(
+                    f"Output {partition} not removed (periods not converted again: "
+                    f"{', '.join(missing)}): the rows of its other periods are duplicated"
+                )
+                continue
+            for path in map(Path, paths):
+                if str(path) in current:
+                    continue
+                elif path.is_dir():  # Partition: the parts of previous runs
+                    for filename in path.glob("part-*"):
+                        if not filename.name.startswith(f"part-{self.run_id}-"):
+                            filename.unlink()
+                elif path.exists():
+                    path.unlink()
+                    index_filename = path.parent / (path.name + INDEX_SUFFIX)
+                    if index_filename.exists():
+                        index_filename.unlink()
+                else:
+                    self.logger.warning(f"Output {path} (of {partition}) not found")
+                    continue
+                self.logger.info(f"Removed previous output {path}")
+        if self.replaced and self.partitioned:
+            # Removed parts are left out of the indexes (the exporters also do it)
+            for path in self.feed_paths:
+                PartitionIndex(path.parent).save()
+
+    def closed(self, reason):
+        # Periods are only recorded if the whole crawl finished (so the output
+        # has all their rows)
+        self.close_reason = reason
+        if reason == "finished":
+            self.manifest.save()
+
+    def feeds_stored(self):
+        # The outputs being replaced are only removed after the new ones are
+        # stored (`closed` is called before)
+        stats = self.crawler.stats.get_stats()
+        failed = any(key.startswith("feedexport/failed_count/") for key in stats)
+        if self.close_reason == "finished" and not failed:
+            self.remove_replaced_outputs()
@@ -1,4 +1,5 @@
 import datetime
+import re
 from decimal import Decimal, InvalidOperation
 from urllib.parse import urlparse
 
@@ -7,62 +8,91 @@ from transparenciagovbr.spiders.base import TransparenciaBaseSpider
 from transparenciagovbr.utils.date import today
 
 
-class Text(str):
+# Layout of the descriptions (after the first 78 characters, which have the
+# quantity and unit): `'<item>',<description> MARCA: <brand> ITEM DO PROCESSO:
+# <process item> ITEM DE MATERIAL: <material item>`. The non-greedy groups
+# match the first occurrence of each marker, like `str.find` does.
+REGEXP_DESCRIPTION = re.compile(
+    r"(?P<item>[^,]*),(?P<descricao_restante>.*?)MARCA:(?P<marca>.*?)"
+    r"ITEM DO PROCESSO:(?P<item_processo>.*?)ITEM DE MATERIAL:(?P<item_material>.*)",
+    flags=re.DOTALL,
+)
 
-    def until(self, substr):
-        return Text(self[:self.find(substr)])
 
-    def starting_at(self, substr):
-        return Text(self[self.find(substr):])
+EMPTY_DESCRIPTION = {
+    "descricao_restante": "",
+    "item": "",
+    "item_material": "",
+    "item_processo": "",
+    "marca": "",
+    "quantidade": "",
+    "unidade": "",
+}
 
-    def after(self, substr):
-        return Text(self[self.find(substr) + len(substr):])
 
+def until(text, substr):
+    # If `substr` is not found, the last character is removed (the same
+    # result as the original implementation, which used `text.find`)
+    return text[: text.find(substr)]
 
-def parse_description(text):
-    """Extrai dados estruturados do texto da descrição"""
 
-    new = {
-        "descricao_restante": "",
-        "item": "",
-        "item_material": "",
-        "item_processo": "",
-        "marca": "",
-        "quantidade": "",
-        "unidade": "",
-    }
+def after(text, substr):
+    return text[text.find(substr) + len(substr) :]
 
-    if len(text) < 78 or "MARCA:" not in text:
-        return new
 
-    # TODO: verificar a possibilidade de transformar essa função num conjunto
-    # de expressões regulares (provavelmente rodarão mais rapidamente)
+def parse_quantity(text):
+    """Return `(quantidade, unidade)` from the first part of the description"""
 
-    part1, part2 = Text(text[:78].strip()), Text(text[78:])
-    try:
-        new["quantidade"] = Decimal(part1.until(" ").strip().replace(".", "").replace(",", "."))
-    except InvalidOperation:
-        return new
-    new["unidade"] = part1.after(" ").strip()
+    quantity, separator, unit = text.partition(" ")
+    if not separator:  # Same as `until`/`after` when there's no space
+        quantity, unit = text[:-1], text
+    quantity = quantity.strip().replace(".", "").replace(",", ".")
+    return Decimal(quantity), unit.strip()
 
-    item = part2.until(",")
-    if item and item[0] == item[-1] == "'":
-        item = item[1:-1]
-    new["item"] = item
-    rest = part2.after(",")
 
-    new["descricao_restante"] = rest.until("MARCA:").strip()
-    rest = rest.after("MARCA:")
+def parse_rest(text):
+    """Slower version of `REGEXP_DESCRIPTION` for descriptions not matching it"""
 
-    new["marca"] = rest.until("ITEM DO PROCESSO:").strip()
-    rest = rest.after("ITEM DO PROCESSO:")
+    item = until(text, ",")
+    rest = after(text, ",")
+    descricao_restante = until(rest, "MARCA:")
+    rest = after(rest, "MARCA:")
+    marca = until(rest, "ITEM DO PROCESSO:")
+    rest = after(rest, "ITEM DO PROCESSO:")
+    item_processo = until(rest, "ITEM DE MATERIAL:")
+    item_material = after(rest, "ITEM DE MATERIAL:")
+    return item, descricao_restante, marca, item_processo, item_material
 
-    new["item_processo"] = rest.until("ITEM DE MATERIAL:").strip()
-    rest = rest.after("ITEM DE MATERIAL:")
 
-    new["item_material"] = rest.strip()
+def parse_description(text):
+    """Extrai dados estruturados do texto da descrição"""
 
-    return new
+    if len(text) < 78 or "MARCA:" not in text:
+        return dict(EMPTY_DESCRIPTION)
+
+    try:
+        quantidade, unidade = parse_quantity(text[:78].strip())
+    except InvalidOperation:
+        return dict(EMPTY_DESCRIPTION)
+
+    match = REGEXP_DESCRIPTION.match(text, 78)
+    if match is not None:
+        item, descricao_restante, marca, item_processo, item_material = match.groups()
+    else:
+        item, descricao_restante, marca, item_processo, item_material = parse_rest(
+            text[78:]
+        )
+    if item and item[0] == item[-1] == "'":
+        item = item[1:-1]
+    return {
+        "descricao_restante": descricao_restante.strip(),
+        "item": item,
+        "item_material": item_material.strip(),
+        "item_processo": item_processo.strip(),
+        "marca": marca.strip(),
+        "quantidade": quantidade,
+        "unidade": unidade,
+    }
 
 
 def extract_extra_fields(row):
@@ -77,7 +107,6 @@ def extract_extra_fields(row):
     }
     if row["elemento_despesa"] != "MATERIAL DE CONSUMO":
         return new
-    # TODO: add fields related to services and other elements
 
     new.update(parse_description(row["descricao"]))
     return new
@@ -96,10 +125,9 @@ class DespesaItemEmpenhoSpider(DespesaMixin, TransparenciaBaseSpider):
     filename_suffix = "_Despesas_ItemEmpenho.csv"
     schema_filename = "despesa_item_empenho.csv"
 
-    def parse_zip_response(self, response):
-        for row in super().parse_zip_response(response):
-            row.update(extract_extra_fields(row))
-            yield row
+    def convert_row(self, row):
+        row.update(extract_extra_fields(row))
+        return row
 
 
 class DespesaEmpenhoSpider(DespesaMixin, TransparenciaBaseSpider):
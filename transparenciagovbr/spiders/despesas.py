@@ -0,0 +1,79 @@
+import datetime
+from pathlib import Path
+
+from transparenciagovbr.items import Row, TableFilter
+from transparenciagovbr.spiders.base import TransparenciaBaseSpider
+from transparenciagovbr.spiders.despesa_item_empenho import (
+    DespesaEmpenhoSpider,
+    DespesaItemEmpenhoSpider,
+    DespesaMixin,
+)
+from transparenciagovbr.spiders.pagamento import PagamentoSpider
+from transparenciagovbr.utils.date import today
+
+
+class DespesasSpider(DespesaMixin, TransparenciaBaseSpider):
+    """Download each daily despesas archive once and convert all its tables
+
+    The rows of each table (one inner CSV, converted by the table's spider)
+    are written to a different output: `OUTPUT_PATH/<table>.<FEED_FORMAT>`
+    (or `OUTPUT_PATH/<table>/<OUTPUT_PARTITION>.<FEED_FORMAT>`, if the setting
+    `OUTPUT_PARTITION` is defined, or `OUTPUT_PATH/<table>/_index.json` and
+    the partitions, if `FEED_FORMAT` is `partitioned`). Don't use `-o` with
+    this spider.
+    """
+
+    name = "despesas"
+    base_url = "http://transparencia.gov.br/download-de-dados/despesas/{year}{month:02d}{day:02d}"
+    start_date = datetime.date(2013, 3, 31)
+    end_date = today()
+    publish_frequency = "daily"
+    tables = {
+        spider_class.name: spider_class
+        for spider_class in (
+            PagamentoSpider,
+            DespesaEmpenhoSpider,
+            DespesaItemEmpenhoSpider,
+        )
+    }
+    schema = None  # Each table has its own (see `table_spiders`)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.table_spiders = {
+            table: spider_class() for table, spider_class in self.tables.items()
+        }
+
+    @classmethod
+    def update_settings(cls, spider_settings):
+        super().update_settings(spider_settings)
+        feed_format = spider_settings.get("FEED_FORMAT")
+        output_path = Path(spider_settings.get("OUTPUT_PATH"))
+        partition = spider_settings.get("OUTPUT_PARTITION")
+        if feed_format == "partitioned":
+            export_format = spider_settings.get("PARTITION_FORMAT")
+        else:
+            export_format = feed_format
+        feeds = {}
+        for table, spider_class in cls.tables.items():
+            if feed_format == "partitioned":
+                filename = output_path / table / "_index.json"
+            elif partition:
+                filename = output_path / table / f"{partition}.{feed_format}"
+            else:
+                filename = output_path / f"{table}.{feed_format}"
+            feeds[str(filename)] = {
+                "format": feed_format,
+                "item_filter": TableFilter,
+                "table": table,
+            }
+            if export_format == "parquet":  # The exporter needs the table's types
+                feeds[str(filename)]["item_export_kwargs"] = {
+                    "schema_filename": spider_class.schema_filename
+                }
+        spider_settings.set("FEEDS", feeds, priority="spider")
+
+    def parse_zip_file(self, filename_or_fobj, metrics=None):
+        for table, spider in self.table_spiders.items():
+            for row in spider.parse_zip_file(filename_or_fobj, metrics=metrics):
+                yield Row(row, table=table)
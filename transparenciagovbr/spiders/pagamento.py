@@ -1,10 +1,11 @@
 import datetime
 
 from transparenciagovbr.spiders.base import TransparenciaBaseSpider
+from transparenciagovbr.spiders.despesa_item_empenho import DespesaMixin
 from transparenciagovbr.utils.date import today
 
 
-class PagamentoSpider(TransparenciaBaseSpider):
+class PagamentoSpider(DespesaMixin, TransparenciaBaseSpider):
     name = "pagamento"
     base_url = "http://www.portaldatransparencia.gov.br/download-de-dados/despesas/{year}{month:02d}{day:02d}"
     start_date = datetime.date(2013, 3, 31)
@@ -1,10 +1,9 @@
-import csv
 import datetime
-import io
 import zipfile
 
 from transparenciagovbr.spiders.base import TransparenciaBaseSpider
-from transparenciagovbr.utils.io import NotNullTextWrapper
+from transparenciagovbr.utils.io import csv_reader
+from transparenciagovbr.utils.metrics import timed_rows
 
 
 class PagamentoHistSpider(TransparenciaBaseSpider):
@@ -15,15 +14,21 @@ class PagamentoHistSpider(TransparenciaBaseSpider):
     publish_frequency = "monthly"
     schema_filename = "pagamento_historico.csv"
 
-    def parse_zip_response(self, response):
-        zf = zipfile.ZipFile(io.BytesIO(response.body))
+    def parse_zip_file(self, filename_or_fobj, metrics=None):
+        zf = zipfile.ZipFile(filename_or_fobj)
         assert len(zf.filelist) == 1
-        fobj = NotNullTextWrapper(
-            zf.open(zf.filelist[0].filename), encoding=self.encoding
+        reader = csv_reader(
+            zf.open(zf.filelist[0].filename),
+            encoding=self.encoding,
+            delimiter="\t",
+            metrics=metrics,
         )
-        reader = csv.DictReader(fobj, delimiter="\t")
+        deserialize = self.schema.compile(next(reader))
 
-        for row in reader:
-            new = self.schema.deserialize(row)
-            if new is not None:
-                yield new
+        if metrics is not None:
+            for row in timed_rows(reader, deserialize, metrics):
+                yield self.convert_row(row)
+            return
+        for values in reader:
+            if values:
+                yield self.convert_row(deserialize(values))
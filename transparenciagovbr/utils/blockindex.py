@@ -0,0 +1,170 @@
+"""Index of the rows of compressed CSV outputs, by key, for random access
+
+The outputs written by `ParallelBlockWriter` are made of independently
+compressed blocks (one gzip member/zstd frame/lz4 frame/xz stream each, cut
+between rows), so any block can be decompressed alone. The index is a
+SQLite file (`<output>.idx`) with the offsets of the blocks and, for each
+indexed field, which blocks have rows with each value, so finding the rows
+having a value only decompresses the blocks where it appears (smaller blocks,
+set by `FEED_COMPRESSION_BLOCK_SIZE`, mean less data decompressed per query).
+
+Usage: python -m transparenciagovbr.utils.blockindex <filename> <field>=<value> [...]
+(prints the rows having all the values, as CSV)
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+from transparenciagovbr.utils.compression import DECOMPRESSORS
+
+
+INDEX_SUFFIX = ".idx"
+
+
+def index_filename(filename):
+    return Path(str(filename) + INDEX_SUFFIX)
+
+
+class BlockIndexWriter:
+    """Collect the values of `fields` in each block and save them to the index
+
+    `add` must be called in order of block (as the rows are written).
+    """
+
+    def __init__(self, filename, codec, fields):
+        self.filename = index_filename(filename)
+        self.temp_filename = self.filename.parent / (self.filename.name + ".tmp")
+        if self.temp_filename.exists():
+            self.temp_filename.unlink()
+        self.codec = codec
+        self.fields = list(fields)
+        self.connection = sqlite3.connect(str(self.temp_filename))
+        self.connection.executescript(
+            """
+            PRAGMA synchronous = OFF;
+            CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE blocks (
+                block INTEGER PRIMARY KEY,
+                compressed_offset INTEGER,
+                compressed_size INTEGER,
+                uncompressed_offset INTEGER
+            );
+            CREATE TABLE keys (field TEXT, value TEXT, block INTEGER);
+            """
+        )
+        self.block = 0
+        self.values = set()
+
+    def add(self, block, item):
+        if block != self.block:
+            self._write_values()
+            self.block = block
+        for field in self.fields:
+            value = item.get(field)
+            if value is not None and value != "":
+                self.values.add((field, str(value)))
+
+    def _write_values(self):
+        self.connection.executemany(
+            "INSERT INTO keys VALUES (?, ?, ?)",
+            ((field, value, self.block) for field, value in self.values),
+        )
+        self.values = set()
+
+    def save(self, blocks, compressed_size, header):
+        """Save the index (`blocks` and `compressed_size` from `ParallelBlockWriter`)"""
+
+        self._write_values()
+        offsets = [offset for offset, _ in blocks] + [compressed_size]
+        self.connection.executemany(
+            "INSERT INTO blocks VALUES (?, ?, ?, ?)",
+            (
+                (number, offset, offsets[number + 1] - offset, uncompressed_offset)
+                for number, (offset, uncompressed_offset) in enumerate(blocks)
+            ),
+        )
+        self.connection.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            (
+                ("codec", self.codec),
+                ("fields", json.dumps(self.fields)),
+                ("header", json.dumps(list(header))),
+                ("compressed_size", str(compressed_size)),
+            ),
+        )
+        self.connection.execute("CREATE INDEX keys_field_value ON keys (field, value)")
+        self.connection.commit()
+        self.connection.close()
+        os.replace(self.temp_filename, self.filename)
+
+
+def query(filename, conditions):
+    """Yield the rows (dicts) of `filename` having all `conditions` (`{field: value}`)"""
+
+    if not index_filename(filename).exists():
+        raise ValueError(f"{filename} has no index ({index_filename(filename)})")
+    connection = sqlite3.connect(str(index_filename(filename)))
+    try:
+        meta = dict(connection.execute("SELECT name, value FROM meta"))
+        if int(meta["compressed_size"]) != Path(filename).stat().st_size:
+            raise ValueError(f"Index is outdated for {filename}")
+        fields, header = json.loads(meta["fields"]), json.loads(meta["header"])
+        for field in conditions:
+            if field not in fields:
+                raise ValueError(
+                    f"Field {repr(field)} is not indexed (indexed: {', '.join(fields)})"
+                )
+        blocks = None
+        for field, value in conditions.items():
+            result = connection.execute(
+                "SELECT block FROM keys WHERE field = ? AND value = ?", (field, value)
+            )
+            field_blocks = {block for (block,) in result}
+            blocks = field_blocks if blocks is None else blocks & field_blocks
+        offsets = connection.execute(
+            "SELECT block, compressed_offset, compressed_size FROM blocks ORDER BY block"
+        ).fetchall()
+    finally:
+        connection.close()
+
+    decompress = DECOMPRESSORS[meta["codec"]]
+    positions = [(header.index(field), value) for field, value in conditions.items()]
+    with open(filename, mode="rb") as fobj:
+        for block, compressed_offset, compressed_size in offsets:
+            if block not in (blocks or ()):
+                continue
+            fobj.seek(compressed_offset)
+            data = decompress(fobj.read(compressed_size)).decode("utf-8")
+            reader = csv.reader(io.StringIO(data, newline=""))
+            if block == 0:
+                next(reader)  # Header
+            for row in reader:
+                if all(row[position] == value for position, value in positions):
+                    yield dict(zip(header, row))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename")
+    parser.add_argument("conditions", nargs="+", metavar="field=value")
+    args = parser.parse_args()
+
+    conditions = dict(condition.split("=", maxsplit=1) for condition in args.conditions)
+    writer = None
+    try:
+        for row in query(args.filename, conditions):
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(row.keys()))
+                writer.writeheader()
+            writer.writerow(row)
+    except ValueError as exception:
+        parser.error(str(exception))
+
+
+if __name__ == "__main__":
+    main()
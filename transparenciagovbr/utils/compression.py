@@ -0,0 +1,220 @@
+"""Compressed output files (gzip, zstd, lz4 and xz)
+
+`open_compressed` returns a binary file object which compresses everything
+written to it (and `open_compressed_reader` reads these files back). With
+`threads > 0` the data is split in blocks which are compressed by a pool of
+threads (zlib, lzma, zstandard and lz4 release the GIL) and each block
+becomes an independent gzip member/zstd frame/lz4 frame/xz stream, so the
+result can be read by any decompressor (like `pigz`/`zstd -T` do). Blocks
+are only cut between calls to `write`, so if each call writes whole CSV
+rows, each block starts at a row.
+
+zstd and lz4 are optional dependencies (`pip install zstandard lz4`).
+"""
+import gzip
+import io
+import lzma
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_LEVELS = {"gzip": 9, "zstd": 3, "lz4": 0, "xz": 6}
+
+
+def _gzip_writer(fobj, level):
+    return gzip.GzipFile(fileobj=fobj, mode="wb", compresslevel=level, mtime=0)
+
+
+def _gzip_compressor(level):
+    return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _zstd_writer(fobj, level):
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=level).stream_writer(fobj, closefd=False)
+
+
+def _zstd_compressor(level):
+    import zstandard
+
+    # `ZstdCompressor` objects can't be used by more than one thread at a time
+    local = threading.local()
+
+    def compress(data):
+        if not hasattr(local, "compressor"):
+            local.compressor = zstandard.ZstdCompressor(level=level)
+        return local.compressor.compress(data)
+
+    return compress
+
+
+def _lz4_writer(fobj, level):
+    import lz4.frame
+
+    return lz4.frame.LZ4FrameFile(fobj, mode="wb", compression_level=level)
+
+
+def _lz4_compressor(level):
+    import lz4.frame
+
+    return lambda data: lz4.frame.compress(data, compression_level=level)
+
+
+def _xz_writer(fobj, level):
+    return lzma.LZMAFile(fobj, mode="wb", preset=level)
+
+
+def _xz_compressor(level):
+    return lambda data: lzma.compress(data, preset=level)
+
+
+WRITERS = {
+    "gzip": _gzip_writer,
+    "zstd": _zstd_writer,
+    "lz4": _lz4_writer,
+    "xz": _xz_writer,
+}
+COMPRESSORS = {
+    "gzip": _gzip_compressor,
+    "zstd": _zstd_compressor,
+    "lz4": _lz4_compressor,
+    "xz": _xz_compressor,
+}
+
+
+class ParallelBlockWriter(io.RawIOBase):
+    """Write-only file object which compresses blocks using a thread pool
+
+    Compressed blocks are written to `fobj` in order by the thread calling
+    `write` (without waiting for blocks which are not finished yet) and at
+    most `2 * threads` blocks are kept in memory. `blocks` has one
+    `(compressed_offset, uncompressed_offset)` tuple per written block and
+    `submitted` is the number of the block the next `write` goes to.
+    """
+
+    def __init__(self, fobj, compress, threads, block_size=4 * 1024 * 1024):
+        self.fobj = fobj
+        self.compress = compress
+        self.block_size = block_size
+        self.max_pending = 2 * threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.blocks = []
+        self.submitted = 0
+        self.compressed_offset = fobj.tell() if fobj.seekable() else 0
+        self.uncompressed_offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+        self._write_finished(block=len(self.pending) > self.max_pending)
+        return len(data)
+
+    def _submit(self):
+        data = b"".join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        self.submitted += 1
+        self.pending.append((len(data), self.executor.submit(self.compress, data)))
+
+    def _write_finished(self, block=False):
+        while self.pending and (block or self.pending[0][1].done()):
+            size, future = self.pending.popleft()
+            compressed = future.result()
+            self.fobj.write(compressed)
+            self.blocks.append((self.compressed_offset, self.uncompressed_offset))
+            self.compressed_offset += len(compressed)
+            self.uncompressed_offset += size
+            block = block and len(self.pending) > self.max_pending
+
+    def flush(self):
+        """Compress and write everything written so far (ends the current block)"""
+
+        if self.buffered:
+            self._submit()
+        while self.pending:
+            self._write_finished(block=True)
+        self.fobj.flush()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.executor.shutdown()
+        super().close()
+
+
+def open_compressed(fobj, codec="gzip", level=None, threads=0, block_size=None):
+    """Return a binary file object writing `codec`-compressed data to `fobj`
+
+    Closing the returned object does not close `fobj`.
+    """
+
+    if codec not in WRITERS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if not threads:
+        return WRITERS[codec](fobj, level)
+    kwargs = {"block_size": block_size} if block_size else {}
+    return ParallelBlockWriter(fobj, COMPRESSORS[codec](level), threads, **kwargs)
+
+
+def _zstd_reader(filename):
+    import zstandard
+
+    # The files may have more than one frame (see `ParallelBlockWriter`)
+    decompressor = zstandard.ZstdDecompressor()
+    return decompressor.stream_reader(open(filename, mode="rb"), read_across_frames=True)
+
+
+def _lz4_reader(filename):
+    import lz4.frame
+
+    return lz4.frame.open(filename, mode="rb")
+
+
+READERS = {
+    ".gz": gzip.open,
+    ".lz4": _lz4_reader,
+    ".xz": lzma.open,
+    ".zst": _zstd_reader,
+}
+
+
+def open_compressed_reader(filename):
+    """Open `filename` for reading in binary mode, decompressing by its extension"""
+
+    filename = str(filename)
+    for extension, reader in READERS.items():
+        if filename.endswith(extension):
+            return reader(filename)
+    return open(filename, mode="rb")
+
+
+def _zstd_decompress(data):
+    import zstandard
+
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def _lz4_decompress(data):
+    import lz4.frame
+
+    return lz4.frame.decompress(data)
+
+
+# Decompress one block written by `ParallelBlockWriter`
+DECOMPRESSORS = {
+    "gzip": gzip.decompress,
+    "zstd": _zstd_decompress,
+    "lz4": _lz4_decompress,
+    "xz": lzma.decompress,
+}
@@ -7,22 +7,33 @@ def today():
     return datetime.date(date.year, date.month, date.day)
 
 
+def add_months(date, months):
+    """Return `date` plus `months` (which may be negative), keeping the day if it exists
+
+    The day is limited to the month's last day (like 2020-03-31 minus one
+    month, which is 2020-02-29).
+    """
+
+    month_index = date.year * 12 + date.month - 1 + months
+    year, month = divmod(month_index, 12)
+    day = min(date.day, calendar.monthrange(year, month + 1)[1])
+    return datetime.date(year, month + 1, day)
+
+
+def add_years(date, years):
+    return add_months(date, 12 * years)
+
+
 def next_day(date):
     return date + datetime.timedelta(days=1)
 
 
 def next_month(date):
-    return datetime.date(
-        year=date.year + (date.month // 12), month=(date.month % 12) + 1, day=date.day
-    )
+    return add_months(date, 1)
 
 
 def next_year(date):
-    if calendar.isleap(date.year):
-        days_to_add = 366
-    else:
-        days_to_add = 365
-    return date + datetime.timedelta(days=days_to_add)
+    return add_years(date, 1)
 
 
 def next_date(date, interval="daily"):
@@ -31,11 +42,31 @@ def next_date(date, interval="daily"):
     return from_interval[interval](date)
 
 
+def nth_date(start, number, interval="daily"):
+    """Return the date `number` intervals after `start` (computed from `start`)"""
+
+    if interval == "daily":
+        return start + datetime.timedelta(days=number)
+    elif interval == "monthly":
+        return add_months(start, number)
+    elif interval == "yearly":
+        return add_years(start, number)
+    raise ValueError(f"Unknown interval: {interval}")
+
+
 def date_range(start, stop, interval="daily"):
+    """Yield the dates from `start` (inclusive) to `stop` (exclusive) each `interval`
+
+    Each date is computed from `start` (not from the previous one), so the
+    day of `start` is kept even after shorter months.
+    """
+
+    number = 0
     current = start
     while current < stop:
         yield current
-        current = next_date(date=current, interval=interval)
+        number += 1
+        current = nth_date(start, number, interval)
 
 
 def date_to_dict(date):
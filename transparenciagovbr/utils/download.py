@@ -0,0 +1,356 @@
+import json
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.client import HTTPException
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+
+class DownloadError(Exception):
+    pass
+
+
+class FileChanged(DownloadError):
+    """The file changed in the server during the download"""
+
+
+class HostLimiter:
+    """Limit the number of simultaneous connections to each host
+
+    Use as `with limiter(url): ...` around each connection. The limit of a
+    domain (and its subdomains) can be lowered while it's being used (see
+    `set_limit`).
+    """
+
+    def __init__(self, max_per_host=4):
+        self.max_per_host = max_per_host
+        self.limits = {}
+        self.connections = Counter()
+        self.condition = threading.Condition()
+
+    def set_limit(self, domain, limit):
+        """Allow up to `limit` connections (at most `max_per_host`) to `domain`"""
+
+        with self.condition:
+            self.limits[domain] = max(1, min(self.max_per_host, limit))
+            self.condition.notify_all()
+
+    def key(self, url):
+        parsed = urlparse(url)
+        hostname = parsed.hostname or ""
+        for domain in self.limits:
+            if hostname == domain or hostname.endswith("." + domain):
+                return domain
+        return parsed.netloc
+
+    @contextmanager
+    def __call__(self, url):
+        with self.condition:
+            key = self.key(url)
+            while self.connections[key] >= self.limits.get(key, self.max_per_host):
+                self.condition.wait()
+            self.connections[key] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.connections[key] -= 1
+                self.condition.notify_all()
+
+
+class SegmentedDownload:
+    """Download of a file in segments (concurrent HTTP Range requests)
+
+    The segments are written to `<filename>.part` and their progress is
+    saved to `<filename>.part.json`, so an interrupted download continues
+    from where each segment stopped, if the file didn't change in the server
+    (its `ETag` and `Last-Modified` are compared and sent in `If-Range`).
+    """
+
+    def __init__(
+        self, url, filename, size, validators, headers, timeout, chunk_size, limiter
+    ):
+        self.url = url
+        self.filename = Path(filename)
+        self.temp_filename = self.filename.parent / (self.filename.name + ".part")
+        self.state_filename = self.filename.parent / (self.filename.name + ".part.json")
+        self.size = size
+        self.validators = validators
+        self.headers = headers
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        self.segments = []
+
+    def resume(self):
+        """Load the progress of a previous download (`False` if it can't be resumed)"""
+
+        if not self.state_filename.exists() or not self.temp_filename.exists():
+            return False
+        with open(self.state_filename) as fobj:
+            state = json.load(fobj)
+        if (
+            state["url"] != self.url
+            or state["size"] != self.size
+            or state["validators"] != self.validators
+            or self.temp_filename.stat().st_size != self.size
+        ):
+            return False
+        self.segments = state["segments"]
+        return True
+
+    def create(self, segments, min_segment_size):
+        quantity = max(1, min(segments, self.size // min_segment_size))
+        bounds = [self.size * number // quantity for number in range(quantity + 1)]
+        # Each segment is `[start, end (inclusive), bytes downloaded]`
+        self.segments = [[bounds[i], bounds[i + 1] - 1, 0] for i in range(quantity)]
+        with open(self.temp_filename, mode="wb") as fobj:
+            fobj.truncate(self.size)
+        self.save()
+
+    def save(self):
+        state = {
+            "url": self.url,
+            "size": self.size,
+            "validators": self.validators,
+            "segments": self.segments,
+        }
+        temp_filename = self.state_filename.parent / (self.state_filename.name + ".tmp")
+        with open(temp_filename, mode="w") as fobj:
+            json.dump(state, fobj)
+        os.replace(temp_filename, self.state_filename)
+
+    def _download_segment(self, segment):
+        start, end, _ = segment
+        headers = {**self.headers, "Range": f"bytes={start + segment[2]}-{end}"}
+        if_range = self.validators["etag"] or self.validators["last_modified"]
+        if if_range:
+            headers["If-Range"] = if_range
+        request = Request(self.url, headers=headers)
+        with self.limiter(self.url):
+            with urlopen(request, timeout=self.timeout) as response:
+                if response.status != 206:  # `If-Range` didn't match
+                    raise FileChanged(f"{self.url} changed in the server")
+                with open(self.temp_filename, mode="r+b") as fobj:
+                    fobj.seek(start + segment[2])
+                    while start + segment[2] <= end:
+                        remaining = end + 1 - (start + segment[2])
+                        chunk = response.read(min(self.chunk_size, remaining))
+                        if not chunk:
+                            break
+                        fobj.write(chunk)
+                        fobj.flush()
+                        with self.lock:
+                            segment[2] += len(chunk)
+                            self.save()
+        if start + segment[2] <= end:
+            raise DownloadError(f"Connection closed before the end of {self.url}")
+
+    def download_segment(self, segment, retries=3):
+        for attempt in range(retries + 1):
+            try:
+                return self._download_segment(segment)
+            except FileChanged:
+                raise
+            except (OSError, HTTPException, DownloadError):
+                # Network errors: continue from where the segment stopped
+                if attempt == retries:
+                    raise
+
+    def run(self):
+        pending = [
+            segment for segment in self.segments if segment[0] + segment[2] <= segment[1]
+        ]
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                futures = [
+                    executor.submit(self.download_segment, segment) for segment in pending
+                ]
+                for future in futures:
+                    future.result()
+        downloaded = sum(segment[2] for segment in self.segments)
+        if downloaded != self.size or self.temp_filename.stat().st_size != self.size:
+            raise DownloadError(
+                f"Size mismatch for {self.url}: {downloaded} != {self.size}"
+            )
+        os.replace(self.temp_filename, self.filename)
+        self.state_filename.unlink()
+
+
+def _stream_response(response, filename, chunk_size):
+    """Write the body of `response` to `filename` (through `<filename>.part`)"""
+
+    temp_filename = filename.parent / (filename.name + ".part")
+    written = 0
+    with open(temp_filename, mode="wb") as fobj:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            fobj.write(chunk)
+            written += len(chunk)
+    size = response.headers.get("Content-Length")
+    if size is not None and int(size) != written:
+        raise DownloadError(f"Size mismatch for {response.url}: {written} != {size}")
+    os.replace(temp_filename, filename)
+
+
+def download_file(
+    url,
+    filename,
+    headers=None,
+    timeout=180,
+    chunk_size=1024 * 1024,
+    segments=4,
+    min_segment_size=16 * 1024 * 1024,
+    limiter=None,
+):
+    """Download `url` to `filename` without holding the whole body in memory
+
+    If the server supports HTTP Range requests, the file is downloaded in up
+    to `segments` concurrent segments (of at least `min_segment_size` bytes)
+    and an interrupted download is resumed in the next call (see
+    `SegmentedDownload`); otherwise, it's downloaded in chunks of
+    `chunk_size` bytes. Either way, the body is written to a temporary `.part`
+    file, which is renamed to `filename` only after the download finishes and
+    its size is verified (so a failed download never leaves a truncated file
+    behind). `limiter` (a `HostLimiter`) limits the connections per host.
+    Returns a tuple `(status, headers)`; the file is only written for
+    successful responses.
+    """
+
+    filename = Path(filename)
+    headers = dict(headers or {})
+    limiter = limiter or HostLimiter()
+    if not filename.parent.exists():
+        filename.parent.mkdir(parents=True, exist_ok=True)
+
+    for _ in range(2):  # Start again (once) if the file changes during the download
+        # The first byte tells if ranges are supported and the file size
+        with limiter(url):
+            request = Request(url, headers={**headers, "Range": "bytes=0-0"})
+            try:
+                response = urlopen(request, timeout=timeout)
+            except HTTPError as exception:
+                if exception.code != 416:  # 416 is returned for empty files
+                    return exception.code, dict(exception.headers)
+                response = urlopen(Request(url, headers=headers), timeout=timeout)
+            with response:
+                response_headers = dict(response.headers)
+                content_range = response.headers.get("Content-Range", "")
+                size = content_range.rsplit("/", maxsplit=1)[-1]
+                if response.status != 206 or not size.isdigit():
+                    # No support for ranges: the whole body is being sent
+                    _stream_response(response, filename, chunk_size)
+                    return response.status, response_headers
+
+        size = int(size)
+        response_headers.pop("Content-Range", None)
+        response_headers["Content-Length"] = str(size)
+        lower_headers = {key.lower(): value for key, value in response_headers.items()}
+        validators = {
+            "etag": lower_headers.get("etag"),
+            "last_modified": lower_headers.get("last-modified"),
+        }
+        # The segments are checked with `If-Range` instead of the conditional
+        # headers (if any) of the first request
+        segment_headers = {
+            key: value
+            for key, value in headers.items()
+            if key.lower() not in ("if-none-match", "if-modified-since")
+        }
+        download = SegmentedDownload(
+            url, filename, size, validators, segment_headers, timeout, chunk_size, limiter
+        )
+        if not download.resume():
+            download.create(segments, min_segment_size)
+        try:
+            download.run()
+        except FileChanged:
+            download.state_filename.unlink()
+            continue
+        return 200, response_headers
+    raise DownloadError(f"{url} keeps changing in the server")
+
+
+def write_file(filename, data):
+    """Write `data` to `filename` atomically (creating the directories)"""
+
+    filename = Path(filename)
+    if not filename.parent.exists():
+        filename.parent.mkdir(parents=True, exist_ok=True)
+    temp_filename = filename.parent / (filename.name + ".part")
+    with open(temp_filename, mode="wb") as fobj:
+        fobj.write(data)
+    os.replace(temp_filename, filename)
+
+
+def validators_filename(filename):
+    return Path(filename).parent / (Path(filename).name + ".validators.json")
+
+
+def load_validators(filename):
+    """Return the stored validators of `filename` if they match the file on disk
+
+    If the file is missing or its size doesn't match the stored
+    `Content-Length` (like when the download was interrupted), return `None`.
+    """
+
+    filename, sidecar = Path(filename), validators_filename(filename)
+    if not filename.exists() or not sidecar.exists():
+        return None
+    with open(sidecar) as fobj:
+        validators = json.load(fobj)
+    size = validators.get("content_length")
+    if size is not None and int(size) != filename.stat().st_size:
+        return None
+    return validators
+
+
+def save_validators(filename, headers, size=None):
+    """Store `ETag`, `Last-Modified` and `Content-Length` of a response for `filename`
+
+    `headers` is a dict with string keys and values (case-insensitive).
+    """
+
+    headers = {key.lower(): value for key, value in headers.items()}
+    validators = {
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+        "content_length": headers.get("content-length", size),
+    }
+    sidecar = validators_filename(filename)
+    if not sidecar.parent.exists():
+        sidecar.parent.mkdir(parents=True, exist_ok=True)
+    with open(sidecar, mode="w") as fobj:
+        json.dump(validators, fobj)
+    return validators
+
+
+def validators_match(validators, headers):
+    """Return `True` if response `headers` have the same validators as stored
+
+    Only validators present in both are compared and at least `ETag` or
+    `Last-Modified` must be (the size alone is not enough).
+    """
+
+    headers = {key.lower(): value for key, value in headers.items()}
+    compared = False
+    for key, header in (
+        ("etag", "etag"),
+        ("last_modified", "last-modified"),
+        ("content_length", "content-length"),
+    ):
+        stored, current = validators.get(key), headers.get(header)
+        if stored is None or current is None:
+            continue
+        elif str(stored) != str(current):
+            return False
+        compared = compared or key != "content_length"
+    return compared
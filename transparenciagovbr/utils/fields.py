@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from functools import lru_cache
 
 import rows
 
@@ -9,16 +10,22 @@ EM_SIGILO_STRINGS = (
     "Detalhamento das informações bloqueado.",
     "Informações protegidas por sigilo, nos termos da legislação, para garantia da segurança da sociedade e do Estado",
 )
+_EM_SIGILO_SET = frozenset(EM_SIGILO_STRINGS)
 
 
 def schema_path_from_filename(filename):
     return str((settings.REPOSITORY_PATH / "schema" / filename).absolute())
 
 
-def load_schema(filename):
-    schema_path = schema_path_from_filename(filename)
-    table = rows.import_from_csv(schema_path)
-    table.field_names
+@lru_cache(maxsize=None)
+def import_schema_table(filename):
+    """Read a schema CSV only once per process"""
+
+    return list(rows.import_from_csv(schema_path_from_filename(filename)))
+
+
+@lru_cache(maxsize=1)
+def field_types_context():
     # Our internal context will be all available rows.fields + our custom
     # fields
     rows_context = {
@@ -31,22 +38,42 @@ def load_schema(filename):
         FieldClass = getattr(fields, type_name)
         if "Field" in type_name and FieldClass.__module__ != "rows.fields":
             custom_context[FieldClass.name] = FieldClass
-    context = {**rows_context, **custom_context}
+    return {**rows_context, **custom_context}
+
+
+def load_schema(filename):
+    context = field_types_context()
+    return OrderedDict(
+        [
+            (row.field_name, context[row.internal_field_type])
+            for row in import_schema_table(filename)
+        ]
+    )
+
+
+def load_field_types(filename):
+    """Return the output type (`field_type` column) of each field, by field name"""
+
     return OrderedDict(
-        [(row.field_name, context[row.internal_field_type]) for row in table]
+        [(row.field_name, row.field_type) for row in import_schema_table(filename)]
     )
 
 
 def field_mapping_from_csv(csvfile):
-    schema_path = schema_path_from_filename(csvfile)
-    return {
-        row.original_name: row.field_name for row in rows.import_from_csv(schema_path)
-    }
+    return {row.original_name: row.field_name for row in import_schema_table(csvfile)}
+
+
+@lru_cache(maxsize=None)
+def get_schema(schema_filename):
+    """Return the `Schema` for `schema_filename`, creating it only once"""
+
+    return Schema(schema_filename)
 
 
 class Schema:
 
     def __init__(self, schema_filename):
+        self.filename = schema_filename
         schema = load_schema(schema_filename)
         field_mapping = field_mapping_from_csv(schema_filename)
 
@@ -57,16 +84,69 @@ class Schema:
             else:
                 deserialize = schema[field_name].deserialize
             self.fields.append((field_name, original_field_name, deserialize))
+        self._original_names = frozenset(
+            original_field_name for _, original_field_name, _ in self.fields
+        )
 
     def deserialize(self, row):
-        new = {
-            field_name: deserialize(row.pop(original_field_name, None))
-            for field_name, original_field_name, deserialize in self.fields
-        }
-        if row:
-            raise ValueError(f"Missing fields during deserialization: {', '.join(row.keys())}")
-        for key, value in new.items():
-            if value in EM_SIGILO_STRINGS:
-                new[key] = None
-                new["em_sigilo"] = "t"
+        new = {}
+        em_sigilo = False
+        for field_name, original_field_name, deserialize in self.fields:
+            value = deserialize(row.get(original_field_name))
+            if value in _EM_SIGILO_SET:  # Checked after the conversion
+                value = None
+                em_sigilo = True
+            new[field_name] = value
+        if not self._original_names.issuperset(row):
+            extra = [key for key in row if key not in self._original_names]
+            raise ValueError(f"Missing fields during deserialization: {', '.join(extra)}")
+        if em_sigilo:
+            new["em_sigilo"] = "t"
         return new
+
+    def compile(self, header):
+        """Return a function which deserializes rows given as sequences
+
+        `header` is the list of (original) field names for the values in each
+        sequence (like the first line of the CSV file). All the column lookups
+        are resolved here, only once, so the returned function just does the
+        type conversion and the sigilo detection (on the converted values, like
+        `deserialize`) in a single pass.
+        """
+
+        extra = [field_name for field_name in header if field_name not in self._original_names]
+        if extra:
+            raise ValueError(f"Missing fields during deserialization: {', '.join(extra)}")
+        width = len(header)
+        position = {field_name: index for index, field_name in enumerate(header)}
+        # All the keys are created (in the right order) by copying `template`;
+        # fields not in the header are deserialized only once here (like in
+        # `deserialize`, where they're `None`).
+        template = {}
+        present = []
+        for field_name, original_field_name, deserialize in self.fields:
+            if original_field_name in position:
+                template[field_name] = None
+                present.append((field_name, position[original_field_name], deserialize))
+            else:
+                template[field_name] = deserialize(None)
+        sigilo = _EM_SIGILO_SET
+
+        def deserialize_values(values):
+            if len(values) != width:
+                if len(values) > width:
+                    raise ValueError(f"Row has {len(values)} values, expected {width}")
+                values = list(values) + [None] * (width - len(values))
+            new = template.copy()
+            em_sigilo = False
+            for field_name, index, deserialize in present:
+                value = deserialize(values[index])
+                if value in sigilo:  # Checked after the conversion
+                    em_sigilo = True
+                else:
+                    new[field_name] = value
+            if em_sigilo:
+                new["em_sigilo"] = "t"
+            return new
+
+        return deserialize_values
@@ -1,21 +1,85 @@
+import codecs
+import csv
 import re
-from csv import DictReader
-from io import TextIOWrapper
+from io import RawIOBase, StringIO
 from zipfile import ZipFile
 
+from transparenciagovbr.utils.metrics import TimedFile
 
-class NotNullTextWrapper(TextIOWrapper):
-    def read(self, *args, **kwargs):
-        data = super().read(*args, **kwargs)
-        return data.replace("\x00", "")
 
-    def readline(self, *args, **kwargs):
-        data = super().readline(*args, **kwargs)
-        return data.replace("\x00", "")
+BLOCK_SIZE = 256 * 1024
 
 
-def parse_zip(filename_or_fobj, inner_filename_suffix, encoding):
-    zf = ZipFile(filename_or_fobj)
+def decoded_lines(fobj, encoding, block_size=BLOCK_SIZE):
+    """Yield the lines of the binary file `fobj`, decoded and without NUL bytes
+
+    `fobj` is read in blocks of `block_size` bytes: the NUL bytes (some of the
+    Portal's files are padded with them and, before Python 3.11, `csv` doesn't
+    accept them) are removed from each block before decoding it, so `encoding`
+    must be ASCII-compatible (like ISO-8859-1 and UTF-8). Line endings are
+    translated to `\\n` (like `TextIOWrapper` does) and kept in the lines, so
+    it can be passed to `csv.reader`.
+    """
+
+    decoder = codecs.getincrementaldecoder(encoding)()
+    rest = ""
+    while True:
+        data = fobj.read(block_size)
+        if b"\x00" in data:
+            data = data.replace(b"\x00", b"")
+            if not data:  # The whole block was NULs (but it's not the end)
+                continue
+        text = rest + decoder.decode(data, final=not data)
+        if not data:
+            if text:
+                yield from StringIO(text, newline=None)
+            return
+        # The last line may be incomplete, so it's left for the next block
+        end = text.rfind("\n") + 1
+        rest = text[end:]
+        if end:
+            yield from StringIO(text[:end], newline=None)
+
+
+class NulStrippedFile(RawIOBase):
+    """Binary file object reading `fobj` without the NUL bytes (see `decoded_lines`)
+
+    Used by the readers which don't go through `decoded_lines`, like
+    `pyarrow.csv` in the columnar engine.
+    """
+
+    def __init__(self, fobj, block_size=BLOCK_SIZE):
+        self.fobj = fobj
+        self.block_size = block_size
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buffer + self.fobj.read().replace(b"\x00", b"")
+            self.buffer = b""
+            return data
+        while len(self.buffer) < size:
+            data = self.fobj.read(max(size, self.block_size))
+            if not data:
+                break
+            self.buffer += data.replace(b"\x00", b"")
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.fobj.close()
+        super().close()
+
+
+def matching_filenames(zf, inner_filename_suffix):
     for file_info in zf.filelist:
         filename = file_info.filename
         if isinstance(inner_filename_suffix, re.Pattern):
@@ -24,9 +88,35 @@ def parse_zip(filename_or_fobj, inner_filename_suffix, encoding):
             file_matches = filename.endswith(inner_filename_suffix)
 
         if file_matches:
-            fobj = TextIOWrapper(
-                zf.open(filename), encoding=encoding
-            )
-            reader = DictReader(fobj, delimiter=";")
-            for row in reader:
-                yield row
+            yield filename
+
+
+def csv_reader(fobj, encoding, delimiter=";", metrics=None):
+    """Return a `csv.reader` for the binary file `fobj` (see `decoded_lines`)
+
+    If `metrics` is given, the time spent reading `fobj` (decompressing, for
+    the files inside ZIPs) is added to its `unzip` stage.
+    """
+
+    if metrics is not None:
+        fobj = TimedFile(fobj, metrics, "unzip")
+    return csv.reader(decoded_lines(fobj, encoding), delimiter=delimiter)
+
+
+def parse_zip_csvs(
+    filename_or_fobj, inner_filename_suffix, encoding, delimiter=";", metrics=None
+):
+    """Yield `(header, reader)` for each matching CSV inside the ZIP file
+
+    `reader` yields each row as a list of values (in the same order as
+    `header`), so no dict is created per row - use it with `Schema.compile`.
+    If `metrics` is given, the time spent decompressing is added to its
+    `unzip` stage.
+    """
+
+    zf = ZipFile(filename_or_fobj)
+    for filename in matching_filenames(zf, inner_filename_suffix):
+        reader = csv_reader(zf.open(filename), encoding, delimiter, metrics=metrics)
+        header = next(reader, None)
+        if header is not None:
+            yield header, reader
@@ -0,0 +1,139 @@
+"""Manifest of the periods already converted by each spider
+
+The manifest is a JSON file (one per spider, in `MANIFEST_PATH`) with one
+entry per period (the date used to build the archive's URL) having the
+archive's size, mtime and checksum, the number of rows converted and the
+output (partition) the rows were written to. It's used by the incremental
+mode of the spiders to skip periods which were already converted.
+"""
+import datetime
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from transparenciagovbr import settings
+
+
+def file_checksum(filename_or_fobj, chunk_size=8 * 1024 * 1024):
+    """Return the SHA-256 of a file (by name or file object) as a string"""
+
+    hasher = hashlib.sha256()
+    if isinstance(filename_or_fobj, (str, Path)):
+        fobj = open(filename_or_fobj, mode="rb")
+    else:
+        fobj = filename_or_fobj
+        fobj.seek(0)
+    try:
+        while True:
+            chunk = fobj.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    finally:
+        if fobj is not filename_or_fobj:
+            fobj.close()
+    return f"sha256:{hasher.hexdigest()}"
+
+
+class Manifest:
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        if self.filename.exists():
+            with open(self.filename) as fobj:
+                self.periods = json.load(fobj)["periods"]
+        else:
+            self.periods = {}
+        self.executor = None
+        self.checksums = {}  # Being calculated (futures), by period
+
+    @classmethod
+    def for_spider(cls, spider_name):
+        return cls(settings.MANIFEST_PATH / f"{spider_name}.json")
+
+    def __contains__(self, period):
+        return period in self.periods
+
+    def get(self, period):
+        return self.periods.get(period)
+
+    def is_current(self, period, filename=None):
+        """Return `True` if `period` was converted from the archive `filename`
+
+        If the archive is not on the disk, the manifest entry is trusted. The
+        checksum is only calculated if the size or mtime changed.
+        """
+
+        entry = self.periods.get(period)
+        if entry is None:
+            return False
+        elif filename is None or not Path(filename).exists():
+            return True
+        stat = Path(filename).stat()
+        if stat.st_size != entry["size"]:
+            return False
+        elif stat.st_mtime == entry.get("mtime"):
+            return True
+        checksum = entry["checksum"]
+        if period in self.checksums:
+            checksum = self.checksums[period].result()
+        return file_checksum(filename) == checksum
+
+    def add(self, period, filename_or_fobj, rows, partition=None, outputs=None):
+        """Record a converted period
+
+        `partition` is the output (file name, or partition for partitioned
+        outputs) the rows were written to and `outputs` the paths of the
+        outputs (one per table), so they can be replaced if the period is
+        converted again. The checksum of an archive file is calculated in a
+        thread (so the Scrapy reactor is not blocked by multi-GB archives) and
+        is set when the manifest is saved.
+        """
+
+        checksum = None
+        if isinstance(filename_or_fobj, (str, Path)):
+            stat = Path(filename_or_fobj).stat()
+            size, mtime = stat.st_size, stat.st_mtime
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.checksums[period] = self.executor.submit(file_checksum, filename_or_fobj)
+        else:  # Response body (in memory, and closed after the period is added)
+            size, mtime = filename_or_fobj.seek(0, os.SEEK_END), None
+            checksum = file_checksum(filename_or_fobj)
+            self.checksums.pop(period, None)
+        self.periods[period] = {
+            "size": size,
+            "mtime": mtime,
+            "checksum": checksum,
+            "rows": rows,
+            "partition": partition,
+            "outputs": outputs,
+            "converted_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+
+    def periods_in(self, partition):
+        """Return the periods whose rows were written to the output `partition`"""
+
+        return [
+            period
+            for period, entry in self.periods.items()
+            if entry.get("partition") == partition
+        ]
+
+    def clear(self):
+        self.periods = {}
+        self.checksums = {}
+
+    def save(self):
+        for period, future in self.checksums.items():
+            checksum = future.result()
+            if period in self.periods:
+                self.periods[period]["checksum"] = checksum
+        self.checksums = {}
+        if not self.filename.parent.exists():
+            self.filename.parent.mkdir(parents=True)
+        temp_filename = self.filename.parent / (self.filename.name + ".tmp")
+        with open(temp_filename, mode="w") as fobj:
+            json.dump({"periods": self.periods}, fobj, indent=2, sort_keys=True)
+        os.replace(temp_filename, self.filename)
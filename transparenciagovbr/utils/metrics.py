@@ -0,0 +1,138 @@
+"""Time spent in each stage of the conversion, bytes downloaded and rows
+
+The stages are `download` (the archive transfer), `unzip` (decompressing the
+CSVs inside the ZIP), `parse` (splitting the CSV lines into values),
+`deserialize` (`Schema.compile`'s function, converting the values to their
+types), `export` (writing the items to the output, including the
+compression) and `compress` (the part of `export` spent compressing and
+writing to the disk). They are recorded by `MetricsExtension` (see
+`transparenciagovbr.extensions`) only if it's enabled, since timing each row
+makes the parsing about 10% slower.
+"""
+import time
+
+
+STAGES = ("download", "unzip", "parse", "deserialize", "export", "compress")
+
+
+class Metrics:
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.bytes = 0
+        self.rows = 0
+        self.archives = 0
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def merge(self, other):
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] += seconds
+        self.bytes += other.bytes
+        self.rows += other.rows
+        self.archives += other.archives
+
+    def as_dict(self, elapsed=None):
+        """Return the metrics and the speeds (rows per second of `elapsed`, if given)
+
+        Without `elapsed` (like for one archive), the rows per second are
+        relative to the time spent converting (unzip, parse and deserialize).
+        """
+
+        seconds = self.seconds
+        conversion = seconds["unzip"] + seconds["parse"] + seconds["deserialize"]
+        elapsed = elapsed if elapsed is not None else conversion
+        return {
+            "archives": self.archives,
+            "bytes": self.bytes,
+            "rows": self.rows,
+            "seconds": {stage: round(value, 6) for stage, value in seconds.items()},
+            "download_speed": (  # Bytes per second
+                round(self.bytes / seconds["download"]) if seconds["download"] else None
+            ),
+            "rows_per_second": round(self.rows / elapsed, 1) if elapsed else None,
+        }
+
+    def prometheus(self, labels):
+        """Return the metrics in the Prometheus text format, with `labels` (a dict)"""
+
+        labels = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        lines = [
+            "# HELP transparenciagovbr_stage_seconds_total Time spent in each stage",
+            "# TYPE transparenciagovbr_stage_seconds_total counter",
+        ]
+        for stage, seconds in self.seconds.items():
+            stage_labels = f'{labels},stage="{stage}"'
+            lines.append(f"transparenciagovbr_stage_seconds_total{{{stage_labels}}} {seconds}")
+        for name, value, description in (
+            ("downloaded_bytes_total", self.bytes, "Bytes of the archives downloaded"),
+            ("rows_total", self.rows, "Rows converted"),
+            ("archives_total", self.archives, "Archives converted"),
+        ):
+            lines.extend(
+                [
+                    f"# HELP transparenciagovbr_{name} {description}",
+                    f"# TYPE transparenciagovbr_{name} counter",
+                    f"transparenciagovbr_{name}{{{labels}}} {value}",
+                ]
+            )
+        return "\n".join(lines) + "\n"
+
+
+class TimedFile:
+    """Wrap a file object, adding the time spent reading/writing to a stage"""
+
+    def __init__(self, fobj, metrics, stage):
+        self.fobj = fobj
+        self.metrics = metrics
+        self.stage = stage
+
+    def read(self, *args):
+        start = time.perf_counter()
+        data = self.fobj.read(*args)
+        self.metrics.add(self.stage, time.perf_counter() - start)
+        return data
+
+    def read1(self, *args):
+        start = time.perf_counter()
+        data = self.fobj.read1(*args)
+        self.metrics.add(self.stage, time.perf_counter() - start)
+        return data
+
+    def write(self, data):
+        start = time.perf_counter()
+        result = self.fobj.write(data)
+        self.metrics.add(self.stage, time.perf_counter() - start)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.fobj, name)
+
+
+def timed_rows(reader, deserialize, metrics):
+    """Yield `deserialize(values)` for the non-blank rows of `reader`, timing them
+
+    The time spent in `reader` goes to `parse` (minus the time spent in
+    `unzip`, if the underlying file is a `TimedFile`) and the time spent in
+    `deserialize` goes to `deserialize`. Only the time inside this generator
+    is counted (not the time the consumer spends with each row).
+    """
+
+    perf_counter = time.perf_counter
+    unzip_before = metrics.seconds["unzip"]
+    parse_time = deserialize_time = 0.0
+    try:
+        start = perf_counter()
+        for values in reader:
+            middle = perf_counter()
+            parse_time += middle - start
+            if values:
+                row = deserialize(values)
+                deserialize_time += perf_counter() - middle
+                yield row
+            start = perf_counter()
+        parse_time += perf_counter() - start
+    finally:
+        unzip_time = metrics.seconds["unzip"] - unzip_before
+        metrics.add("parse", parse_time - unzip_time)
+        metrics.add("deserialize", deserialize_time)
@@ -0,0 +1,96 @@
+"""Hive-style partitioned outputs (`ano=YYYY/mes=MM/part-*.<format>`)
+
+A partitioned output is a directory with one subdirectory per partition
+(year and month of the period the rows were downloaded for; only the year
+for spiders published yearly) and an index, `_index.json`, listing every
+partition with its part files and number of rows, so readers don't need to
+list the directories (or read the files) to find the partitions they need.
+
+Usage: python -m transparenciagovbr.utils.partition [--start YYYY-MM] [--end YYYY-MM] <directory>
+(prints the part files of the partitions in the interval, one per line)
+"""
+import argparse
+import datetime
+import json
+import os
+from pathlib import Path
+
+
+INDEX_FILENAME = "_index.json"
+
+
+def partition_keys(period, frequency="daily"):
+    """Return the partition keys (`{"ano": ..., "mes": ...}`) for a period"""
+
+    date = datetime.date.fromisoformat(period)
+    if frequency == "yearly":
+        return {"ano": date.year}
+    return {"ano": date.year, "mes": date.month}
+
+
+def partition_path(keys):
+    return "/".join(
+        f"{key}={value:04d}" if key == "ano" else f"{key}={value:02d}"
+        for key, value in keys.items()
+    )
+
+
+class PartitionIndex:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.filename = self.path / INDEX_FILENAME
+        self.partitions = {}
+        if self.filename.exists() and self.filename.stat().st_size > 0:
+            with open(self.filename) as fobj:
+                self.partitions = json.load(fobj)["partitions"]
+
+    def add(self, keys, filename, rows):
+        """Add a part file (relative to the output directory) to the partition"""
+
+        name = partition_path(keys)
+        partition = self.partitions.setdefault(name, {**keys, "rows": 0, "files": {}})
+        partition["files"][str(filename)] = rows
+        partition["rows"] = sum(partition["files"].values())
+
+    def filenames(self, start=None, end=None):
+        """Return the part files of the partitions from `start` to `end` (`YYYY-MM`)"""
+
+        result = []
+        for name, partition in sorted(self.partitions.items()):
+            key = f"{partition['ano']:04d}-{partition.get('mes', 1):02d}"
+            last_key = f"{partition['ano']:04d}-{partition.get('mes', 12):02d}"
+            if (start is None or last_key >= start) and (end is None or key <= end):
+                result.extend(self.path / filename for filename in sorted(partition["files"]))
+        return result
+
+    def save(self):
+        # Part files which were removed are not listed anymore
+        for name, partition in list(self.partitions.items()):
+            partition["files"] = {
+                filename: rows
+                for filename, rows in partition["files"].items()
+                if (self.path / filename).exists()
+            }
+            partition["rows"] = sum(partition["files"].values())
+            if not partition["files"]:
+                del self.partitions[name]
+        self.path.mkdir(parents=True, exist_ok=True)
+        temp_filename = self.path / (INDEX_FILENAME + ".tmp")
+        with open(temp_filename, mode="w") as fobj:
+            json.dump({"partitions": self.partitions}, fobj, indent=2, sort_keys=True)
+        os.replace(temp_filename, self.filename)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start", help="First partition (YYYY-MM)")
+    parser.add_argument("--end", help="Last partition (YYYY-MM)")
+    parser.add_argument("path", help="Directory of the partitioned output")
+    args = parser.parse_args()
+
+    for filename in PartitionIndex(args.path).filenames(start=args.start, end=args.end):
+        print(filename)
+
+
+if __name__ == "__main__":
+    main()
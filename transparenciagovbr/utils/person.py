@@ -0,0 +1,126 @@
+"""Persons' UUIDs (based on the URLid methodology) and an on-disk index of them
+
+The UUID of a person depends only on the visible digits of the (masked) CPF
+and on the normalized name, so the same person has the same UUID in every
+dataset and month. Creating it (`slug` and `uuid5`) is the slowest part of
+converting the pensionista data, so `PersonIndex` keeps the UUIDs in a SQLite
+database shared between runs and converters: the pairs of a chunk of rows are
+looked up at once and only the missing ones are created (and inserted, in
+one transaction). The index is keyed by the name as it appears in the data,
+so the lookups don't need to normalize it; the normalized one is stored too,
+so `SELECT DISTINCT uuid, masked_cpf, normalized_name FROM person` is a table
+of the persons in all the datasets converted.
+"""
+import sqlite3
+from itertools import islice
+from uuid import NAMESPACE_URL, uuid5
+
+from rows.fields import slug
+
+
+def masked_cpf(cpf):
+    """Return the visible digits of a masked CPF (like `***123456**`)"""
+
+    if cpf is None:
+        cpf = "***********"
+    assert len(cpf) == 11, f"Invalid CPF: {repr(cpf)}"
+    return cpf[3:9]
+
+
+def normalize_name(name):
+    return slug(name).upper().replace("_", "-")
+
+
+def person_uuid(cpf, name):
+    """Create UUID based on URLid methodology"""
+
+    internal_id = masked_cpf(cpf) + "-" + normalize_name(name)
+    return str(uuid5(NAMESPACE_URL, f"https://id.brasil.io/person/v1/{internal_id}/"))
+
+
+class PersonIndex:
+    """SQLite index of `(masked CPF, name) -> UUID`
+
+    Several processes can use the same database (the new pairs are inserted
+    with `INSERT OR IGNORE`, since the UUIDs are deterministic), also on
+    different hosts if it's on a shared filesystem with working POSIX locks
+    (like NFSv4): the rollback journal is used, since WAL's shared-memory
+    index is local to each host.
+    """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(str(filename), timeout=60)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS person (
+                masked_cpf TEXT NOT NULL,
+                name TEXT NOT NULL,
+                normalized_name TEXT NOT NULL,
+                uuid TEXT NOT NULL,
+                PRIMARY KEY (masked_cpf, name)
+            ) WITHOUT ROWID
+            """
+        )
+        self.connection.execute("CREATE TEMPORARY TABLE lookup (masked_cpf TEXT, name TEXT)")
+        self.connection.commit()
+        self.created = self.found = 0
+
+    def uuids(self, pairs):
+        """Return `{(cpf, name): uuid}` for the `(cpf, name)` pairs"""
+
+        keys = {}  # Different pairs may have the same key (like `None` and `"***********"`)
+        for cpf, name in set(pairs):
+            keys.setdefault((masked_cpf(cpf), name or ""), []).append((cpf, name))
+        with self.connection:
+            self.connection.execute("DELETE FROM lookup")
+            self.connection.executemany("INSERT INTO lookup VALUES (?, ?)", keys)
+            found = self.connection.execute(
+                """
+                SELECT l.masked_cpf, l.name, p.uuid
+                FROM lookup AS l
+                    JOIN person AS p ON p.masked_cpf = l.masked_cpf AND p.name = l.name
+                """
+            ).fetchall()
+        uuids = {(cpf, name): uuid for cpf, name, uuid in found}
+        new = []
+        for key, key_pairs in keys.items():
+            if key not in uuids:
+                uuid = uuids[key] = person_uuid(*key_pairs[0])
+                new.append((*key, normalize_name(key_pairs[0][1]), uuid))
+        if new:
+            with self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO person VALUES (?, ?, ?, ?)", new)
+        self.found += len(found)
+        self.created += len(new)
+        return {pair: uuids[key] for key, key_pairs in keys.items() for pair in key_pairs}
+
+    def close(self):
+        self.connection.close()
+
+
+def add_uuids(rows, fields, uuids, chunk_size=10_000):
+    """Yield `rows` (dicts) with the UUID of the persons in `fields` set
+
+    `fields` is a list of `(cpf_field, name_field, uuid_field)` and `uuids`
+    a function returning `{(cpf, name): uuid}` for a list of pairs (like
+    `PersonIndex.uuids`), called once for each chunk of `chunk_size` rows.
+    The UUID is `None` if both CPF and name are empty.
+    """
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        pairs = [
+            (row[cpf_field], row[name_field])
+            for row in chunk
+            for cpf_field, name_field, _ in fields
+        ]
+        result = uuids([pair for pair in pairs if pair != (None, None)])
+        result[None, None] = None
+        for row in chunk:
+            for cpf_field, name_field, uuid_field in fields:
+                row[uuid_field] = result[row[cpf_field], row[name_field]]
+            yield row
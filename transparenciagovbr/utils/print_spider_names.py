@@ -1,8 +1,22 @@
+import sys
+
 from scrapy import spiderloader
 from scrapy.utils import project
 
 settings = project.get_project_settings()
 spider_loader = spiderloader.SpiderLoader.from_settings(settings)
 spiders = spider_loader.list()
+if len(sys.argv) > 1:
+    # List the tables converted by a spider (like `despesas`)
+    for table in getattr(spider_loader.load(sys.argv[1]), "tables", {}):
+        print(table)
+    sys.exit()
+
+# Spiders whose tables are converted by another spider (like `despesas`) are
+# not listed
+converted_by_others = set()
+for spider_name in spiders:
+    converted_by_others.update(getattr(spider_loader.load(spider_name), "tables", {}))
 for spider_name in spiders:
-    print(spider_name)
+    if spider_name not in converted_by_others:
+        print(spider_name)
@@ -0,0 +1,523 @@
+"""Distributed crawl: a queue of work units (spider and period) shared by workers
+
+The coordinator (`enqueue`) puts the entries of the plan (see
+`transparenciagovbr.plan`) in a SQLite database and any number of workers
+(`work`, in one or more processes on each node) claim one unit at a time,
+download its archive, convert it and record it in the spider's manifest. Each
+unit is converted to its own part of the partitioned output
+(`OUTPUT_PATH/<spider>/ano=YYYY/mes=MM/part-<period>.csv.gz`, one output per
+table for despesas, listed in `_index.json` as in `run.sh --partitioned`), so
+the units can finish in any order and a unit converted twice just replaces
+its part. The manifests and the partitions' indexes are updated while
+holding a lock on them (`fcntl.flock`).
+
+A claimed unit is leased to its worker, which renews the lease while working
+on it: if the worker dies, the unit is claimed again by another one after
+`--lease` seconds. Failed units are retried (after `--retry-delay` seconds,
+doubled on each attempt) up to `--max-attempts` times and then marked as
+failed (`status` lists them; `enqueue --retry-failed` puts them back in the
+queue). To use more than one node, the queue database and the `data`
+directory must be on a filesystem shared by all of them, with working POSIX
+locks (`fcntl`; like NFSv4, not mounted with `nolock` or `local_lock`). The
+queue uses SQLite's rollback journal instead of WAL, since WAL's
+shared-memory index is local to each host: every transaction locks the
+database file itself, so the other nodes wait for it (up to 60 seconds).
+
+Usage: python -m transparenciagovbr.workqueue [--queue FILENAME] enqueue|work|status [options]
+"""
+import argparse
+import csv
+import fcntl
+import gzip
+import io
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from transparenciagovbr import settings
+from transparenciagovbr.convert import get_spider
+from transparenciagovbr.plan import PlanEntry, load_plan, parse_shard, plan, select_shard
+from transparenciagovbr.utils.download import (
+    DownloadError,
+    download_file,
+    load_validators,
+    save_validators,
+)
+from transparenciagovbr.utils.manifest import Manifest
+from transparenciagovbr.utils.partition import PartitionIndex, partition_keys, partition_path
+
+
+QUEUE_FILENAME = settings.REPOSITORY_PATH / "data" / "queue.sqlite"
+STATUSES = ("pending", "running", "done", "failed")
+
+
+class WorkQueue:
+    """Queue of `(spider, period)` units in a SQLite database
+
+    The units are claimed in the plan's order, inside an immediate
+    transaction (so two workers never claim the same pending unit).
+    """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(str(filename), timeout=60, isolation_level=None)
+        # Not WAL: it doesn't work with workers on other hosts (see above)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS unit (
+                spider TEXT NOT NULL,
+                period TEXT NOT NULL,
+                url TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                mirror_url TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL DEFAULT 0,
+                worker TEXT,
+                heartbeat_at REAL,
+                rows INTEGER,
+                error TEXT,
+                UNIQUE (spider, period)
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS unit_status ON unit (status, available_at)"
+        )
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def enqueue(self, entries):
+        """Add the plan entries to the queue, returning how many were (re)added
+
+        Units already in the queue are put back as pending (like the ones done
+        in a previous run, whose archive changed), unless they are running.
+        """
+
+        with self.transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                """
+                INSERT INTO unit (spider, period, url, filename, mirror_url)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (spider, period) DO UPDATE SET
+                    url = excluded.url,
+                    filename = excluded.filename,
+                    mirror_url = excluded.mirror_url,
+                    status = 'pending',
+                    attempts = 0,
+                    available_at = 0,
+                    error = NULL
+                WHERE unit.status != 'running'
+                """,
+                [
+                    (entry.spider, entry.period, entry.url, str(entry.filename), entry.mirror_url)
+                    for entry in entries
+                ],
+            )
+            return connection.total_changes - before
+
+    def retry_failed(self):
+        """Put the failed units back in the queue, returning how many they are"""
+
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE unit SET status = 'pending', attempts = 0, available_at = 0 "
+                "WHERE status = 'failed'"
+            )
+            return cursor.rowcount
+
+    def claim(self, worker, lease=3600, max_attempts=3):
+        """Claim the next unit available, returning `(entry, attempt)` (or `None`)
+
+        Units whose lease expired (the worker stopped renewing it) are
+        available again, unless they already had `max_attempts`.
+        """
+
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE unit SET status = 'failed', error = 'lease expired' "
+                "WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (now - lease, max_attempts),
+            )
+            row = connection.execute(
+                """
+                SELECT rowid, spider, period, url, filename, mirror_url, attempts
+                FROM unit
+                WHERE (status = 'pending' AND available_at <= ?)
+                    OR (status = 'running' AND heartbeat_at < ?)
+                ORDER BY rowid
+                LIMIT 1
+                """,
+                (now, now - lease),
+            ).fetchone()
+            if row is None:
+                return None
+            rowid, spider, period, url, filename, mirror_url, attempts = row
+            connection.execute(
+                "UPDATE unit SET status = 'running', attempts = ?, worker = ?, heartbeat_at = ? "
+                "WHERE rowid = ?",
+                (attempts + 1, worker, now, rowid),
+            )
+        return PlanEntry(spider, period, url, Path(filename), mirror_url), attempts + 1
+
+    def _update_claim(self, entry, worker, attempt, assignments, values=()):
+        """Update a unit if it's still claimed by `worker` (returns `False` if not)"""
+
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                f"UPDATE unit SET {assignments} "
+                "WHERE spider = ? AND period = ? AND status = 'running' AND worker = ? "
+                "AND attempts = ?",
+                (*values, entry.spider, entry.period, worker, attempt),
+            )
+            return cursor.rowcount == 1
+
+    def heartbeat(self, entry, worker, attempt):
+        return self._update_claim(entry, worker, attempt, "heartbeat_at = ?", (time.time(),))
+
+    def complete(self, entry, worker, attempt, rows):
+        return self._update_claim(
+            entry, worker, attempt, "status = 'done', rows = ?, error = NULL", (rows,)
+        )
+
+    def fail(self, entry, worker, attempt, error, max_attempts=3, retry_delay=60):
+        """Put the unit back in the queue (after a delay) or mark it as failed"""
+
+        if attempt >= max_attempts:
+            return self._update_claim(
+                entry, worker, attempt, "status = 'failed', error = ?", (error,)
+            )
+        available_at = time.time() + retry_delay * 2 ** (attempt - 1)
+        return self._update_claim(
+            entry,
+            worker,
+            attempt,
+            "status = 'pending', available_at = ?, error = ?",
+            (available_at, error),
+        )
+
+    def counts(self):
+        """Return `{spider: {status: units}}`"""
+
+        result = {}
+        for spider, status, units in self.connection.execute(
+            "SELECT spider, status, COUNT(*) FROM unit GROUP BY spider, status ORDER BY spider"
+        ):
+            result.setdefault(spider, {key: 0 for key in STATUSES})[status] = units
+        return result
+
+    def unfinished(self):
+        """Return the number of units pending or running"""
+
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM unit WHERE status IN ('pending', 'running')"
+        ).fetchone()[0]
+
+    def failed(self):
+        return self.connection.execute(
+            "SELECT spider, period, attempts, error FROM unit WHERE status = 'failed' "
+            "ORDER BY rowid"
+        ).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+@contextmanager
+def locked(filename):
+    """Hold an exclusive lock on `<filename>.lock` (shared by all the nodes)"""
+
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    with open(filename.parent / (filename.name + ".lock"), mode="w") as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+@contextmanager
+def renewing_lease(queue_filename, entry, worker, attempt, interval):
+    """Renew the lease of a claimed unit each `interval` seconds (in a thread)"""
+
+    stop = threading.Event()
+
+    def renew():
+        queue = WorkQueue(queue_filename)  # Connections can't be shared by threads
+        try:
+            while not stop.wait(interval):
+                queue.heartbeat(entry, worker, attempt)
+        finally:
+            queue.close()
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def download_unit(entry, use_mirror=False, force=False):
+    """Download the unit's archive (unless it was downloaded before)
+
+    With `force`, an archive already on the disk is downloaded again if it
+    changed in the server (checked with a conditional request, if its
+    validators were stored). Return `True` if the archive was downloaded.
+    """
+
+    headers = {}
+    if entry.filename.exists():
+        if not force:
+            return False
+        validators = load_validators(entry.filename) or {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    url = entry.mirror_url if use_mirror else entry.url
+    status, response_headers = download_file(
+        url,
+        entry.filename,
+        headers=headers,
+        segments=settings.DOWNLOAD_SEGMENTS,
+        min_segment_size=settings.DOWNLOAD_SEGMENT_MIN_SIZE,
+    )
+    if status == 304:  # Not changed
+        return False
+    elif status != 200:
+        raise DownloadError(f"could not download {url}: HTTP {status}")
+    save_validators(entry.filename, response_headers, size=entry.filename.stat().st_size)
+    return True
+
+
+def convert_unit(entry, output_path, worker):
+    """Convert the unit's archive to one part per table, returning the rows of each
+
+    The parts are written with temporary names (renamed when all the rows
+    were written) and then added to the partitions' indexes.
+    """
+
+    spider = get_spider(entry.spider)
+    keys = partition_keys(entry.period, spider.publish_frequency)
+    partition = partition_path(keys)
+    part_name = f"{partition}/part-{entry.period.replace('-', '')}.csv.gz"
+    parts, counter = {}, Counter()
+    try:
+        for row in spider.parse_zip_file(str(entry.filename)):
+            table = getattr(row, "table", None) or spider.name
+            if table not in parts:
+                filename = output_path / table / part_name
+                temp_filename = filename.parent / f".{filename.name}.{worker}"
+                temp_filename.parent.mkdir(parents=True, exist_ok=True)
+                fobj = io.TextIOWrapper(
+                    gzip.open(temp_filename, mode="wb"), encoding="utf-8", newline=""
+                )
+                writer = csv.writer(fobj)
+                writer.writerow(row.keys())
+                parts[table] = (filename, temp_filename, fobj, writer)
+            parts[table][3].writerow(row.values())
+            counter[table] += 1
+    except BaseException:
+        for _, temp_filename, fobj, _ in parts.values():
+            fobj.close()
+            temp_filename.unlink()
+        raise
+    for filename, temp_filename, fobj, _ in parts.values():
+        fobj.close()
+        os.replace(temp_filename, filename)
+    for table, rows in counter.items():
+        index_path = output_path / table
+        with locked(index_path / "_index.json"):
+            index = PartitionIndex(index_path)
+            index.add(keys, part_name, rows)
+            index.save()
+    return partition, counter
+
+
+def process_unit(entry, output_path, worker, use_mirror=False):
+    """Download and convert a unit and record it in the manifest (returns the rows)"""
+
+    # A period enqueued again (not current in the manifest) may have a new
+    # version of the archive in the server
+    manifest_filename = settings.MANIFEST_PATH / f"{entry.spider}.json"
+    force = not Manifest(manifest_filename).is_current(entry.period, entry.filename)
+    # Archives are shared by spiders (like despesa's), so two workers must not
+    # download the same file at the same time
+    with locked(entry.filename):
+        download_unit(entry, use_mirror=use_mirror, force=force)
+    partition, counter = convert_unit(entry, output_path, worker)
+    rows = sum(counter.values())
+    with locked(manifest_filename):
+        manifest = Manifest(manifest_filename)
+        manifest.add(entry.period, entry.filename, rows, partition)
+        manifest.save()
+    return rows
+
+
+def work(
+    queue_filename,
+    output_path=settings.OUTPUT_PATH,
+    use_mirror=False,
+    lease=3600,
+    max_attempts=3,
+    retry_delay=60,
+    poll_interval=10,
+):
+    """Process units until the queue has none pending or running (in a worker)
+
+    Return the number of units done and failed.
+    """
+
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    queue = WorkQueue(queue_filename)
+    done = failed = 0
+    try:
+        while True:
+            claim = queue.claim(worker, lease=lease, max_attempts=max_attempts)
+            if claim is None:
+                if not queue.unfinished():
+                    break
+                # Units waiting to be retried or running in other workers
+                time.sleep(poll_interval)
+                continue
+            entry, attempt = claim
+            try:
+                with renewing_lease(queue_filename, entry, worker, attempt, lease / 4):
+                    rows = process_unit(entry, Path(output_path), worker, use_mirror)
+            except Exception as exception:
+                error = f"{type(exception).__name__}: {exception}"
+                print(f"ERROR: {entry.spider} {entry.period} (attempt {attempt}): {error}")
+                queue.fail(
+                    entry,
+                    worker,
+                    attempt,
+                    error,
+                    max_attempts=max_attempts,
+                    retry_delay=retry_delay,
+                )
+                failed += 1
+            else:
+                queue.complete(entry, worker, attempt, rows)
+                done += 1
+    finally:
+        queue.close()
+    return done, failed
+
+
+def skip_converted_by_others(entries):
+    """Leave out the entries of spiders whose table is converted by another spider
+
+    Like `pagamento`, converted by `despesas` (if `despesas` is also in the
+    entries; see `utils/print_spider_names.py`).
+    """
+
+    converted_by_others = set()
+    for spider_name in {entry.spider for entry in entries}:
+        converted_by_others.update(getattr(get_spider(spider_name), "tables", {}))
+    return [entry for entry in entries if entry.spider not in converted_by_others]
+
+
+def print_status(queue):
+    counts = queue.counts()
+    print(f"{'spider':<30} " + " ".join(f"{status:>8}" for status in STATUSES))
+    for spider, values in counts.items():
+        print(f"{spider:<30} " + " ".join(f"{values[status]:>8}" for status in STATUSES))
+    for spider, period, attempts, error in queue.failed():
+        print(f"FAILED: {spider} {period} ({attempts} attempts): {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queue", default=str(QUEUE_FILENAME), help="SQLite database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add the plan's units to the queue")
+    enqueue_parser.add_argument("--plan", help="Plan file (see transparenciagovbr.plan)")
+    enqueue_parser.add_argument("--shard", type=parse_shard, help="Only the shard I of N (I/N)")
+    enqueue_parser.add_argument(
+        "--incremental", action="store_true", help="Skip the periods already converted"
+    )
+    enqueue_parser.add_argument(
+        "--retry-failed", action="store_true", help="Put the failed units back in the queue"
+    )
+    enqueue_parser.add_argument("spider_names", nargs="*")
+
+    work_parser = subparsers.add_parser("work", help="Process units until the queue is empty")
+    work_parser.add_argument("--processes", type=int, default=os.cpu_count())
+    work_parser.add_argument("--use-mirror", action="store_true")
+    work_parser.add_argument("--lease", type=float, default=3600, help="Seconds")
+    work_parser.add_argument("--max-attempts", type=int, default=3)
+    work_parser.add_argument("--retry-delay", type=float, default=60, help="Seconds")
+
+    subparsers.add_parser("status", help="Print the units by spider and status")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    if args.command == "enqueue":
+        entries = load_plan(args.plan) if args.plan else plan(args.spider_names)
+        if args.spider_names:
+            entries = [entry for entry in entries if entry.spider in args.spider_names]
+        entries = skip_converted_by_others(entries)
+        if args.shard:
+            entries = select_shard(entries, *args.shard)
+        if args.incremental:
+            manifests = {
+                spider: Manifest.for_spider(spider)
+                for spider in {entry.spider for entry in entries}
+            }
+            entries = [
+                entry
+                for entry in entries
+                if not manifests[entry.spider].is_current(entry.period, entry.filename)
+            ]
+        if args.retry_failed:
+            print(f"{queue.retry_failed()} failed units back in the queue")
+        print(f"{queue.enqueue(entries)} units added to {args.queue}")
+
+    elif args.command == "work":
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [
+                executor.submit(
+                    work,
+                    args.queue,
+                    use_mirror=args.use_mirror,
+                    lease=args.lease,
+                    max_attempts=args.max_attempts,
+                    retry_delay=args.retry_delay,
+                )
+                for _ in range(args.processes)
+            ]
+            done = failed = 0
+            for future in futures:
+                worker_done, worker_failed = future.result()
+                done += worker_done
+                failed += worker_failed
+        print(f"{done} units done, {failed} failed attempts")
+        print_status(queue)
+
+    elif args.command == "status":
+        print_status(queue)
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()